@@ -23,7 +23,14 @@ class qtArgs():
             value = []
             widget = getattr(self.window, name)
 
-            for row in range(0, widget.rowCount()):
+            # views with a model that converts itself to rows
+            if hasattr(widget, 'model') and hasattr(widget.model(), 'toList'):
+                value = widget.model().toList()
+                rows = 0
+            else:
+                rows = widget.rowCount()
+
+            for row in range(0, rows):
                 values_row = []
                 # store each row item on values_row
                 for column in range(0, widget.columnCount()):
@@ -54,6 +61,9 @@ class qtArgs():
             if type(value) is not list:
                 fsave = getattr(widget, info['update'])
                 fsave(value)
+            # is a view with a model that loads rows
+            elif hasattr(widget, 'model') and hasattr(widget.model(), 'fromList'):
+                widget.model().fromList(value)
             # is a QTableWidget
             else:
                 # set the numver of rows
@@ -3,9 +3,9 @@
 the configuration file
 
 Usage:
-    scan [-r | -a] [-c <config>] [--optimum <counter-target>] [-o <fileprefix>] [-s] [-m <text>] [--count <n>] [--sleep <n>] [--] <motor> (<initial> <final> <step-or-count> <acquisition-time>)...
-    scan -x [-r | -a] [-c <config>] [--optimum <counter-target>] [-o <outputdir>]
-    [-s] [-m <text>] [--count <n>] [--sleep <n>] [--] [--time <acquisition-time>] (<motor> <initial> <final> <steps>)...
+    scan [-r | -a] [-d] [-p] [-c <config>] [--optimum <counter-target>] [--fit <model>] [-o <fileprefix>] [-s] [-m <text>] [--count <n>] [--target-error <e>] [--sleep <n>] [--target-counts <n> [--target-counter <name>] [--min-time <s>]] [--retries <n>] [--record <file>] [--] <motor> (<initial> <final> <step-or-count> <acquisition-time>)...
+    scan -x [-r | -a] [-d] [-p] [-c <config>] [--optimum <counter-target>] [--fit <model>] [-o <outputdir>]
+    [--mask <file>] [--levels <n>] [-s] [-m <text>] [--count <n>] [--target-error <e>] [--sleep <n>] [--target-counts <n> [--target-counter <name>] [--min-time <s>]] [--retries <n>] [--record <file>] [--] [--time <acquisition-time>] (<motor> <initial> <final> <steps>)...
     scan -l
     scan -h
 
@@ -17,25 +17,69 @@ Options:
     --optimum=<counter-target>
                         Move motor to the optimal point according to this
                         counter after scan
+    --fit <model>       Model used to find the optimal point: max (raw
+                        maximum), peak, edge or centroid [default: max]
     -l, --list-configurations
                         List configurations instead of scanning
     -m <text>, --message=<text>
                         String of comments to put in output file header
-    --count <n>         Scan multiple times [default: 1]
-    --sleep <n>         Sleep time before each acquisition [default: 0]
+    --count <n>         Scan multiple times, alternating the scan direction.
+                        The mean and standard error of each point are
+                        written to the _mean.txt output file [default: 1]
+    --target-error <e>  Stop repeating once the relative error of the mean of
+                        every point is below this value
+    --sleep <n>         Sleep time before each acquisition. Motors with settle
+                        configuration wait for a stable readback instead
+                        [default: 0]
+    --target-counts <n>
+                        Count each point until the target counter reaches n
+                        counts. The acquisition time becomes the maximum time
+                        and the time counted is stored in live-time
+    --target-counter <name>
+                        Counter used by --target-counts (default: the monitor
+                        counter)
+    --min-time <s>      Minimum count time with --target-counts [default: 0]
+    --retries <n>       Retry a point that fails to move or count up to n
+                        times, then mark it in the failed column (counter
+                        values are NaN) and go on with the scan
+    --record <file>     Record every point (positions, values, spectra and
+                        timing) to be replayed later with scanReplay
     -o <fileprefix>, --output=<fileprefix>
                         Output data to file output-prefix/<fileprefix>_nnnn
     -s, --sync          Write to the output file after each point
+    -d, --daemon        Submit the scan to the running scan daemon
+                        (see scanDaemon.py) instead of connecting to devices
+    -p, --optimize-path
+                        Visit points in the order that minimizes motion time
+                        (fast axis and snake/raster/spiral pattern for 2d
+                        scans). Data is stored back in logical order
+    --mask <file>       Only visit 2d scan points inside the mask: a YAML
+                        list of polygons (vertices as [motor 0, motor 1]) or
+                        a .npy or text 0/1 image, one line per motor 1
+                        position. Data keeps the full grid index in
+                        grid-index
+    --levels <n>        Progressive 2d map: visit points coarse to fine in n
+                        levels, starting with every 2^(n-1)th position. A
+                        preview map is written to <output>_map.npz after each
+                        level and the scan can stop at the end of a level
+                        (SIGUSR1 or the finishLevel command). With --mask,
+                        only the first level covers the whole grid
+                        [default: 1]
     -h, --help          Show this help
      -t <acquisition-time>, --time=<acquisition-time>
                         Acquisition time [default: 1] """
 
 from os import path
-from time import sleep
+from time import sleep, time
+from numbers import Number
 import sys
 import os
+import signal
+import sqlite3
 import importlib
 
+import numpy
+
 import py4syn
 import py4syn.utils.motor as motorModule
 from py4syn.utils.plotter import Plotter
@@ -48,15 +92,43 @@ from py4syn.utils.scan import setPostOperationCallback, \
                               setPreScanCallback, setPostScanCallback
 
 
+from py4syn import mtrDB
 from py4syn.utils.motor import wmr, ummv
+from scan_utils.path_optimizer import optimizeGrid, optimizePoints,\
+                                      restoreLogicalOrder, snakeIndex
+from scan_utils.mask import loadMask, maskedSnake
+from scan_utils.progressive import progressiveOrder, ProgressiveMap
+from scan_utils.repetitions import RepetitionStats
+from scan_utils.settle import createSettlers, settle
+from scan_utils.control import ScanControl
+from scan_utils.readout import ScanReadout
+from scan_utils.dwell import AdaptiveDwell, LIVE_TIME
+from scan_utils.retry import PointRetry, FAILED
+from scan_utils.catalog import Catalog, catalogPath, counterStats, outputFiles
+from scan_utils.locks import DeviceLocks, DeviceBusy, LOCK_DIRECTORY,\
+                             counterDevices, motorDevices
+from scan_utils.events import EventBus, PointEvent, ScanEvent, FitEvent
+from scan_utils.replay import EventRecorder
+from scan_utils.roi import createRoiStores
+from scan_utils.fitting import fitAll, formatFits, createFitExecutor, MODELS
+from scan_utils.spill import createSpectraImages, spilledCounters,\
+                             SpilledDevice
+from scan_utils.xrf import createXrfMappers, createXrfExecutor, xrfCounters
+from scan_utils.plan import motorVelocity, motorAcceleration, motorLimits,\
+                            validateLimits
+from scan_utils.pseudo import isPseudo, realTrajectory, TrajectoryError
+from scan_utils.daemon import submitScan, sendCommand, DaemonError
 from scan_utils.helpers import docopt, listConfigurations, DocoptExit,\
                                processUserField,\
                                loadConfiguration, \
                                readConfiguration, die, loadConstants,\
-                               createCounters, createMotor
+                               createCounters, createMotor, counterKey
 
 motorModule.show_info = False
 
+# Index of each point of a masked scan in the full grid
+GRID_INDEX = 'grid-index'
+
 
 def parseCommandLine(argv):
     p = docopt(__doc__,argv)
@@ -81,6 +153,21 @@ def parseCommandLine(argv):
         p['message'] = p['--message']
         p['count'] = int(p['--count'])
         p['sleep'] = float(p['--sleep'])
+        p['daemon'] = bool(p['--daemon'])
+        p['optimizePath'] = bool(p['--optimize-path'])
+        p['fit'] = p['--fit']
+        p['targetError'] = p['--target-error'] and float(p['--target-error'])
+        p['targetCounts'] = p['--target-counts'] and float(p['--target-counts'])
+        p['targetCounter'] = p['--target-counter']
+        p['minTime'] = float(p['--min-time'])
+        p['retries'] = p['--retries'] and int(p['--retries'])
+        p['record'] = p['--record']
+        p['mask'] = p['--mask']
+        p['levels'] = int(p['--levels'])
+        if p['levels'] < 1:
+            raise DocoptExit()
+        if p['fit'] != 'max' and p['fit'] not in MODELS:
+            raise DocoptExit()
     except (IndexError, ValueError):
         raise DocoptExit()
 
@@ -115,8 +202,13 @@ def frange(start, end, step, rnd = 5):
 
     return result
 
-def preOperationCallback(sleep_, **kwargs):
-    sleep(sleep_)
+# Wait before each acquisition. Motors with settle configuration wait for
+# a stable readback, the fixed sleep is used for the others and on timeout
+def preOperationCallback(sleep_, settlers=(), unconfigured=True, **kwargs):
+    if settlers:
+        settle(settlers, sleep_, unconfigured)
+    else:
+        sleep(sleep_)
 
 def plot(plotter, counters, configuration, delta, scan, pos, idx):
     data = getScanData()
@@ -226,18 +318,82 @@ class ScanMotors():
         self.comments = self.args['message']
         self.optimum = self.args['optimum']
         self.time = self.args['time']
+        self.optimizePath = self.args.get('optimizePath', False)
+        self.fitModel = self.args.get('fit', 'max')
+        # Fit results of all counters for each repetition
+        self.fits = []
+        self.targetError = self.args.get('targetError')
+        self.targetCounts = self.args.get('targetCounts')
+        self.targetCounter = self.args.get('targetCounter')
+        self.minTime = self.args.get('minTime', 0)
+        # Adaptive dwell time, when counting to target counts
+        self.dwell = None
+        # Point retry and fault isolation, when retries are enabled
+        self.retries = self.args.get('retries')
+        self.retry = None
+        # Data fields added to py4syn for this scan
+        self.userFields = []
+        # Mask file of a 2d scan, only points inside it are visited
+        self.mask = self.args.get('mask')
+        # Progressive 2d map levels, number of points visited at the end of
+        # each level and the preview map
+        self.levels = self.args.get('levels', 1)
+        self.levelEnds = []
+        self.progressiveMap = None
+        self.finishRequested = False
         self.image = False
+        # Index, in the order created by generateTrajectory, of each point
+        # visited by the optimized path and by the current repetition (None
+        # when it is the same order)
+        self.pathOrder = None
+        self.naturalOrder = None
+        # Mean and variance of each point over repetitions
+        self.repetitionStats = None
+        # ROI engine stores for spectra counters with ROIs configured
+        self.roiStores = {}
+        # On-disk images for spectra counters with spill enabled, these are
+        # collected here instead of in the device
+        self.spectraImages = {}
+        self.spilledDevices = set()
+        # Online XRF fits of spectra counters, producing elemental maps
+        self.xrfMappers = {}
+        # Count time of each visited point of the current repetition
+        self.runTimes = None
+        # Immediate interrupt and pause of the count in progress
+        self.control = ScanControl()
+        self.readout = ScanReadout()
+        # Per point records for GUI, plots and other consumers
+        self.events = EventBus()
+        self.repetition = 0
+        self.pointStart = None
+        # File where the events of the scan are recorded, for replay
+        self.record = self.args.get('record')
+        # Scan settings and start time of each repetition, for the catalog
+        self.configuration = None
+        self.constants = {}
+        self.counterNames = []
+        self.scanStart = None
+        # Locks on the devices used, while the scan runs
+        self.locks = None
 
     def preScanCallback(self, counters, rows, cols, **kwargs):
         """if a counter is dxp call startcollectimage method"""
+        self.scanStart = time()
+        self.readout.attach(kwargs['scan'])
+        if self.dwell is not None:
+            self.dwell.attach(kwargs['scan'])
+        self.control.attach(kwargs['scan'])
+        if self.retry is not None:
+            self.retry.attach(kwargs['scan'])
+        self.events.publish(ScanEvent('start', time(), self.repetition))
+
         for key, counter in counters.items():
             # k[1] is spectra
             if (key[0]  == 'dxp' or key[0]  == 'dxpfake' or key[0] == 'qe65000') and key[-1]:
-                
                 counter.startCollectImage(rows, cols)
 
     def prePointCallback(self, **kwargs):
-        pass
+        self.pointStart = time()
 
     def postPointCallback(self, countersConf, counters, configuration, constants, **kwargs):
         # TODO: procurar um jeito melhor de encontrar o count e o actualCount
@@ -262,30 +418,344 @@ class ScanMotors():
                                 f = 1.0
                             actualCount.setNormValue(f)
 
+        data = getScanData()
+        for name, store in self.roiStores.items():
+            store.add(self.naturalIndex(len(data[name]) - 1), data[name][-1])
+        for name, image in self.spectraImages.items():
+            image.spill(self.naturalIndex(len(data[name]) - 1), data[name])
+        for name, mapper in self.xrfMappers.items():
+            index = len(data[name]) - 1
+            mapper.add(self.naturalIndex(index), data[name][-1],
+                       self.countTime(index))
+
+        if self.repetitionStats is not None:
+            for name in countersConf:
+                if data.get(name):
+                    self.repetitionStats.add(name,
+                        self.naturalIndex(len(data[name]) - 1), data[name][-1])
+
+        self.events.publish(self.pointEvent(countersConf, data))
+
+        if self.progressiveMap is not None:
+            index = len(data['points']) - 1
+            for name in countersConf:
+                if data.get(name):
+                    self.progressiveMap.add(name, self.naturalIndex(index),
+                                            data[name][-1])
+            if index + 1 in self.levelEnds:
+                self.endLevel(self.levelEnds.index(index + 1))
+
+    def endLevel(self, level):
+        """Write the preview map at the end of a progressive level and stop
+        there if asked to"""
+        self.progressiveMap.save()
+        print('Level %d of %d done, map written to %s' %
+              (level + 1, len(self.levelEnds), self.progressiveMap.fileName))
+        self.events.publish(ScanEvent('level', time(), self.repetition))
+
+        if self.finishRequested and level + 1 < len(self.levelEnds):
+            print('Stopping after level %d' % (level + 1))
+            self.interrupt()
+
+    def recordGridIndex(self, **kwargs):
+        values = getScanData()[GRID_INDEX]
+        values.append(self.naturalIndex(len(values)))
+
+    def pointEvent(self, countersConf, data):
+        """Record of the last point in data"""
+        motors = self.motor if self.image else [self.motor]
+        index = len(data['points']) - 1
+        positions = dict((m, data[m][-1]) for m in motors if data.get(m))
+        values = {}
+        arrays = {}
+
+        for name in countersConf:
+            if not data.get(name):
+                continue
+            value = data[name][-1]
+
+            if isinstance(value, (numpy.ndarray, list, tuple)):
+                arrays[name] = value
+            elif isinstance(value, (Number, str)):
+                values[name] = value
+
+        return PointEvent(index, self.naturalIndex(index), positions, values,
+                          arrays, self.pointStart, time(), self.countTime(index),
+                          self.repetition)
+
+    def countTime(self, index):
+        """Count time of the visited point index"""
+        if self.dwell is not None:
+            return getScanData()[LIVE_TIME][-1]
+        if self.image:
+            return self.time
+
+        return self.runTimes[index]
+
+    def publishFit(self, counter, natural, values):
+        self.events.publish(FitEvent(counter, natural, values, time(),
+                                     self.repetition))
+
+    def naturalIndex(self, index):
+        """Index in the order created by generateTrajectory of the visited
+        point index"""
+        if self.naturalOrder is None:
+            return index
+
+        return int(self.naturalOrder[index])
+
     def postScanCallback(self, counters, **kwargs):
         for key, counter in counters.items():
             # k[1] is spectra
             if (key[0]  == 'dxp' or key[0]  == 'dxpfake' or key[0] == 'qe65000') and key[-1]:
                 counter.stopCollectImage()
 
+        self.readout.close()
+        for store in self.roiStores.values():
+            store.close()
+        if self.progressiveMap is not None:
+            self.progressiveMap.save()
+        for image in self.spectraImages.values():
+            image.close()
+        for name, mapper in self.xrfMappers.items():
+            mapper.close()
+            print('XRF maps of %s written to %s' % (name, mapper.fileName))
+
+        self.events.publish(ScanEvent('end', time(), self.repetition))
+
+        if self.control.incomplete:
+            print('Incomplete points: %s' % ', '.join(
+                str(self.naturalIndex(i)) for i in self.control.incomplete))
+        if self.retry is not None and self.retry.failed:
+            print('Failed points: %s' % ', '.join(
+                str(self.naturalIndex(i)) for i, _ in self.retry.failed))
+
+        if self.naturalOrder is not None:
+            restoreLogicalOrder(getScanData(), self.naturalOrder)
+
+        self.catalogScan()
+
+    def catalogScan(self):
+        """Record the scan that just ended in the catalog"""
+        fileName = catalogPath(self.configuration)
+        if fileName is None:
+            return
+
+        data = getScanData()
+        motors = self.motor if self.image else [self.motor]
+        ranges = []
+        for m in motors:
+            positions = [p for p in data.get(m) or []
+                         if isinstance(p, Number) and p == p]
+            if positions:
+                ranges.append((m, min(positions), max(positions)))
+
+        stats = []
+        for name in self.counterNames:
+            values = counterStats(data.get(name) or [],
+                                  None if self.image else data.get(self.motor))
+            if values is not None:
+                stats.append((name,) + values)
+
+        configuration = self.configuration
+        settings = {
+            'counters': dict((n, configuration['counters'].get(n))
+                             for n in self.counterNames),
+            'motors': dict((m, configuration['motors'].get(m)) for m in motors),
+        }
+        output = path.join(configuration['misc'].get('output-prefix') or '',
+                           self.output) if self.output else None
+        scan = {
+            'start': self.scanStart,
+            'end': time(),
+            'points': len(data['points']),
+            'image': int(self.image),
+            'repetition': self.repetition,
+            'status': 'interrupted' if self.control.interrupted else 'ok',
+            'command': self.args,
+            'configuration': self.args.get('configuration'),
+            'settings': settings,
+            'constants': self.constants,
+            'comment': self.comments,
+            'output': output,
+            'files': outputFiles(output, self.scanStart),
+        }
 
-    def runScan(self):
-
-        if len(self.motor) == 1:
-            self.motor = self.motor[0]
+        try:
+            Catalog(fileName).add(scan, ranges, stats)
+        except (sqlite3.Error, OSError) as e:
+            print('Unable to record scan in catalog: %s' % e)
+
+    def collectsInDevice(self, counters):
+        """True if some device collects a spectra image by itself, which
+        requires points to be visited in the generated order"""
+        for key in counters:
+            if (key[0]  == 'dxp' or key[0]  == 'dxpfake' or key[0] == 'qe65000') and key[-1]:
+                if key not in self.spilledDevices:
+                    return True
+
+        return False
+
+    def optimizeTrajectory(self, points, times, counters, start):
+        """Reorder points to minimize motion time. Returns new points and
+        times and stores the original index of each point in pathOrder"""
+        if self.collectsInDevice(counters):
+            print('Spectra images are collected in scan order, '
+                  'path optimization disabled')
+            return points, times
+        if self.image and self.levels > 1:
+            print('Progressive maps are visited level by level, '
+                  'path optimization disabled')
+            return points, times
+
+        motors = self.motor if self.image else [self.motor]
+        velocities = [motorVelocity(mtrDB[m]) for m in motors]
+        accelerations = [motorAcceleration(mtrDB[m]) for m in motors]
+
+        if self.image and self.mask:
+            # Masked points are no longer a grid, order them freely and keep
+            # their grid index
+            points, order, t = optimizePoints(points, velocities,
+                                              accelerations, start)
+            self.pathOrder = self.pathOrder[order]
+            print('Path: motion time %gs' % t)
+        elif self.image:
+            axes = [frange(i, f, s) for i, f, s in zip(self.initial, self.final,
+                                                       self.steps)]
+            points, logical, fastAxis, pattern, t = \
+                optimizeGrid(axes, velocities, accelerations, start)
+            self.pathOrder = snakeIndex(logical, len(axes[0]))
+            print('Path: %s, fast motor %s, motion time %gs' %
+                  (pattern, motors[fastAxis], t))
+        else:
+            p, self.pathOrder, t = optimizePoints([points], velocities,
+                                                  accelerations, [start])
+            points = p[0]
+            times = [times[i] for i in self.pathOrder]
+            print('Path: motion time %gs' % t)
+
+        return points, times
+
+    def selectPoints(self, points, counters):
+        """Keep only the 2d scan points inside the mask, in snake order, or
+        order them coarse to fine for progressive maps. The grid index of
+        each point is stored in pathOrder"""
+        if self.collectsInDevice(counters):
+            die('Spectra images are collected in scan order, masked and '
+                'progressive scans need spill enabled')
+
+        axes = [frange(i, f, s) for i, f, s in zip(self.initial, self.final,
+                                                   self.steps)]
+        mask = None
+        if self.mask:
+            try:
+                mask = loadMask(self.mask, axes)
+            except (OSError, ValueError) as e:
+                die(e)
+
+        if self.levels > 1:
+            keep, sizes = progressiveOrder(len(axes[1]), len(axes[0]),
+                                           self.levels, mask)
+            self.levelEnds = numpy.cumsum(sizes).tolist()
+            print('Progressive map: %s points per level' %
+                  ', '.join(str(n) for n in sizes))
+        else:
+            keep = maskedSnake(mask)
+            if len(keep) == 0:
+                die('No scan point inside mask %s' % self.mask)
+            print('Mask: %d of %d points' % (len(keep), len(points[0])))
+
+        self.pathOrder = keep
+
+        return [numpy.asarray(p)[keep].tolist() for p in points]
+
+    def createDwell(self, counters, configuration):
+        """Adaptive dwell time for --target-counts, counting until the target
+        counter (by default the monitor counter) reaches the target"""
+        name = self.targetCounter
+        if name is None:
+            monitors = [n for n in counters
+                        if configuration['counters'][n].get('monitor')]
+            if not monitors:
+                die('--target-counts needs --target-counter or a monitor counter')
+            name = monitors[0]
 
         try:
-            configuration = loadConfiguration()
-            counters = readConfiguration('config.' + self.args['configuration'] +
-                                         '.yml')
-        except OSError as e:
+            return AdaptiveDwell(name, self.targetCounts, self.minTime)
+        except ValueError as e:
             die(e)
 
-        if self.relative is None:
-            self.relative = configuration['misc'].get('default-scan') == 'relative'
+    def countTimes(self, times):
+        """Times passed to the scan, the maximum times with adaptive dwell"""
+        if self.dwell is None:
+            return times
 
-#        try:
-        countersList = createCounters(counters, configuration, self.output)
+        return self.dwell.countTimes(times)
+
+    def pseudoTrajectory(self, points, configuration):
+        """Precompute real motor positions of a pseudo motor scan and check
+        them against the real motor limits. Returns None when the pseudo
+        motor must be moved point by point"""
+        if self.image or not isPseudo(self.motor, configuration):
+            return None
+
+        try:
+            real = realTrajectory(self.motor, points, configuration, mtrDB)
+        except TrajectoryError as e:
+            print('%s, moving pseudo motor point by point' % e)
+            return None
+
+        limits = dict((m, motorLimits(mtrDB[m])) for m in real)
+        violations = validateLimits([(self.motor, m, p) for m, p in real.items()],
+                                    limits)
+        for _, m, p, low, high in violations:
+            print('Motor %s position %g outside limits [%g, %g]' %
+                  (m, p, low, high))
+        if violations:
+            die('Pseudo motor %s trajectory is outside real motor limits' %
+                self.motor)
+
+        return real
+
+    def recordPseudoPosition(self, **kwargs):
+        getScanData()[self.motor].append(mtrDB[self.motor].getRealPosition())
+
+    def _getScanData(self):
+        s = getScanData()
+        if s is not None:
+            return s['scan_object']
+        else:
+            return None
+
+    # Interrupt and pause abort the count in progress, paused points are
+    # counted again on resume
+    def interrupt(self):
+        scanData = self._getScanData()
+        if scanData is not None:
+            scanData.interrupt()
+        self.control.interrupt()
+
+    def pause(self):
+        self.control.pause()
+
+    # Progressive maps stop at the end of the current level
+    def finishLevel(self):
+        self.finishRequested = True
+
+    def resume(self):
+        self.control.resume()
+
+    def loadConfiguration(self):
+        """Return the global configuration and the selected counter list"""
+        configuration = loadConfiguration()
+        counters = readConfiguration('config.' + self.args['configuration'] +
+                                     '.yml')
+        return configuration, counters
+
+    def createCounters(self, counters, configuration):
+        return createCounters(counters, configuration, self.output)
+
+    def createMotors(self, configuration):
         if isinstance(self.motor,list)  and len(self.motor) > 1:
             # 2d mode (snake)
             self.image = True
@@ -294,17 +764,90 @@ class ScanMotors():
         else:
              createMotor(self.motor, configuration)
 
-#        except (LookupError, ValueError) as e:
-#            die(e)
-
+    def generateTrajectory(self, configuration):
+        """Return points, times, rows and cols of the scan. In 2d mode points
+        has one list for each motor and times is None (self.time is used)"""
         if self.image:
             points, cols, rows = generatePointsSnake(self.initial, self.final, self.steps)
+            times = None
         else:
             points, times = generatePoints(self.initial, self.final, self.stepOrCount,
                                            self.acquisitionTime, configuration)
 
             rows = len(points)
             cols = 1
+
+        return points, times, rows, cols
+
+    def runScan(self):
+
+        if len(self.motor) == 1:
+            self.motor = self.motor[0]
+
+        try:
+            configuration, counters = self.loadConfiguration()
+        except OSError as e:
+            die(e)
+
+        if self.relative is None:
+            self.relative = configuration['misc'].get('default-scan') == 'relative'
+
+        # Scans in other processes using the same devices are waited for
+        self.lockDevices(counters, configuration)
+        try:
+            self.runLocked(configuration, counters)
+        finally:
+            # py4syn callbacks are global, later scans in this process (daemon,
+            # plans) must not call back into this one
+            setPostOperationCallback(None)
+            self.readout.close()
+            self.resetScanSettings()
+            self.locks.release()
+
+    def resetScanSettings(self):
+        """Undo the py4syn settings and data fields of this scan, so they
+        don't leak into the next scan run in this process"""
+        setOutput(None)
+        setScanComment('')
+        setPartialWrite(False)
+
+        data = getScanData()
+        for name in self.userFields + [LIVE_TIME, FAILED]:
+            data.pop(name, None)
+        self.userFields = []
+
+    def lockDevices(self, counters, configuration):
+        # Runs before createMotors, so self.image isn't set yet
+        motors = self.motor if isinstance(self.motor, list) else [self.motor]
+        devices = counterDevices(counters, configuration)
+        for m in motors:
+            if m in configuration['motors']:
+                devices.extend(motorDevices(m, configuration))
+
+        misc = configuration['misc']
+        self.locks = DeviceLocks(misc.get('lock-directory', LOCK_DIRECTORY))
+        owner = 'pid %d, %s scan' % (os.getpid(), ' '.join(motors))
+        try:
+            self.locks.acquire(devices, owner, misc.get('lock-timeout'))
+        except (DeviceBusy, OSError) as e:
+            die(e)
+
+    def runLocked(self, configuration, counters):
+#        try:
+        countersList = self.createCounters(counters, configuration)
+        if self.targetCounts:
+            self.dwell = self.createDwell(counters, configuration)
+        if self.retries is not None:
+            misc = configuration['misc']
+            self.retry = PointRetry(self.retries, misc.get('retry-delay', 0.5),
+                                    misc.get('retry-max-delay', 10))
+        self.createMotors(configuration)
+
+#        except (LookupError, ValueError) as e:
+#            die(e)
+
+        points, times, rows, cols = self.generateTrajectory(configuration)
+        if not self.image:
             print(rows)
 
         # callbacks to collect image
@@ -315,6 +858,9 @@ class ScanMotors():
                             *l, **kw))
 
         constants = loadConstants()[0]
+        self.configuration = configuration
+        self.constants = constants
+        self.counterNames = list(counters)
         if self.image:
             oldPosition = []
             for m in self.motor:
@@ -322,6 +868,29 @@ class ScanMotors():
         else:
             oldPosition = wmr(self.motor)
 
+        self.spilledDevices = set(counterKey(configuration['counters'][n])
+                                  for n in spilledCounters(counters, configuration))
+        # Their image is collected to a file, behind the device image API
+        for key in self.spilledDevices:
+            countersList[key] = SpilledDevice(countersList[key])
+
+        # Points keep their full grid index, so outputs still map to the grid
+        gridPoints = len(points[0]) if self.image else len(points)
+        postOperation = None
+        if self.image and (self.mask or self.levels > 1):
+            points = self.selectPoints(points, countersList)
+            createUserDefinedDataField(GRID_INDEX)
+            self.userFields.append(GRID_INDEX)
+            postOperation = lambda *l, **kw: self.recordGridIndex(**kw)
+
+        if self.optimizePath:
+            if self.relative:
+                start = [0]*len(self.motor) if self.image else 0
+            else:
+                start = oldPosition
+            points, times = self.optimizeTrajectory(points, times, countersList,
+                                                    start)
+
         if self.relative:
             np = []
             for x in points:
@@ -329,11 +898,25 @@ class ScanMotors():
             points = np
             delta = oldPosition
             createUserDefinedDataField('delta')
+            self.userFields.append('delta')
         else:
             delta = 0
 
-        setPreOperationCallback(lambda *l, **kw: preOperationCallback(self.sleep, *l,
-                                **kw))
+        # Pseudo motors are scanned by driving their real motors along
+        # precomputed trajectories, the pseudo position is still recorded
+        real = self.pseudoTrajectory(points, configuration)
+        if real is not None:
+            createUserDefinedDataField(self.motor)
+            self.userFields.append(self.motor)
+            postOperation = lambda *l, **kw: self.recordPseudoPosition(**kw)
+        # Always set, so callbacks of a previous scan are replaced (they're
+        # cleared again in runScan)
+        setPostOperationCallback(postOperation)
+
+        settlers, unconfigured = createSettlers(self.motor if self.image else
+                                                [self.motor], configuration, mtrDB)
+        setPreOperationCallback(lambda *l, **kw: preOperationCallback(self.sleep,
+                                settlers, len(unconfigured) > 0, *l, **kw))
 
         setPrePointCallback(lambda *l, **kw: self.prePointCallback(*l, **kw))
 
@@ -347,15 +930,40 @@ class ScanMotors():
         #else:
         #    setX(motor)
 
+        # Always set, a previous scan in this process may have set them
         if self.output:
             setOutput(path.join(configuration['misc']['output-prefix'], self.output))
-        if self.comments:
-            setScanComment(self.comments)
-        if self.sync:
-            setPartialWrite(True)
-
+        else:
+            setOutput(None)
+        setScanComment(self.comments or '')
+        setPartialWrite(bool(self.sync))
+
+        nPoints = len(points[0]) if self.image else len(points)
+        if self.args['count'] > 1:
+            self.repetitionStats = RepetitionStats(gridPoints)
+        # Alternate scan direction, so no return move is needed between
+        # repetitions
+        alternate = self.args['count'] > 1 and \
+                    not self.collectsInDevice(countersList) and \
+                    not self.levelEnds
+
+        recorder = None
+        if self.record:
+            # Replays write the ROI, spectra and XRF outputs again from the
+            # configuration and map geometry
+            recorder = EventRecorder(self.record, self.events, {
+                'args': self.args, 'motors': self.motor if self.image else
+                [self.motor], 'counters': self.counterNames, 'image': self.image,
+                'configuration': configuration, 'lines': cols,
+                'pointsPerLine': rows})
+
+        fitExecutor = None
+        xrfExecutor = None
+        if xrfCounters(counters, configuration):
+            xrfExecutor = createXrfExecutor(configuration['misc'].get('xrf-workers'))
         k = 1
         for i in range(self.args['count']):
+            self.repetition = i
             #TODO: remover comentário
             j = 1
 #            for counter in counters:
@@ -367,17 +975,66 @@ class ScanMotors():
 #                    j += 1
 #                    k += 1
 
+            dataPrefix = path.join(configuration['misc'].get('output-prefix') or '',
+                                   self.output or 'scan')
+            if self.args['count'] > 1:
+                dataPrefix += '_%d' % (i + 1)
+            self.roiStores = createRoiStores(counters, configuration, dataPrefix)
+            # In 2d mode, rows are positions of motor 0 and cols of motor 1
+            self.spectraImages = createSpectraImages(counters, configuration,
+                                                     dataPrefix, cols, rows,
+                                                     self.image)
+            for name, image in self.spectraImages.items():
+                countersList[counterKey(configuration['counters'][name])].attach(image)
+            if self.levelEnds:
+                self.progressiveMap = ProgressiveMap(dataPrefix + '_map.npz',
+                                                     cols, rows, self.levels)
+            if xrfExecutor is not None:
+                try:
+                    self.xrfMappers = createXrfMappers(counters, configuration,
+                                                       dataPrefix, xrfExecutor,
+                                                       cols, rows, self.image,
+                                                       self.publishFit)
+                except (OSError, ValueError, KeyError) as e:
+                    xrfExecutor.shutdown()
+                    die(e)
+
+            if alternate and i % 2 == 1:
+                if self.pathOrder is not None:
+                    self.naturalOrder = self.pathOrder[::-1]
+                else:
+                    self.naturalOrder = numpy.arange(nPoints)[::-1]
+                if self.image:
+                    runPoints = [points[0][::-1], points[1][::-1]]
+                    runTimes = times
+                else:
+                    runPoints = points[::-1]
+                    runTimes = times[::-1]
+            else:
+                self.naturalOrder = self.pathOrder
+                runPoints = points
+                runTimes = times
+            self.runTimes = runTimes
+
 #            try:
-            if not self.image:
-                scan(self.motor, points, -1, times)
+            if real is not None:
+                reverse = runPoints is not points
+                motorPoints = []
+                for m, p in real.items():
+                    motorPoints += [m, (p[::-1] if reverse else p).tolist()]
+                scan(*(motorPoints + [len(runPoints), self.countTimes(runTimes)]))
+            elif not self.image:
+                scan(self.motor, runPoints, -1, self.countTimes(runTimes))
             else:
                 # len(points[0]) -> number of steps
                 print("Tempo de coleta: ", self.time)
-                scan(self.motor[0], points[0], self.motor[1], points[1], len(points[0]),self.time)
+                scan(self.motor[0], runPoints[0], self.motor[1], runPoints[1], len(points[0]),self.countTimes([self.time])[0])
 #            except Exception as e:
 #                die(e)
 
             print('Scan ended')
+            if self.finishRequested:
+                break
 
             _, peakAt, _, _, _ = getFitValues()
             if peakAt is not None:
@@ -388,14 +1045,56 @@ class ScanMotors():
                 else:
                     print('')
 
+            if not self.image:
+                if fitExecutor is None:
+                    fitExecutor = createFitExecutor()
+                data = getScanData()
+                self.fits.append(fitAll(data[self.motor], data, counters,
+                                        executor=fitExecutor))
+                print(formatFits(self.fits[-1]))
+
+            if self.targetError is not None and self.repetitionStats is not None:
+                e = self.repetitionStats.maxRelativeError(counters)
+                print('Maximum relative error: %g' % e)
+                if e <= self.targetError:
+                    print('Target error reached after %d repetitions' % (i + 1))
+                    break
+
+        if fitExecutor is not None:
+            fitExecutor.shutdown()
+        if xrfExecutor is not None:
+            xrfExecutor.shutdown()
+        if recorder is not None:
+            recorder.close()
+            print('Scan recorded to %s' % self.record)
+
+        if self.repetitionStats is not None:
+            data = getScanData()
+            motors = self.motor if self.image else [self.motor]
+            meanFile = path.join(configuration['misc'].get('output-prefix') or '',
+                                 (self.output or 'scan') + '_mean.txt')
+            self.repetitionStats.save(meanFile, [data[m] for m in motors], motors)
+            print('Mean of repetitions written to %s' % meanFile)
+
         if self.optimum:
             x = getScanData()[self.motor]
             y = getScanData()[self.optimum]
 
-            m = max(y)
-            p = x[y.index(m)]
+            fit = None
+            if self.fitModel != 'max' and self.fits:
+                fit = self.fits[-1].get(self.optimum, {}).get(self.fitModel)
+                if fit is None:
+                    print('Unable to fit %s with %s model, using maximum' %
+                          (self.optimum, self.fitModel))
+
+            if fit is not None:
+                p = fit['position']
+                print("%s at " % self.fitModel.capitalize(), p)
+            else:
+                m = max(y)
+                p = x[y.index(m)]
 
-            print("Max: ", m, " at ", p)
+                print("Max: ", m, " at ", p)
             print("Moving to peak. ")
             umv(self.motor, p)
             print("Motor at ", wmr(self.motor))
@@ -408,6 +1107,24 @@ class ScanMotors():
 #        print('Scan ended. Waiting for graph to close...')
 #        plotter.plot_process.join()
 
+# Run the scan on the scan daemon, printing its progress
+def runRemoteScan(args):
+    try:
+        result = submitScan(args)
+    except KeyboardInterrupt:
+        sendCommand('interrupt')
+        raise SystemExit(-2)
+    except (OSError, DaemonError) as e:
+        die('Unable to submit scan to daemon: %s' % e)
+
+    if result['status'] != 'ok':
+        die(result.get('message', 'Scan failed'))
+
 if __name__ == '__main__':
-    s = ScanMotors(sys.argv[1:])
-    s.runScan()
+    args = parseCommandLine(sys.argv[1:])
+    if args['daemon']:
+        runRemoteScan(args)
+    else:
+        s = ScanMotors(args=args)
+        signal.signal(signal.SIGUSR1, lambda *l: s.finishLevel())
+        s.runScan()
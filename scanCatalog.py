@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+"""Find past scans in the scan catalog
+
+Usage:
+    scanCatalog [-m <motor> [-x <position>]] [-c <counter>] [--since <date>] [--until <date>] [-t <text>] [-n <limit>] [-f]
+    scanCatalog show <id>
+    scanCatalog remove <id>
+    scanCatalog -h
+
+Options:
+    -m <motor>, --motor=<motor>
+                        Only scans of this motor
+    -x <position>, --position=<position>
+                        Only scans where the motor covered this position
+    -c <counter>, --counter=<counter>
+                        Only scans with this counter
+    --since <date>      Only scans started at or after this date (YYYY-MM-DD
+                        or YYYY-MM-DD HH:MM:SS)
+    --until <date>      Only scans started before this date
+    -t <text>, --text=<text>
+                        Only scans with this text in the command, comment or
+                        output
+    -n <limit>, --limit=<limit>
+                        Show at most this number of scans [default: 50]
+    -f, --files         List the files of each scan
+    -h, --help          Show this help"""
+
+import json
+import sys
+from datetime import datetime
+
+from scan_utils.catalog import Catalog, catalogPath
+from scan_utils.helpers import docopt, DocoptExit, loadConfiguration, die
+
+def parseDate(text):
+    for fmt in ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%d'):
+        try:
+            return datetime.strptime(text, fmt).timestamp()
+        except ValueError:
+            pass
+
+    raise ValueError('Invalid date: %s' % text)
+
+def formatTime(t):
+    return datetime.fromtimestamp(t).strftime('%Y-%m-%d %H:%M:%S') if t else '-'
+
+def formatScan(scan, files=False):
+    motors = ', '.join('%s [%g, %g]' % (m['motor'], m['low'], m['high'])
+                       for m in scan['motors'])
+    lines = ['%5d  %s  %-11s  %5d points  %s  %s' %
+             (scan['id'], formatTime(scan['start']), scan['status'],
+              scan['points'], motors, scan['output'] or '')]
+
+    if files:
+        lines.extend('       %s' % f for f in scan['files'] or [])
+
+    return '\n'.join(lines)
+
+if __name__ == '__main__':
+    p = docopt(__doc__, sys.argv[1:])
+
+    try:
+        scanId = p['<id>'] and int(p['<id>'])
+        position = p['--position'] and float(p['--position'])
+        since = p['--since'] and parseDate(p['--since'])
+        until = p['--until'] and parseDate(p['--until'])
+        limit = int(p['--limit'])
+    except ValueError:
+        raise DocoptExit()
+
+    try:
+        fileName = catalogPath(loadConfiguration())
+    except (OSError, ValueError) as e:
+        die(e)
+    if fileName is None:
+        die('Scan catalog is disabled in the configuration')
+
+    catalog = Catalog(fileName)
+
+    if p['show']:
+        scan = catalog.get(scanId)
+        if scan is None:
+            die('Scan %d not found' % scanId)
+        print(json.dumps(scan, indent=2, default=str))
+    elif p['remove']:
+        catalog.remove(scanId)
+    else:
+        for scan in catalog.find(p['--motor'], position, p['--counter'], since,
+                                 until, p['--text'], limit):
+            print(formatScan(scan, p['--files']))
@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+"""Long running scan service. Keeps configuration, motors and counters
+connected and runs scan jobs received from a local Unix socket (see
+scan_utils/daemon.py for the client side and scan -d to submit jobs)
+
+Usage:
+    scanDaemon [-s <socket>]
+    scanDaemon -h
+
+Options:
+    -s <socket>, --socket=<socket>
+                        Unix socket path (default: $SCAN_DAEMON_SOCKET or
+                        scan-daemon.sock in the temporary directory)
+    -h, --help          Show this help"""
+
+import os
+import socketserver
+import sys
+import threading
+from contextlib import contextmanager
+
+import py4syn.utils.motor as motorModule
+from scan import ScanMotors
+from scan_utils.daemon import DAEMON_SOCKET, sendMessage, readMessages
+from scan_utils.helpers import docopt, loadConfiguration, readConfiguration,\
+                               createCounters, installSignalHandlers
+
+motorModule.show_info = False
+
+
+class MessageWriter():
+    '''File-like object that forwards text to the client as output messages'''
+    def __init__(self, f):
+        self.f = f
+        self.closed = False
+
+    def write(self, text):
+        if self.closed or not text:
+            return
+
+        # Keep scanning even if the client went away
+        try:
+            sendMessage(self.f, type='output', text=text)
+        except OSError:
+            self.closed = True
+
+    def flush(self):
+        pass
+
+
+class ThreadOutput():
+    '''Replacement for sys.stdout and sys.stderr that writes to the stream
+    set for the current thread, or to the original one. redirect_stdout
+    would replace the stream of every thread, mixing the output of other
+    connections into the output of the running scan'''
+    def __init__(self, default):
+        self.default = default
+        self.local = threading.local()
+
+    @contextmanager
+    def redirect(self, stream):
+        previous = getattr(self.local, 'stream', None)
+        self.local.stream = stream
+        try:
+            yield stream
+        finally:
+            self.local.stream = previous
+
+    def stream(self):
+        return getattr(self.local, 'stream', None) or self.default
+
+    def write(self, text):
+        return self.stream().write(text)
+
+    def flush(self):
+        self.stream().flush()
+
+    def __getattr__(self, name):
+        return getattr(self.default, name)
+
+
+class DaemonScanMotors(ScanMotors):
+    """Scan using the configuration and devices kept by the daemon"""
+    def __init__(self, daemon, args):
+        ScanMotors.__init__(self, args=args)
+        self.daemon = daemon
+
+    def loadConfiguration(self):
+        return self.daemon.getConfiguration(self.args['configuration'])
+
+    def createCounters(self, counters, configuration):
+        return createCounters(counters, configuration, self.output,
+                              cache=self.daemon.devices)
+
+
+class ScanRequestHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        f = self.request.makefile('rw')
+
+        try:
+            for message in readMessages(f):
+                try:
+                    if message['command'] == 'scan':
+                        self.server.runScan(message['args'], f)
+                    else:
+                        self.server.control(message['command'])
+                    sendMessage(f, type='end', status='ok')
+                except (Exception, SystemExit) as e:
+                    sendMessage(f, type='end', status='error', message=str(e))
+
+                # One request per connection
+                break
+        except OSError:
+            pass
+        finally:
+            f.close()
+
+
+class ScanDaemon(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socketPath):
+        # Remove socket left behind by a previous daemon
+        if os.path.exists(socketPath):
+            os.unlink(socketPath)
+
+        super().__init__(socketPath, ScanRequestHandler)
+        self.socketPath = socketPath
+        # Scans share py4syn global state, so only one runs at a time
+        self.scanLock = threading.Lock()
+        self.current = None
+        self.devices = {}
+        # Output of each scan goes to its own client
+        self.stdout = sys.stdout = ThreadOutput(sys.stdout)
+        self.stderr = sys.stderr = ThreadOutput(sys.stderr)
+        self.reload()
+
+    def reload(self):
+        """Reread configuration files. Connected devices are kept"""
+        self.configuration = loadConfiguration()
+        self.counterSets = {}
+
+    def getConfiguration(self, name):
+        if name not in self.counterSets:
+            self.counterSets[name] = readConfiguration('config.' + name + '.yml')
+
+        return self.configuration, self.counterSets[name]
+
+    def runScan(self, args, f):
+        writer = MessageWriter(f)
+
+        if not self.scanLock.acquire(blocking=False):
+            writer.write('Waiting for running scan to finish...\n')
+            self.scanLock.acquire()
+
+        try:
+            with self.stdout.redirect(writer), self.stderr.redirect(writer):
+                self.current = DaemonScanMotors(self, args)
+                self.current.runScan()
+        finally:
+            self.current = None
+            self.scanLock.release()
+
+    def control(self, command):
+        if command == 'ping':
+            return
+        elif command == 'reload':
+            self.reload()
+        elif command == 'shutdown':
+            threading.Thread(target=self.shutdown).start()
+        elif command in ('interrupt', 'pause', 'resume', 'finishLevel'):
+            scan = self.current
+            if scan is not None:
+                getattr(scan, command)()
+        else:
+            raise ValueError('Unknown command: %s' % command)
+
+    def server_close(self):
+        super().server_close()
+        sys.stdout = self.stdout.default
+        sys.stderr = self.stderr.default
+        try:
+            os.unlink(self.socketPath)
+        except OSError:
+            pass
+
+
+if __name__ == '__main__':
+    p = docopt(__doc__, sys.argv[1:])
+    installSignalHandlers()
+
+    daemon = ScanDaemon(p['--socket'] or DAEMON_SOCKET)
+    print('Scan daemon listening on %s' % daemon.socketPath)
+
+    try:
+        daemon.serve_forever()
+    finally:
+        daemon.server_close()
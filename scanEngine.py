@@ -0,0 +1,353 @@
+"""Run a scan in a child process
+
+The scan loop, spectra handling and normalization run in their own process,
+so they don't share the GIL with the GUI event loop. The child sends events
+over a pipe:
+
+    ('output', text)                    printed text and data lines
+    ('point', index, values)            scalar values of a point, by name
+    ('fit', natural, counter, values)   fitted XRF amounts of a point (index
+                                        in logical order), by element
+    ('array', index, name, slot, size)  array value (spectrum) of a point,
+                                        stored in shared memory
+    ('array-data', index, name, values) array value too long for a shared
+                                        memory slot, sent through the pipe
+    ('end', status, message)            scan finished, status is ok or error
+
+ScanEngine.messages() returns array events already copied out of shared
+memory (or sent through the pipe), as ('array', index, name, values). Arrays
+are dropped, and counted at the end of the scan, when every shared memory slot
+is in use. Commands (interrupt, pause,
+resume and finishLevel) are sent to the child over a second pipe. Events are
+sent from their own threads through bounded queues, so a parent that stops
+reading makes events be dropped instead of stalling the scan.
+
+With target=replayMain, the engine replays a recorded scan (see
+scan_utils/replay.py) instead, sending the same events, so the GUI and other
+consumers can be tested and measured without beam.
+
+ScanExecutor runs several independent scans at the same time, each one in
+its own engine, so each has its own py4syn state (motors, counters and scan
+data). Scans using the same device wait for each other (see
+scan_utils/locks.py)."""
+
+import multiprocessing
+import queue
+import threading
+from contextlib import redirect_stdout, redirect_stderr
+from datetime import datetime
+
+import numpy
+
+from py4syn.utils.scan import scanDataToLine, scanHeader, setPlotGraph
+from scan import ScanMotors
+from scan_utils.events import EventBus, Subscription, PointEvent, FitEvent
+from scan_utils.replay import Replay, ReplayWriters, readRecording
+from scan_utils.shared import SharedSlots, SLOTS, MAX_LENGTH
+
+# Point events waiting to be sent to the parent, older ones are dropped
+POINT_QUEUE = 1000
+# Output events of the scan thread waiting to be sent, older ones are dropped
+OUTPUT_QUEUE = 10000
+
+
+class PipeWriter():
+    '''File-like object that sends text to the parent as output events'''
+    def __init__(self, send):
+        self.send = send
+
+    def write(self, text):
+        if text:
+            self.send('output', text)
+
+    def flush(self):
+        pass
+
+
+class EngineScanMotors(ScanMotors):
+    """Scan that reports its progress to the parent process"""
+    def __init__(self, args, send, arrays):
+        ScanMotors.__init__(self, args=args)
+        self.send = send
+        self.arrays = arrays
+        setPlotGraph(False)
+
+    def preScanCallback(self, counters, rows, cols, **kwargs):
+        self.send('output', "Start time: %s \n" % (str(datetime.now())))
+        self.send('output', scanHeader() + "\n")
+        ScanMotors.preScanCallback(self, counters, rows, cols, **kwargs)
+
+    def postPointCallback(self, countersConf, counters, configuration, constants, **kwargs):
+        self.send('output', scanDataToLine(format="4") + "\n")
+        ScanMotors.postPointCallback(self, countersConf, counters,
+                                     configuration, constants, **kwargs)
+
+    def postScanCallback(self, counters, **kwargs):
+        self.send('output', "End time: %s \n" % (str(datetime.now())))
+        ScanMotors.postScanCallback(self, counters, **kwargs)
+
+
+def listen(scan, commands):
+    """Run commands from the parent. Interrupt the scan if the parent goes
+    away"""
+    while True:
+        try:
+            command = commands.recv()
+        except (EOFError, OSError):
+            scan.interrupt()
+            return
+
+        if command in ('interrupt', 'pause', 'resume', 'finishLevel') and \
+           hasattr(scan, command):
+            getattr(scan, command)()
+
+
+def forward(subscription, send, arrays):
+    """Send point events to the parent. Runs in its own thread, so a slow
+    parent only makes events be dropped from the subscription queue"""
+    for event in subscription:
+        if isinstance(event, FitEvent):
+            send('fit', event.natural, event.counter, event.values)
+        if not isinstance(event, PointEvent):
+            continue
+
+        for name, value in event.arrays.items():
+            if numpy.size(value) > arrays.length:
+                send('array-data', event.index, name,
+                     numpy.asarray(value, dtype=float).ravel())
+                continue
+
+            stored = arrays.write(value)
+            if stored is not None:
+                send('array', event.index, name, stored[0], stored[1])
+
+        values = dict(event.positions)
+        values.update(event.values)
+        send('point', event.index, values)
+
+
+def sendQueued(outbox, send):
+    """Send the queued events. Runs in its own thread, so the scan thread
+    never waits for the parent to read the pipe"""
+    for event in outbox:
+        send(*event)
+
+
+def reportDroppedArrays(arrays, send):
+    if arrays.dropped:
+        send('output', '%d arrays dropped, every shared memory slot was in use\n'
+             % arrays.dropped)
+
+
+def engineMain(args, events, commands, arrays):
+    lock = threading.Lock()
+
+    def send(*event):
+        with lock:
+            events.send(event)
+
+    outbox = Subscription(OUTPUT_QUEUE)
+    post = lambda *event: outbox.put(event)
+    sender = threading.Thread(target=sendQueued, args=(outbox, send))
+    sender.start()
+
+    scan = EngineScanMotors(args, post, arrays)
+    threading.Thread(target=listen, args=(scan, commands), daemon=True).start()
+    forwarder = threading.Thread(target=forward,
+                                 args=(scan.events.subscribe(POINT_QUEUE),
+                                       send, arrays))
+    forwarder.start()
+
+    writer = PipeWriter(post)
+    try:
+        with redirect_stdout(writer), redirect_stderr(writer):
+            scan.runScan()
+        status, message = 'ok', None
+    except (Exception, SystemExit) as e:
+        status, message = 'error', str(e)
+    finally:
+        scan.events.close()
+        forwarder.join()
+        outbox.close()
+        sender.join()
+
+    if outbox.dropped:
+        send('output', '%d output messages dropped, the parent was too slow\n'
+             % outbox.dropped)
+    reportDroppedArrays(arrays, send)
+    send('end', status, message)
+    events.close()
+
+
+def printPoints(subscription, send):
+    """Send the values of each point as an output line"""
+    names = None
+
+    for event in subscription:
+        if not isinstance(event, PointEvent):
+            continue
+
+        values = dict(event.positions)
+        values.update(event.values)
+        if names is None:
+            names = list(values)
+            send('output', '# %s\n' % '\t'.join(names))
+        send('output', '\t'.join(str(values.get(n, '')) for n in names) + '\n')
+
+
+def writeOutputs(bus, subscription, writers, send):
+    """Write the outputs of replayed points"""
+    try:
+        writers.write(subscription)
+    except Exception as e:
+        # Don't hold up the replay
+        bus.unsubscribe(subscription)
+        send('output', 'Writing outputs failed: %s\n' % e)
+
+
+def replayMain(args, events, commands, arrays):
+    """Replay the recording args['replay'] at args['speed'] (0 for as fast
+    as possible), sending the same events as engineMain. With args['output'],
+    the ROI, spectra and XRF outputs are written again with that prefix"""
+    lock = threading.Lock()
+
+    def send(*event):
+        with lock:
+            events.send(event)
+
+    bus = EventBus()
+    points = bus.subscribe(POINT_QUEUE)
+    consumers = [threading.Thread(target=forward, args=(points, send, arrays)),
+                 threading.Thread(target=printPoints,
+                                  args=(bus.subscribe(POINT_QUEUE), send))]
+    for c in consumers:
+        c.start()
+
+    replay = None
+    try:
+        header, recorded = readRecording(args['replay'])
+        if args.get('output'):
+            # Writers get every point, like in the scan
+            writers = ReplayWriters(header, args['output'])
+            subscription = bus.subscribe(POINT_QUEUE, 'block', blockTimeout=60)
+            consumers.append(threading.Thread(target=writeOutputs,
+                                              args=(bus, subscription, writers,
+                                                    send)))
+            consumers[-1].start()
+        replay = Replay(recorded, bus, args.get('speed', 1.0))
+        threading.Thread(target=listen, args=(replay, commands),
+                         daemon=True).start()
+        replay.run()
+        status, message = 'ok', None
+    except (Exception, KeyboardInterrupt) as e:
+        status, message = 'error', str(e)
+    finally:
+        bus.close()
+        for c in consumers:
+            c.join()
+
+    if replay is not None:
+        send('output', '%s, %d points dropped\n' % (replay.summary(),
+                                                   points.dropped))
+    reportDroppedArrays(arrays, send)
+    send('end', status, message)
+    events.close()
+
+
+class ScanEngine():
+    '''Parent side of a scan running in a child process'''
+    def __init__(self, args, slots=SLOTS, length=MAX_LENGTH, target=engineMain):
+        # Don't fork the GUI process (Qt and Channel Access threads)
+        context = multiprocessing.get_context('spawn')
+
+        self.arrays = SharedSlots(slots, length, context)
+        self.events, childEvents = context.Pipe(duplex=False)
+        childCommands, self.commands = context.Pipe(duplex=False)
+        self.process = context.Process(target=target,
+                                       args=(args, childEvents, childCommands,
+                                             self.arrays),
+                                       daemon=True)
+        self.childEnds = (childEvents, childCommands)
+
+    def start(self):
+        self.process.start()
+
+        # Only the child keeps these ends, so EOF is seen when it exits
+        for c in self.childEnds:
+            c.close()
+
+    def messages(self):
+        """Yield events until the scan ends"""
+        try:
+            while True:
+                try:
+                    event = self.events.recv()
+                except (EOFError, OSError):
+                    yield ('end', 'error', 'Scan engine exited unexpectedly')
+                    return
+
+                if event[0] == 'array':
+                    _, index, name, slot, size = event
+                    yield ('array', index, name, self.arrays.read(slot, size))
+                elif event[0] == 'array-data':
+                    yield ('array',) + event[1:]
+                else:
+                    yield event
+                    if event[0] == 'end':
+                        return
+        finally:
+            self.process.join()
+            self.events.close()
+            self.commands.close()
+
+    def sendCommand(self, command):
+        try:
+            self.commands.send(command)
+        except (OSError, ValueError):
+            # Engine already finished
+            pass
+
+
+class ScanExecutor():
+    '''Run independent scans concurrently, each in its own ScanEngine'''
+    def __init__(self):
+        self.engines = {}
+        self.queue = queue.Queue()
+        self.running = set()
+        self.nextId = 1
+
+    def submit(self, args):
+        """Start a scan and return its id"""
+        scanId = self.nextId
+        self.nextId += 1
+
+        engine = ScanEngine(args)
+        engine.start()
+        self.engines[scanId] = engine
+        self.running.add(scanId)
+        threading.Thread(target=self.read, args=(scanId, engine),
+                         daemon=True).start()
+
+        return scanId
+
+    def read(self, scanId, engine):
+        for event in engine.messages():
+            self.queue.put((scanId, event))
+
+    def messages(self):
+        """Yield (scan id, event) until every submitted scan ends"""
+        while self.running:
+            scanId, event = self.queue.get()
+            if event[0] == 'end':
+                self.running.discard(scanId)
+                del self.engines[scanId]
+            yield scanId, event
+
+    def sendCommand(self, scanId, command):
+        engine = self.engines.get(scanId)
+        if engine is not None:
+            engine.sendCommand(command)
+
+    def sendAll(self, command):
+        for engine in list(self.engines.values()):
+            engine.sendCommand(command)
@@ -1,5 +1,11 @@
 #!/usr/bin/env python3
-"""An interface for scan on pyqt """
+"""An interface for scan on pyqt
+
+Usage:
+    scanGui.py [--replay <recording>]
+
+With --replay, a scan recorded with scan --record is replayed through the
+scan engine and shown in the window, as a scan would be."""
 import sys
 import os
 import time
@@ -7,16 +13,24 @@ from datetime import datetime, timedelta
 from glob import glob
 
 from gui.window import Ui_MainWindow
-from scan import ScanMotors
+from scanEngine import ScanEngine, engineMain, replayMain
 
 from PyQt5 import QtWidgets
-from PyQt5.QtCore import QThread, QObject, pyqtSlot, pyqtSignal
+import numpy
+from PyQt5.QtCore import QThread, QObject, pyqtSlot, pyqtSignal, Qt, \
+                         QAbstractTableModel, QModelIndex
 from PyQt5.QtWidgets import QMessageBox
-from PyQt5.QtGui import QTextCursor
-from py4syn.utils.scan import scanDataToLine, scanHeader, setPlotGraph, getScanData
+from PyQt5.QtGui import QTextCursor, QFont
 from PyQtArgs.qtArgs import qtArgs
+from scan_utils.runs import FIELDS, HEADERS, emptyRuns, parseValue, \
+                            formatValue, validateValue, runsFromRows, \
+                            runsToRows, loadRunsCsv, isComplete, runTimes
+from scan_utils.daemon import submitScan, sendCommand, isDaemonRunning,\
+                              DaemonError
 
 SCAN_UTILS = "/usr/local/scripts/scan-utils/*.*.yml"
+# run shown when the window opens
+DEFAULT_RUN = ['1', '2', '0.5', '1', '2', '0.5', '500']
 FACTOR_TIME = 10
 # dictionary with the time of pauses
 PAUSES = {'p1': {'H': 8, 'M':0}, 'p2': {'H': 19, 'M': 0}}
@@ -42,82 +56,200 @@ def checkPauseTime(pauses, secsToEnd):
     return False
 
 
-class ScanMotorsT(ScanMotors, QThread):
-    """A thread for scan motors
-    This class encapsulate scan in a thread and include functions
-    to work with a GUI"""
+def secondsToEnd(args):
+    """How many seconds before beam end the scan is paused"""
+    time = args['time']
+    # for cases with only 1 motor
+    if time is None:
+        time = args['acquisitionTime'][0]
+
+    if time < 60*MINUTESTOEND:
+        return 60*MINUTESTOEND
+    else:
+        return time*1.1
+
+
+class ProcessScanT(QThread):
+    """A thread that runs the scan engine in a child process
+    (see scanEngine.py) and forwards its events to the GUI, so acquisition
+    and the Qt event loop don't share the GIL"""
     writeSignal = pyqtSignal(str)
     blEndSignal = pyqtSignal()
-
-    def __init__(self, arg, writeSlot, blEndSlot):
-        """ 
-        writeSlot: slot to write messages
-        blEndSLot: slot to run beamline end
-        """
-        ScanMotors.__init__(self, args = arg)
+    # point index and scalar values by name
+    pointSignal = pyqtSignal(int, dict)
+    # point index, counter name and array (spectrum)
+    arraySignal = pyqtSignal(int, str, object)
+    # point index in logical order, counter name and XRF amounts by element
+    fitSignal = pyqtSignal(int, str, dict)
+
+    def __init__(self, arg, writeSlot, blEndSlot, target=engineMain):
         QThread.__init__(self)
+        self.engine = ScanEngine(arg, target=target)
         self.writeSignal.connect(writeSlot)
         self.blEndSignal.connect(blEndSlot)
-        setPlotGraph(False)
+        self.paused = False
+        # Replays don't pause for the beam
+        self.secsToEnd = secondsToEnd(arg) if target is engineMain else None
 
-        # for cases with only 1 motor
-        if self.time is None:
-            self.time = self.acquisitionTime[0] 
-        
+    def run(self):
+        self.engine.start()
+
+        for event in self.engine.messages():
+            if event[0] == 'output':
+                self.writeSignal.emit(event[1])
+            elif event[0] == 'point':
+                self.pointSignal.emit(event[1], event[2])
+                self.checkPause()
+            elif event[0] == 'array':
+                self.arraySignal.emit(event[1], event[2], event[3])
+            elif event[0] == 'fit':
+                self.fitSignal.emit(event[1], event[2], event[3])
+            elif event[0] == 'end' and event[1] != 'ok':
+                self.writeSignal.emit("Scan failed: %s \n" % event[2])
+
+    def checkPause(self):
+        """Verify if is next to pause time"""
+        if self.secsToEnd is None:
+            return
+        if not self.paused and checkPauseTime(PAUSES, self.secsToEnd):
+            self.pause()
+            # emit signal to send beam stop message
+            self.blEndSignal.emit()
 
-        if self.time < 60*MINUTESTOEND:
-            self.secsToEnd = 60*MINUTESTOEND
-        else:
-            self.secsToEnd = self.time*1.1
+    def interrupt(self):
+        self.engine.sendCommand('interrupt')
 
-    def run(self):
-        ScanMotors.runScan(self)
+    def pause(self):
+        self.paused = True
+        self.engine.sendCommand('pause')
 
-    def preScanCallback(self, counters, rows, cols, **kwargs):
-        self.writeSignal.emit("Start time: %s \n" % (str(datetime.now())) )
-        self.writeSignal.emit(scanHeader()+ "\n")
-        ScanMotors.preScanCallback(self, counters, rows, cols, **kwargs)
+    def resume(self):
+        self.paused = False
+        self.engine.sendCommand('resume')
 
-    def prePointCallback(self, **kwargs):
-        """Verify if is next to pause time"""
-        scanData = self._getScanData()
-        #if is running
-        if scanData is not None:
-            if checkPauseTime(PAUSES,self.secsToEnd):
-                self.pause()
-                # emit signal to send beam stop message
-                self.blEndSignal.emit()
-
-    def postPointCallback(self, countersConf, counters, configuration, constants, **kwargs):
-        self.writeSignal.emit(scanDataToLine(format="4") + "\n")
-        ScanMotors.postPointCallback(self, countersConf, counters, configuration, constants, **kwargs)
-
-    def postScanCallback(self, counters, **kwargs):
-        self.writeSignal.emit("End time: %s \n" % ( str(datetime.now())) )
-        ScanMotors.postScanCallback(self, counters, **kwargs)
-
-    def _getScanData(self):
-        s = getScanData()
-        if s is not None:
-            return s['scan_object']
-        else:
-            return None
 
-    #TODO: implement a better way interrupt, pause and resume
+class DaemonScanT(QThread):
+    """A thread that submits the scan to the scan daemon
+    Same interface as ProcessScanT, but the scan runs on the daemon process
+    and only its output is received here"""
+    writeSignal = pyqtSignal(str)
+    blEndSignal = pyqtSignal()
+
+    def __init__(self, arg, writeSlot, blEndSlot):
+        QThread.__init__(self)
+        self.args = arg
+        self.writeSignal.connect(writeSlot)
+        self.blEndSignal.connect(blEndSlot)
+        self.paused = False
+        self.secsToEnd = secondsToEnd(arg)
+
+    def run(self):
+        try:
+            result = submitScan(self.args, output=self.received)
+        except (OSError, DaemonError) as e:
+            self.writeSignal.emit("Scan daemon error: %s \n" % e)
+            return
+
+        if result['status'] != 'ok':
+            self.writeSignal.emit("Scan failed: %s \n" % result.get('message'))
+
+    def received(self, text):
+        """Forward daemon output and verify if is next to pause time"""
+        self.writeSignal.emit(text)
+        if not self.paused and checkPauseTime(PAUSES, self.secsToEnd):
+            self.pause()
+            # emit signal to send beam stop message
+            self.blEndSignal.emit()
+
     def interrupt(self):
-        scanData = self._getScanData()
-        if scanData is not None:
-            scanData.interrupt()
+        sendCommand('interrupt')
 
     def pause(self):
-        scanData = self._getScanData()
-        if scanData is not None:
-            scanData.pause()
+        self.paused = True
+        sendCommand('pause')
 
     def resume(self):
-        scanData = self._getScanData()
-        if scanData is not None:
-            scanData.resume()
+        self.paused = False
+        sendCommand('resume')
+
+
+class RunTableModel(QAbstractTableModel):
+    """Run table backed by a record array (see scan_utils/runs.py)
+    Values are validated on entry and editing a cell only touches its run"""
+    errorSignal = pyqtSignal(str)
+
+    def __init__(self, runs=None):
+        super().__init__()
+        self.runs = runs if runs is not None else emptyRuns(0)
+        self.headerFont = QFont()
+        self.headerFont.setPointSize(8)
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.runs)
+
+    def columnCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(FIELDS)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if role in (Qt.DisplayRole, Qt.EditRole):
+            return formatValue(self.runs[FIELDS[index.column()]][index.row()])
+
+        return None
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if orientation == Qt.Horizontal:
+            if role == Qt.DisplayRole:
+                return HEADERS[section]
+            if role == Qt.FontRole:
+                return self.headerFont
+        elif role == Qt.DisplayRole:
+            return str(section + 1)
+
+        return None
+
+    def flags(self, index):
+        return Qt.ItemIsEnabled | Qt.ItemIsSelectable | Qt.ItemIsEditable
+
+    def setData(self, index, value, role=Qt.EditRole):
+        if role != Qt.EditRole:
+            return False
+
+        field = FIELDS[index.column()]
+        try:
+            v = parseValue(value)
+        except ValueError:
+            self.errorSignal.emit('Invalid number: %s' % value)
+            return False
+
+        error = validateValue(field, v)
+        if error is not None:
+            self.errorSignal.emit(error)
+            return False
+
+        self.runs[field][index.row()] = v
+        self.dataChanged.emit(index, index)
+        return True
+
+    def appendRuns(self, runs):
+        if len(runs) == 0:
+            return
+
+        first = len(self.runs)
+        self.beginInsertRows(QModelIndex(), first, first + len(runs) - 1)
+        self.runs = numpy.concatenate((self.runs, runs))
+        self.endInsertRows()
+
+    def setRuns(self, runs):
+        self.beginResetModel()
+        self.runs = runs
+        self.endResetModel()
+
+    # Used by qtArgs to save and load the table
+    def toList(self):
+        return runsToRows(self.runs)
+
+    def fromList(self, rows):
+        self.setRuns(runsFromRows(rows))
 
 
 class ScanGui(QObject):
@@ -136,9 +268,17 @@ class ScanGui(QObject):
         self.ui.btnPath.released.connect(self.chooseDir)
         self.ui.btnSave.released.connect(self.saveArgs)
         self.ui.btnLoad.released.connect(self.loadArgs)
-        self.ui.twRuns.cellChanged.connect(self.timeExpected)
+        self.ui.btnImport.released.connect(self.importRuns)
         self.ui.cmbMotor2.currentIndexChanged.connect(self.timeExpected)
 
+        # run table
+        self.runs = RunTableModel(runsFromRows([DEFAULT_RUN]))
+        self.ui.twRuns.setModel(self.runs)
+        self.runs.errorSignal.connect(self.invalidValue)
+        self.runs.dataChanged.connect(self.timeExpected)
+        self.runs.rowsInserted.connect(self.timeExpected)
+        self.runs.modelReset.connect(self.timeExpected)
+
         self.sc = None
 
         # list all counters
@@ -157,6 +297,24 @@ class ScanGui(QObject):
         self.timeExpected()
 
 
+    def createScan(self):
+        """Use the scan daemon when it is running, otherwise scan in a child
+        process"""
+        if isDaemonRunning():
+            return DaemonScanT(self.arguments, self.appendText, self.beamlineEnd)
+        else:
+            return ProcessScanT(self.arguments, self.appendText, self.beamlineEnd)
+
+    def replay(self, fileName, speed=1.0):
+        """Replay a recorded scan through the scan engine"""
+        self.nextRun = 0
+        self.ui.tbOutput.clear()
+        self.toggleStartStop()
+        self.sc = ProcessScanT({'replay': fileName, 'speed': speed},
+                               self.appendText, self.beamlineEnd, replayMain)
+        self.sc.start()
+        self.sc.finished.connect(self.finish)
+
     def callScan(self):
         """Call scan script"""
 
@@ -179,68 +337,39 @@ class ScanGui(QObject):
 
                 row = self.nextRun
 
-                try:
-                    # only 1 motor
-                    if self.ui.cmbMotor2.currentText() == "" :
-                        m1Init = self.ui.twRuns.item(row, 0).text()
-                        m1End = self.ui.twRuns.item(row, 1).text()
-                        m1Step = self.ui.twRuns.item(row, 2).text()
-                        cntTime = self.ui.twRuns.item(row, 6).text()
-
-                        # verify if all fields has data
-                        if (m1Init != "" and m1End != "" and m1Step and
-                           cntTime != ""):
-                            #TODO: fix to use 1 motor
-                            self.arguments['initial'] = [float(m1Init)]
-                            self.arguments['final'] = [float(m1End)]
-                            self.arguments['stepOrCount'] = [float(m1Step)]
-                            self.arguments['acquisitionTime'] = [float(cntTime)/1000] # in seconds
-                            self.arguments['motor'] = self.ui.cmbMotor1.currentText()
-
-                            self.ui.tbOutput.append("===== Run %d ===== \n" %
-                                                    (self.nextRun + 1))
-
-
-                            self.sc = ScanMotorsT(self.arguments, self.appendText,self.beamlineEnd)
-                            self.sc.start()
-                            self.sc.finished.connect(self.finish)
+                run = self.runs.runs[row]
+                twoMotors = self.ui.cmbMotor2.currentText() != ""
 
+                # verify if all fields has data
+                if isComplete(self.runs.runs[row:row+1], twoMotors)[0]:
+                    # only 1 motor
+                    if not twoMotors:
+                        #TODO: fix to use 1 motor
+                        self.arguments['initial'] = [float(run['initial1'])]
+                        self.arguments['final'] = [float(run['final1'])]
+                        self.arguments['stepOrCount'] = [float(run['step1'])]
+                        self.arguments['acquisitionTime'] = [float(run['time'])/1000] # in seconds
+                        self.arguments['motor'] = self.ui.cmbMotor1.currentText()
                     else:
-                        m1Init = self.ui.twRuns.item(row, 0).text()
-                        m1End = self.ui.twRuns.item(row, 1).text()
-                        m1Step = self.ui.twRuns.item(row, 2).text()
-                        m2Init = self.ui.twRuns.item(row, 3).text()
-                        m2End = self.ui.twRuns.item(row, 4).text()
-                        m2Step = self.ui.twRuns.item(row, 5).text()
-                        cntTime = self.ui.twRuns.item(row, 6).text()
-
-                        # verify if all fields has data
-                        if (m1Init != "" and m1End != "" and m1Step != "" and
-                           m2Init != "" and m2End != "" and m2Step != "" and
-                           cntTime != ""):
-                            #TODO: fix to use 1 motor
-                            self.arguments['initial'] = [float(m1Init), float(m2Init)]
-                            self.arguments['final'] = [float(m1End), float(m2End)]
-                            self.arguments['steps'] = [float(m1Step),float(m2Step)]
-                            self.arguments['time'] = float(cntTime)/1000 # in seconds
-
-                            self.arguments['motor'] = [self.ui.cmbMotor1.currentText(),self.ui.cmbMotor2.currentText()]
-
-                            self.ui.tbOutput.append("===== Run %d ===== \n" %
-                                                    (self.nextRun + 1))
-
-
-                            self.sc = ScanMotorsT(self.arguments, self.appendText, self.beamlineEnd)
-                            self.sc.start()
-                            self.sc.finished.connect(self.finish)
-
-                except AttributeError:
+                        self.arguments['initial'] = [float(run['initial1']), float(run['initial2'])]
+                        self.arguments['final'] = [float(run['final1']), float(run['final2'])]
+                        self.arguments['steps'] = [float(run['step1']), float(run['step2'])]
+                        self.arguments['time'] = float(run['time'])/1000 # in seconds
+
+                        self.arguments['motor'] = [self.ui.cmbMotor1.currentText(),self.ui.cmbMotor2.currentText()]
+
+                    self.ui.tbOutput.append("===== Run %d ===== \n" %
+                                            (self.nextRun + 1))
+
+                    self.sc = self.createScan()
+                    self.sc.start()
+                    self.sc.finished.connect(self.finish)
+                else:
                     # when some field is empty
                     self.toggleStartStop()
-                    pass
 
                 # there are more runs increase nextRow, else it receives 0
-                if self.ui.twRuns.rowCount() > row + 1:
+                if self.runs.rowCount() > row + 1:
                     self.nextRun += 1
                 else:
                     self.nextRun = 0
@@ -304,8 +433,24 @@ class ScanGui(QObject):
     @pyqtSlot()
     def addLine(self):
         """Add a line to the runs """
-        rows = self.ui.twRuns.rowCount()
-        self.ui.twRuns.setRowCount(rows + 1)
+        self.runs.appendRuns(emptyRuns(1))
+
+    @pyqtSlot()
+    def importRuns(self):
+        """Append runs from a CSV file, with the same columns as the table"""
+        filename = QtWidgets.QFileDialog.getOpenFileName(
+            ui.btnImport, 'Choose a CSV file to import', '',
+            'CSV files (*.csv);;All files (*)')[0]
+
+        if filename != '':
+            try:
+                self.runs.appendRuns(loadRunsCsv(filename))
+            except (OSError, ValueError) as e:
+                self.showDialog("Import Error", str(e))
+
+    @pyqtSlot(str)
+    def invalidValue(self, text):
+        self.showDialog("Invalid Value", text)
 
     @pyqtSlot()
     def chooseDir(self):
@@ -333,7 +478,7 @@ class ScanGui(QObject):
             pqa.saveArg('cmbMotor2', self.ui.cmbMotor2.currentIndex(),
                         'currentIndex', 'setCurrentIndex')
 
-            # save QTableWidget data
+            # save run table data
             pqa.saveArg('twRuns', qtw=True)
 
             # store on file
@@ -347,39 +492,18 @@ class ScanGui(QObject):
 
         if filename != '':
             pqa = qtArgs(self.ui)
-            pqa.loadArgs(filename)
+            try:
+                pqa.loadArgs(filename)
+            except (OSError, ValueError) as e:
+                self.showDialog("Load Error", str(e))
 
     @pyqtSlot()
     def timeExpected(self):
-        '''Calculate time expected'''
-        try:
-            totalTime = 0
-
-            for row in range(0, self.ui.twRuns.rowCount()):
-                cntTime = int(self.ui.twRuns.item(row, 6).text())
-                initial = float(self.ui.twRuns.item(row, 0).text())
-                final = float(self.ui.twRuns.item(row, 1).text())
-                stepSize = float(self.ui.twRuns.item(row, 2).text())
-                # only 1 motor
-                if self.ui.cmbMotor2.currentText() == "":
-                    lines = 1
-                # 2 motors 
-                else:
-                    initialSM = float(self.ui.twRuns.item(row, 3).text())
-                    finalSM = float(self.ui.twRuns.item(row, 4).text())
-                    stepSM = float(self.ui.twRuns.item(row, 5).text())
-                    lines = round(abs((finalSM - initialSM)/stepSM)) + 1
-
-                points = round(abs((final - initial)/stepSize)) + 1
-                movTime = float((cntTime + FACTOR_TIME) / 1000)
-                totalTime += movTime*points*lines
-
-            self.ui.lblEstTime.setText(str(timedelta(seconds=int(totalTime))))
-        except ValueError:
-            self.ui.lblEstTime.setText("Invalid value")
-        except AttributeError:
-            # when some item is empty, just show totalTime
-            self.ui.lblEstTime.setText(str(timedelta(seconds=int(totalTime))))
+        '''Calculate time expected, incomplete runs are not included'''
+        times = runTimes(self.runs.runs, self.ui.cmbMotor2.currentText() != "",
+                         FACTOR_TIME)
+        totalTime = numpy.nansum(times)
+        self.ui.lblEstTime.setText(str(timedelta(seconds=int(totalTime))))
 
     @pyqtSlot()
     def beamlineEnd(self):
@@ -396,6 +520,8 @@ if __name__ == "__main__":
     MainWindow.show()
 
     sg = ScanGui(ui)
+    if len(sys.argv) == 3 and sys.argv[1] == '--replay':
+        sg.replay(sys.argv[2])
 
     sys.exit(app.exec_())
 #a = scanMotorsT()
@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+"""Monitor counters at a fixed rate, without moving any motor. Replaces time
+scans done with a null motor for beam stability and temperature logging
+
+Usage:
+    scanMonitor [-c <config>] [-r <rate>] [-n <samples> | -t <duration>] [-o <fileprefix>] [-b <seconds>] [-d <deadband>] [--buffer <n>]
+    scanMonitor -h
+
+Options:
+    -c <config>, --configuration=<config>
+                        Choose a counter configuration file [default: default]
+    -r <rate>, --rate=<rate>
+                        Samples per second [default: 10]
+    -n <samples>, --samples=<samples>
+                        Stop after this number of samples
+    -t <duration>, --duration=<duration>
+                        Stop after this number of seconds
+    -o <fileprefix>, --output=<fileprefix>
+                        Output data to file output-prefix/<fileprefix>.txt
+                        [default: monitor]
+    -b <seconds>, --batch=<seconds>
+                        Write samples to the file every this number of seconds
+                        [default: 1]
+    -d <deadband>, --deadband=<deadband>
+                        Only store samples where some counter changed more
+                        than this value (counters may set their own with the
+                        deadband configuration key)
+    --buffer <n>        Number of samples kept in memory between writes
+                        [default: 100000]
+    -h, --help          Show this help
+
+Counters are read without starting a count, so they should be continuously
+updated (pv counters, temperatures, scalers in auto count mode). Stop with
+Ctrl+C."""
+
+import sys
+from os import path
+
+from py4syn import counterDB
+from scan_utils.helpers import docopt, DocoptExit, loadConfiguration, \
+                               readConfiguration, createCounters, die, \
+                               installSignalHandlers
+from scan_utils.monitor import Monitor
+from scan_utils.readout import Readout
+
+def deadbands(names, configuration, default):
+    """Deadband of each counter, None if no deadband is used"""
+    values = [configuration['counters'][n].get('deadband', default)
+              for n in names]
+
+    if all(v is None for v in values):
+        return None
+
+    return [float(v) if v is not None else 0.0 for v in values]
+
+if __name__ == '__main__':
+    p = docopt(__doc__, sys.argv[1:])
+
+    try:
+        rate = float(p['--rate'])
+        limit = p['--samples'] and int(p['--samples'])
+        duration = p['--duration'] and float(p['--duration'])
+        batch = float(p['--batch'])
+        deadband = p['--deadband'] and float(p['--deadband'])
+        capacity = int(p['--buffer'])
+        if rate <= 0:
+            raise ValueError()
+    except ValueError:
+        raise DocoptExit()
+
+    try:
+        configuration = loadConfiguration()
+        counters = readConfiguration('config.' + p['--configuration'] + '.yml')
+        createCounters(counters, configuration)
+    except (OSError, ValueError) as e:
+        die(e)
+
+    names = [n for n in counters if n in counterDB]
+    readout = Readout(dict((n, counterDB[n]) for n in names))
+    fileName = path.join(configuration['misc'].get('output-prefix') or '',
+                         p['--output'] + '.txt')
+
+    installSignalHandlers()
+    with open(fileName, 'w') as f:
+        monitor = Monitor(readout, names, rate, f,
+                          deadbands(names, configuration, deadband), batch,
+                          capacity)
+        print('Monitoring %s at %g Hz to %s' % (', '.join(names), rate, fileName))
+
+        try:
+            monitor.run(limit, duration)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            readout.close()
+
+    print('%d samples taken, %d stored, %d late, %d lost' %
+          (monitor.samples, monitor.stored, monitor.late, monitor.ring.overruns))
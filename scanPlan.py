@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+"""Run a list of scans from a plan file. Trajectories of all scans are
+validated against motor soft limits and the total time is estimated before
+anything is moved
+
+Usage:
+    scanPlan [-n | -p] [-c <config>] <plan>
+    scanPlan -h
+
+Options:
+    -n, --dry-run       Only validate the plan and show the estimated time
+    -p, --parallel      Run all scans at the same time, each in its own
+                        process. Scans sharing a motor or detector wait for
+                        each other
+    -c <config>, --configuration=<config>
+                        Counter configuration for scans that don't choose one
+                        [default: default]
+    -h, --help          Show this help
+
+A plan file is a YAML list of scans. Each entry is either a string with the
+arguments of the scan command, for example:
+
+    - -a sh2x 0 1 10 1
+    - -x -a --time 0.5 sh2x 0 1 0.1 sh2y 0 1 0.1
+
+or a mapping with the same keys produced by scan.parseCommandLine, for
+example:
+
+    - motor: sh2x
+      initial: [0]
+      final: [1]
+      stepOrCount: [10]
+      acquisitionTime: [1]
+      output: run1"""
+
+import shlex
+import sys
+from datetime import timedelta
+
+import numpy
+import yaml
+
+import py4syn.utils.motor as motorModule
+from py4syn import mtrDB
+from py4syn.utils.motor import wmr
+from scan import ScanMotors, parseCommandLine
+from scanEngine import ScanExecutor
+from scan_utils.helpers import docopt, loadConfiguration, die
+from scan_utils.plan import motorLimits, motorVelocity, validateLimits,\
+                            estimateTime
+
+motorModule.show_info = False
+
+DEFAULT_ARGS = {'motor': None, 'initial': [], 'final': [], 'stepOrCount': [],
+                'steps': [], 'acquisitionTime': [], 'relative': None,
+                'sync': False, 'output': None, 'sleep': 0.0, 'message': None,
+                'optimum': None, 'time': 1.0, 'count': 1,
+                'configuration': 'default'}
+
+def loadPlan(fileName, defaultConfiguration='default'):
+    with open(fileName) as f:
+        plan = yaml.load(f)
+
+    if not isinstance(plan, list):
+        raise ValueError('Plan file must contain a list of scans')
+
+    scans = []
+    for entry in plan:
+        if isinstance(entry, str):
+            args = parseCommandLine(shlex.split(entry))
+            if args['--configuration'] == 'default':
+                args['configuration'] = defaultConfiguration
+        else:
+            args = dict(DEFAULT_ARGS, configuration=defaultConfiguration)
+            args.update(entry)
+            if isinstance(args['motor'], str):
+                args['motor'] = [args['motor']]
+
+        scans.append(ScanMotors(args=args))
+
+    return scans
+
+# Create motors and generate the absolute trajectory of every scan. Returns
+# the list of (scan index, motor, positions) and the estimated time of each scan
+def expandPlan(scans, configuration):
+    trajectories = []
+    estimates = []
+
+    for i, s in enumerate(scans):
+        if len(s.motor) == 1:
+            s.motor = s.motor[0]
+
+        s.createMotors(configuration)
+        points, times, rows, cols = s.generateTrajectory(configuration)
+
+        if s.image:
+            motors = s.motor
+            times = [s.time]*len(points[0])
+        else:
+            motors = [s.motor]
+            points = [points]
+
+        relative = s.relative
+        if relative is None:
+            relative = configuration['misc'].get('default-scan') == 'relative'
+
+        start = [wmr(m) for m in motors]
+        positions = []
+        for m, p, x0 in zip(motors, points, start):
+            p = numpy.asarray(p, dtype=float)
+            if relative:
+                p = p + x0
+            positions.append(p)
+            trajectories.append((i, m, p))
+
+        velocities = [motorVelocity(mtrDB[m]) for m in motors]
+        t = estimateTime(positions, times, velocities, s.sleep, start)
+        estimates.append(t*s.args['count'])
+
+    return trajectories, estimates
+
+def checkPlan(scans, configuration):
+    trajectories, estimates = expandPlan(scans, configuration)
+    limits = dict((m, motorLimits(mtrDB[m])) for _, m, _ in trajectories)
+
+    for i, (s, t) in enumerate(zip(scans, estimates)):
+        print('Scan %d: %s, estimated time %s' % (i + 1, s.motor,
+              timedelta(seconds=int(t))))
+    print('Total estimated time: %s' % timedelta(seconds=int(sum(estimates))))
+
+    violations = validateLimits(trajectories, limits)
+    for i, m, p, low, high in violations:
+        print('Scan %d: motor %s position %g outside limits [%g, %g]' %
+              (i + 1, m, p, low, high))
+
+    return len(violations) == 0
+
+def runPlan(scans):
+    for i, s in enumerate(scans):
+        print('===== Scan %d/%d =====' % (i + 1, len(scans)))
+        s.runScan()
+
+# Print output of concurrent scans line by line, prefixed by the scan number,
+# and store the status of each scan that ends
+def printMessages(executor, pending, results):
+    for scanId, event in executor.messages():
+        if event[0] == 'output':
+            lines = (pending.get(scanId, '') + event[1]).split('\n')
+            pending[scanId] = lines.pop()
+            for line in lines:
+                print('[%d] %s' % (scanId, line))
+        elif event[0] == 'end':
+            _, status, message = event
+            if pending.get(scanId):
+                print('[%d] %s' % (scanId, pending.pop(scanId)))
+            print('[%d] Scan %s%s' % (scanId, 'ended' if status == 'ok' else
+                                      'failed', ': ' + message if message else ''))
+            results[scanId] = status
+
+def runParallel(scans):
+    executor = ScanExecutor()
+    for s in scans:
+        executor.submit(s.args)
+
+    pending = {}
+    results = {}
+    try:
+        printMessages(executor, pending, results)
+    except KeyboardInterrupt:
+        executor.sendAll('interrupt')
+        printMessages(executor, pending, results)
+
+    failed = sum(status != 'ok' for status in results.values())
+    if failed:
+        die('%d of %d scans failed' % (failed, len(scans)))
+
+if __name__ == '__main__':
+    p = docopt(__doc__, sys.argv[1:])
+
+    try:
+        configuration = loadConfiguration()
+        scans = loadPlan(p['<plan>'], p['--configuration'])
+        valid = checkPlan(scans, configuration)
+    except (OSError, ValueError) as e:
+        die(e)
+
+    if not valid:
+        die('Plan rejected: points outside motor limits')
+
+    if p['--parallel']:
+        runParallel(scans)
+    elif not p['--dry-run']:
+        runPlan(scans)
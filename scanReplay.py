@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+"""Replay a scan recorded with scan --record through the scan engine (the
+same path used by the GUI) and measure how fast its events are consumed
+
+Usage:
+    scanReplay [-s <speed> | -f] [-q] [-o <prefix>] <recording>
+    scanReplay -h
+
+Options:
+    -s <speed>, --speed=<speed>
+                        Replay speed relative to the recording [default: 1]
+    -f, --fast          Replay as fast as possible
+    -q, --quiet         Don't print the output of the replay
+    -o <prefix>, --output=<prefix>
+                        Write the ROI, spilled spectra and XRF outputs of the
+                        recorded scan again, to files starting with prefix
+    -h, --help          Show this help
+
+The recorded events are replayed as they were published, the scan callbacks
+don't run again: values are not normalized again (they're replayed as
+normalized by the scan) and the py4syn data file, progressive preview maps,
+repetition statistics, peak fits and catalog entry aren't written."""
+
+import signal
+import sys
+from time import time
+
+from scanEngine import ScanEngine, replayMain
+from scan_utils.helpers import docopt, DocoptExit, die
+
+class Consumer():
+    '''Receive engine events like the GUI does, counting them'''
+    def __init__(self, quiet=False):
+        self.quiet = quiet
+        self.points = 0
+        self.arrays = 0
+        self.fits = 0
+        self.bytes = 0
+        self.status = None
+        self.message = None
+
+    def consume(self, engine):
+        for event in engine.messages():
+            if event[0] == 'output':
+                if not self.quiet:
+                    print(event[1], end='')
+            elif event[0] == 'point':
+                self.points += 1
+            elif event[0] == 'array':
+                self.arrays += 1
+                self.bytes += event[3].nbytes
+            elif event[0] == 'fit':
+                self.fits += 1
+            elif event[0] == 'end':
+                _, self.status, self.message = event
+
+if __name__ == '__main__':
+    p = docopt(__doc__, sys.argv[1:])
+
+    try:
+        speed = 0 if p['--fast'] else float(p['--speed'])
+        if speed < 0:
+            raise ValueError()
+    except ValueError:
+        raise DocoptExit()
+
+    engine = ScanEngine({'replay': p['<recording>'], 'speed': speed,
+                         'output': p['--output']}, target=replayMain)
+    consumer = Consumer(p['--quiet'])
+    start = time()
+    engine.start()
+
+    # Ctrl+C stops the replay, the summary is still shown
+    signal.signal(signal.SIGINT, lambda *l: engine.sendCommand('interrupt'))
+    consumer.consume(engine)
+    elapsed = time() - start
+
+    if consumer.status != 'ok':
+        die('Replay failed: %s' % consumer.message)
+
+    print('Received %d points, %d arrays (%.1f MB) and %d fits in %.3fs, '
+          '%.1f points/s' %
+          (consumer.points, consumer.arrays, consumer.bytes/1e6, consumer.fits,
+           elapsed, consumer.points/elapsed if elapsed > 0 else float('inf')))
@@ -1,38 +1,110 @@
+import threading
+from bisect import bisect_right
+from collections import deque
+from time import time
+
 from epics import PV
 from py4syn.epics.StandardDevice import StandardDevice
 from py4syn.epics.ICountable import ICountable
 
+# Number of monitor updates kept in the ring buffer
+MAX_SAMPLES = 10000
+
 class CountablePV(StandardDevice, ICountable):
-        '''Adds fake ICountable support for generic PV'''
-        def __init__(self, pvName, mnemonic):
+        '''Adds ICountable support for generic PV
+
+        The PV is monitored and updates are kept in a timestamped ring buffer,
+        so reading the value doesn't need a network round trip. The value
+        returned is the time weighted mean ("mean") or the integral
+        ("integral") of the PV over the counting window, or the latest value
+        ("last")'''
+        def __init__(self, pvName, mnemonic, integrate='mean'):
                 StandardDevice.__init__(self, mnemonic)
+                if integrate not in ('mean', 'integral', 'last'):
+                        raise ValueError('Invalid integration mode: %s' % integrate)
+
                 self.pvName = pvName
-                self.pv = PV(pvName)
-        
-        def getValue(self, **kwargs):
+                self.integrate = integrate
+                self.samples = deque(maxlen=MAX_SAMPLES)
+                self.lock = threading.Lock()
+                self.start = None
+                self.end = None
+                self.pv = PV(pvName, callback=self.onChange, auto_monitor=True)
+
+        def onChange(self, value=None, **kwargs):
+                with self.lock:
+                        self.samples.append((time(), value))
+
+        def latestValue(self):
+                with self.lock:
+                        if len(self.samples) > 0:
+                                return self.samples[-1][1]
+
+                # No monitor update received yet
                 return self.pv.get()
 
+        def windowValue(self, start, end):
+                '''Integral of the PV from start to end, holding each value
+                until the next update'''
+                with self.lock:
+                        samples = list(self.samples)
+
+                if len(samples) == 0:
+                        return None
+
+                times = [t for t, _ in samples]
+                i = max(bisect_right(times, start) - 1, 0)
+                t0 = start
+                v = samples[i][1]
+                area = 0.0
+
+                for t, value in samples[i+1:]:
+                        if t >= end:
+                                break
+                        area += v*(t - t0)
+                        t0 = t
+                        v = value
+
+                return area + v*(end - t0)
+
+        def getValue(self, **kwargs):
+                if self.integrate == 'last' or self.start is None:
+                        return self.latestValue()
+
+                end = self.end if self.end is not None else time()
+                area = self.windowValue(self.start, end)
+
+                if area is None:
+                        return self.pv.get()
+                elif self.integrate == 'integral':
+                        return area
+                elif end > self.start:
+                        return area/(end - self.start)
+                else:
+                        return self.latestValue()
+
         def setCountTime(self, t):
                 pass
-        
+
         def setPresetValue(self, channel, val):
                 pass
-        
+
         def startCount(self):
-                pass
-        
+                self.start = time()
+                self.end = None
+
         def stopCount(self):
-                pass
-        
+                if self.start is not None and self.end is None:
+                        self.end = time()
+
         def canMonitor(self):
                 return False
-        
+
         def canStopCount(self):
                 return True
-        
+
         def isCounting(self):
                 return False
-        
+
         def wait(self):
                 pass
-
@@ -0,0 +1,216 @@
+"""Catalog of past scans
+
+Every scan (each repetition of a scan with --count) is recorded in a SQLite
+database with its motors and ranges, counters and their summary statistics,
+configuration, constants, timing and the files written. Scans can then be
+found without searching output directories, using Catalog.find or the
+scanCatalog command.
+
+The database is kept in the user data directory, another file can be chosen
+(or the catalog disabled) in the misc section:
+
+    misc:
+      catalog: /data/catalog.sqlite     # or false
+"""
+import json
+import os
+import sqlite3
+from contextlib import contextmanager
+from glob import glob, escape
+from numbers import Number
+
+import numpy
+from xdg.BaseDirectory import xdg_data_home
+
+from .helpers import BASE_DIRECTORY
+
+CATALOG = 'catalog.sqlite'
+
+SCHEMA = '''
+create table if not exists scans (
+    id integer primary key,
+    start real,
+    end real,
+    points integer,
+    image integer,
+    repetition integer,
+    status text,
+    command text,
+    configuration text,
+    settings text,
+    constants text,
+    comment text,
+    output text,
+    files text
+);
+create table if not exists scan_motors (
+    scan integer references scans(id) on delete cascade,
+    motor text,
+    low real,
+    high real
+);
+create table if not exists scan_counters (
+    scan integer references scans(id) on delete cascade,
+    counter text,
+    minimum real,
+    maximum real,
+    mean real,
+    total real,
+    peak real
+);
+create index if not exists scans_start on scans(start);
+create index if not exists scan_motors_motor on scan_motors(motor);
+create index if not exists scan_counters_counter on scan_counters(counter);
+'''
+
+def catalogPath(configuration):
+    """Catalog file from the configuration, None if it's disabled"""
+    fileName = configuration['misc'].get('catalog', True)
+    if fileName is False or fileName is None:
+        return None
+    if fileName is True:
+        fileName = os.path.join(xdg_data_home, BASE_DIRECTORY, CATALOG)
+
+    return fileName
+
+def counterStats(values, positions=None):
+    """Minimum, maximum, mean, sum and position of the maximum of the numeric
+    values of a counter, None if there are none"""
+    values = [v if isinstance(v, Number) and not isinstance(v, bool) else
+              float('nan') for v in values]
+    values = numpy.array(values, dtype=float)
+    valid = ~numpy.isnan(values)
+    if not valid.any():
+        return None
+
+    peak = None
+    if positions is not None and len(positions) == len(values):
+        peak = float(positions[int(numpy.nanargmax(values))])
+
+    return (float(values[valid].min()), float(values[valid].max()),
+            float(values[valid].mean()), float(values[valid].sum()), peak)
+
+def outputFiles(prefix, start):
+    """Files written since start whose name begins with prefix"""
+    if not prefix:
+        return []
+
+    return sorted(f for f in glob(escape(prefix) + '*')
+                  if os.path.isfile(f) and os.path.getmtime(f) >= start)
+
+class Catalog():
+    '''Record and find scans in a SQLite database. Each call uses its own
+    connection, so the catalog may be shared by processes'''
+    def __init__(self, fileName):
+        self.fileName = fileName
+        directory = os.path.dirname(fileName)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        with self.connect() as db:
+            db.executescript(SCHEMA)
+
+    @contextmanager
+    def connect(self):
+        """Connection committed at the end of the block, or rolled back on
+        error"""
+        db = sqlite3.connect(self.fileName, timeout=30)
+        db.row_factory = sqlite3.Row
+        db.execute('pragma foreign_keys = on')
+
+        try:
+            with db:
+                yield db
+        finally:
+            db.close()
+
+    def add(self, scan, motors=(), counters=()):
+        """Record a scan. scan is a dictionary with the scans table columns
+        (settings, constants, command and files are stored as JSON), motors
+        a list of (motor, low, high) positions and counters a list of (counter,
+        minimum, maximum, mean, total, peak). Returns the scan id"""
+        scan = dict(scan)
+        for key in ('command', 'settings', 'constants', 'files'):
+            if key in scan:
+                scan[key] = json.dumps(scan[key], default=str)
+
+        with self.connect() as db:
+            cursor = db.execute('insert into scans (%s) values (%s)' %
+                                (', '.join(scan), ', '.join('?'*len(scan))),
+                                list(scan.values()))
+            scanId = cursor.lastrowid
+            db.executemany('insert into scan_motors values (?, ?, ?, ?)',
+                           [(scanId,) + tuple(m) for m in motors])
+            db.executemany('insert into scan_counters values '
+                           '(?, ?, ?, ?, ?, ?, ?)',
+                           [(scanId,) + tuple(c) for c in counters])
+
+        return scanId
+
+    def find(self, motor=None, position=None, counter=None, since=None,
+             until=None, text=None, limit=None):
+        """Scans matching every given condition, newest first. position
+        selects scans of motor that covered it, since and until are
+        timestamps, text is searched in the command, comment and output"""
+        conditions = []
+        arguments = []
+
+        if motor is not None and position is not None:
+            conditions.append('id in (select scan from scan_motors '
+                              'where motor = ? and low <= ? and ? <= high)')
+            arguments.extend([motor, position, position])
+        elif motor is not None:
+            conditions.append('id in (select scan from scan_motors '
+                              'where motor = ?)')
+            arguments.append(motor)
+        if counter is not None:
+            conditions.append('id in (select scan from scan_counters '
+                              'where counter = ?)')
+            arguments.append(counter)
+        if since is not None:
+            conditions.append('start >= ?')
+            arguments.append(since)
+        if until is not None:
+            conditions.append('start < ?')
+            arguments.append(until)
+        if text is not None:
+            conditions.append("(command like ? or comment like ? or "
+                              "output like ?)")
+            arguments.extend(['%' + text + '%']*3)
+
+        query = 'select * from scans'
+        if conditions:
+            query += ' where ' + ' and '.join(conditions)
+        query += ' order by start desc'
+        if limit is not None:
+            query += ' limit %d' % limit
+
+        with self.connect() as db:
+            return [self.expand(db, row) for row in db.execute(query, arguments)]
+
+    def get(self, scanId):
+        """Scan with the given id, None if it doesn't exist"""
+        with self.connect() as db:
+            row = db.execute('select * from scans where id = ?',
+                             (scanId,)).fetchone()
+            return row and self.expand(db, row)
+
+    def remove(self, scanId):
+        with self.connect() as db:
+            db.execute('delete from scans where id = ?', (scanId,))
+
+    def expand(self, db, row):
+        """Scan dictionary with JSON decoded and its motors and counters"""
+        scan = dict(row)
+        for key in ('command', 'settings', 'constants', 'files'):
+            if scan[key] is not None:
+                scan[key] = json.loads(scan[key])
+
+        scan['motors'] = [dict(m) for m in db.execute(
+            'select motor, low, high from scan_motors where scan = ?',
+            (scan['id'],))]
+        scan['counters'] = dict((c['counter'], dict(c)) for c in db.execute(
+            'select counter, minimum, maximum, mean, total, peak '
+            'from scan_counters where scan = ?', (scan['id'],)))
+
+        return scan
@@ -11,7 +11,7 @@ from .PilatusClass import Pilatus
 
 from py4syn.epics.Keithley6514Class import Keithley6514
 from py4syn.epics.MarCCDClass import MarCCD
-from py4syn.utils.counter import ctr, getCountersData
+from py4syn.utils.counter import ctr
 import py4syn.utils.scan as scanModule
 
 class ScanPipeline(helpers.SubScan):
@@ -26,6 +26,7 @@ class ScanPipeline(helpers.SubScan):
         super().__init__(len(self.STEP_FN), self.pipelineStep)
         self.splitDeviceList(devices)
         self.shutters = shutters
+        self.control.shutters = tuple(shutters)
         self.imageNames = imageNames
 
         if len(self.marccd) > 0:
@@ -80,7 +81,7 @@ class ScanPipeline(helpers.SubScan):
         for shutter in self.shutters:
             shutter.close()
 
-        self.count1Data = getCountersData()
+        self.count1Data = self.readCounters()
 
     def breathe(self, positions, indexes):
         for m in self.marccd:
@@ -107,7 +108,7 @@ class ScanPipeline(helpers.SubScan):
         for shutter in self.shutters:
             shutter.close()
 
-        self.count2Data = getCountersData()
+        self.count2Data = self.readCounters()
 
     def mergeImages(self, device, index):
         target = self.imageNames[device.getMnemonic()][index]
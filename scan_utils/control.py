@@ -0,0 +1,138 @@
+"""Low latency interrupt and pause
+
+py4syn only checks for interrupt and pause between points, so with long dwell
+times stopping a scan could take as long as a whole count. ScanControl aborts
+the count in progress (and any motion) as soon as interrupt or pause is
+requested:
+
+ - on pause, the partial data of the point is discarded; on resume the motors
+   are moved back to the point and it's counted again from the start
+ - on interrupt, the partial data is kept and the point is marked incomplete
+"""
+import threading
+
+from py4syn.utils import counter
+import py4syn.utils.scan as scanModule
+
+class ScanControl():
+    '''Pause, resume and interrupt a running scan immediately'''
+    def __init__(self, shutters=()):
+        self.shutters = tuple(shutters)
+        self.scan = None
+        self.running = threading.Event()
+        self.running.set()
+        self.aborted = False
+        self.interrupted = False
+        # Visited indexes of points with partial data
+        self.incomplete = []
+
+    def abort(self):
+        self.aborted = True
+
+        # Close shutters first, so the sample is protected even if stopping
+        # some device fails
+        for shutter in self.shutters:
+            shutter.close()
+
+        counter.stopAll()
+
+        if self.scan is not None:
+            for param in self.scan.getScanParams():
+                device = param.getDevice()
+                if hasattr(device, 'stop'):
+                    device.stop()
+
+    def pause(self):
+        self.running.clear()
+        self.abort()
+
+    def resume(self):
+        self.running.set()
+
+    def interrupt(self):
+        self.interrupted = True
+        self.abort()
+        self.running.set()
+
+    def mark(self):
+        """Lengths of the data lists before a point is counted"""
+        return dict((k, len(v)) for k, v in scanModule.SCAN_DATA.items()
+                    if isinstance(v, list) and k != 'points')
+
+    def discard(self, mark):
+        """Remove data appended after mark"""
+        for k, n in mark.items():
+            del scanModule.SCAN_DATA[k][n:]
+
+    def waitResume(self, pointIdx):
+        """Wait while paused, then move the motors back to the point. Returns
+        False if the scan was interrupted"""
+        self.running.wait()
+        if self.interrupted:
+            return False
+
+        self.aborted = False
+        for param in self.scan.getScanParams():
+            param.getDevice().setValue(param.getPoints()[pointIdx])
+        self.scan._Scan__waitDevices()
+
+        # Positions recorded before the abort may be wrong
+        for param in self.scan.getScanParams():
+            device = param.getDevice()
+            values = scanModule.SCAN_DATA[device.getMnemonic()]
+            if values:
+                values[-1] = device.getValue()
+
+        return True
+
+    def markIncomplete(self, pointIdx):
+        print('Point %d incomplete' % pointIdx)
+        self.incomplete.append(pointIdx)
+
+    def attach(self, scan):
+        """Hook into a py4syn scan object, replacing its counter launch and
+        save steps. Called by the pre scan callback"""
+        self.scan = scan
+        self.aborted = False
+        self.interrupted = False
+        self.incomplete = []
+        self.running.set()
+
+        launch = scan._Scan__launchCounters
+        save = scan._Scan__saveCounterData
+        state = {}
+
+        def launchCounters(*args, **kwargs):
+            pointIdx = len(scanModule.SCAN_DATA['points']) - 1
+
+            # Paused or interrupted while moving
+            if self.aborted and not self.waitResume(pointIdx):
+                state['launched'] = False
+                return
+
+            state['mark'] = self.mark()
+            state['launched'] = True
+            launch(*args, **kwargs)
+
+        def saveCounterData(*args, **kwargs):
+            pointIdx = len(scanModule.SCAN_DATA['points']) - 1
+
+            while True:
+                save(*args, **kwargs)
+
+                if not self.aborted:
+                    return
+                if not state['launched'] or self.interrupted:
+                    self.markIncomplete(pointIdx)
+                    return
+
+                self.discard(state['mark'])
+                if not self.waitResume(pointIdx):
+                    self.markIncomplete(pointIdx)
+                    save(*args, **kwargs)
+                    return
+
+                launch(*args, **kwargs)
+
+        scan._Scan__launchCounters = launchCounters
+        scan._Scan__saveCounterData = saveCounterData
@@ -0,0 +1,84 @@
+"""Client side of the scan daemon protocol
+
+The scan daemon (scanDaemon.py) keeps configuration, motors and counters
+connected and accepts scan jobs over a local Unix socket. Messages are JSON
+objects, one per line. A client sends a single request and reads replies until
+an "end" message arrives. This module only depends on the standard library, so
+thin clients don't need to import py4syn or connect to any device."""
+import json
+import os
+import socket
+import sys
+import tempfile
+
+DAEMON_SOCKET = os.environ.get('SCAN_DAEMON_SOCKET',
+                               os.path.join(tempfile.gettempdir(),
+                                            'scan-daemon.sock'))
+
+class DaemonError(RuntimeError):
+    pass
+
+def sendMessage(f, **message):
+    f.write(json.dumps(message) + '\n')
+    f.flush()
+
+def readMessages(f):
+    for line in f:
+        line = line.strip()
+        if line:
+            yield json.loads(line)
+
+def isDaemonRunning(socketPath=DAEMON_SOCKET):
+    try:
+        sendCommand('ping', socketPath)
+    except (OSError, DaemonError):
+        return False
+
+    return True
+
+def connect(socketPath=DAEMON_SOCKET):
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        s.connect(socketPath)
+    except OSError:
+        s.close()
+        raise
+
+    return s, s.makefile('rw')
+
+# Send a control command (ping, interrupt, pause, resume, finishLevel,
+# reload, shutdown) and return the daemon reply
+def sendCommand(command, socketPath=DAEMON_SOCKET, **kwargs):
+    s, f = connect(socketPath)
+
+    try:
+        sendMessage(f, command=command, **kwargs)
+        for message in readMessages(f):
+            if message['type'] == 'end':
+                if message['status'] != 'ok':
+                    raise DaemonError(message.get('message', 'Unknown error'))
+                return message
+    finally:
+        f.close()
+        s.close()
+
+    raise DaemonError('Connection to scan daemon closed unexpectedly')
+
+# Submit a scan job. args is the dictionary created by scan.parseCommandLine.
+# Every progress message is passed to the output callback as text. Returns the
+# final "end" message.
+def submitScan(args, output=sys.stdout.write, socketPath=DAEMON_SOCKET):
+    s, f = connect(socketPath)
+
+    try:
+        sendMessage(f, command='scan', args=args)
+        for message in readMessages(f):
+            if message['type'] == 'output':
+                output(message['text'])
+            elif message['type'] == 'end':
+                return message
+    finally:
+        f.close()
+        s.close()
+
+    raise DaemonError('Connection to scan daemon closed unexpectedly')
@@ -0,0 +1,87 @@
+"""Adaptive dwell time
+
+Each point is counted until a chosen counter reaches a target number of
+counts, bounded by a minimum time and by the acquisition time of the point,
+which becomes the maximum. The time actually counted is stored in the
+live-time field, to be used for normalization.
+
+If the target counter is the monitor counter (monitor: true) and there's no
+minimum time, the monitor preset of the device is used (negative count
+time) and the count is only stopped here if it reaches the maximum time.
+Otherwise points are counted for the maximum time and the target counter is
+polled, stopping the count once the target is reached."""
+from time import time, sleep
+
+from py4syn import counterDB
+from py4syn.utils import counter
+from py4syn.utils.scan import createUserDefinedDataField
+import py4syn.utils.scan as scanModule
+
+from .readout import readDevice
+
+LIVE_TIME = 'live-time'
+
+class AdaptiveDwell():
+    def __init__(self, name, target, minTime=0, poll=0.01):
+        if name not in counterDB:
+            raise ValueError('Target counter not found: %s' % name)
+
+        self.name = name
+        self.target = target
+        self.minTime = minTime
+        self.poll = poll
+        self.info = counterDB[name]
+        self.preset = bool(self.info.get('monitor')) and minTime <= 0
+        self.maxTimes = None
+        self.start = None
+        self.liveTime = None
+        createUserDefinedDataField(LIVE_TIME)
+
+    def countTimes(self, times):
+        """Count times to pass to the scan for the given maximum times"""
+        self.maxTimes = list(times)
+        if self.preset:
+            return [-self.target]*len(self.maxTimes)
+
+        return self.maxTimes
+
+    def read(self):
+        entries = [(self.name, self.info.get('channel'), self.info.get('factor', 1))]
+        return readDevice(self.info['device'], entries)[self.name]
+
+    def wait(self, pointIdx):
+        """Wait until the point is done, stopping the count when the target
+        or the maximum time is reached"""
+        maxTime = self.maxTimes[pointIdx % len(self.maxTimes)]
+        device = self.info['device']
+
+        while device.isCounting():
+            elapsed = time() - self.start
+            if elapsed >= maxTime:
+                break
+            if not self.preset and elapsed >= self.minTime:
+                value = self.read()
+                if value is not None and value >= self.target:
+                    break
+            sleep(self.poll)
+
+        counter.stopAll()
+        self.liveTime = time() - self.start
+
+    def attach(self, scan):
+        """Hook into a py4syn scan object, like ScanControl.attach. Must be
+        attached before the control, so re-acquired points use it too"""
+        launch = scan._Scan__launchCounters
+        save = scan._Scan__saveCounterData
+
+        def launchCounters(*args, **kwargs):
+            self.start = time()
+            launch(*args, **kwargs)
+
+        def saveCounterData(*args, **kwargs):
+            self.wait(len(scanModule.SCAN_DATA['points']) - 1)
+            save(*args, **kwargs)
+            scanModule.SCAN_DATA[LIVE_TIME].append(self.liveTime)
+
+        scan._Scan__launchCounters = launchCounters
+        scan._Scan__saveCounterData = saveCounterData
@@ -0,0 +1,119 @@
+"""Per point event bus
+
+The scan publishes one PointEvent per point, with positions, counter values,
+timing and references to array values (spectra). Each consumer (GUI, plots,
+writers) subscribes with its own bounded queue, so a slow consumer never
+stalls acquisition. What happens when a queue is full depends on the policy
+of the subscription:
+
+    drop-oldest     discard the oldest queued event (default)
+    drop-newest     discard the new event
+    block           wait up to block-timeout seconds for room, then discard
+                    the new event
+
+Arrays are not copied, consumers must not modify them."""
+import threading
+from collections import deque, namedtuple
+
+POLICIES = ('drop-oldest', 'drop-newest', 'block')
+
+# index: visited point index, natural: index in logical order, positions and
+# values: scalars by name, arrays: array values by name, start and end: point
+# start and end time (time.time()), countTime: time counted (live time with
+# adaptive dwell), repetition: repetition number (--count)
+PointEvent = namedtuple('PointEvent', 'index natural positions values arrays '
+                                      'start end countTime repetition')
+# kind: start, end or level (end of a progressive map level)
+ScanEvent = namedtuple('ScanEvent', 'kind time repetition')
+# counter: spectra counter, natural: index in logical order, values: fitted
+# amounts by element (see scan_utils/xrf.py), time: when the fit finished
+FitEvent = namedtuple('FitEvent', 'counter natural values time repetition')
+
+class Subscription():
+    '''Bounded queue of events for one consumer'''
+    def __init__(self, maxsize=1000, policy='drop-oldest', blockTimeout=0.1):
+        if policy not in POLICIES:
+            raise ValueError('Unknown drop policy: %s' % policy)
+
+        self.maxsize = maxsize
+        self.policy = policy
+        self.blockTimeout = blockTimeout
+        self.queue = deque()
+        self.condition = threading.Condition()
+        self.dropped = 0
+        self.closed = False
+
+    def put(self, event):
+        with self.condition:
+            if len(self.queue) >= self.maxsize:
+                if self.policy == 'drop-oldest':
+                    self.queue.popleft()
+                    self.dropped += 1
+                elif self.policy == 'block':
+                    self.condition.wait_for(lambda: len(self.queue) < self.maxsize,
+                                            self.blockTimeout)
+
+                if len(self.queue) >= self.maxsize:
+                    self.dropped += 1
+                    return
+
+            self.queue.append(event)
+            self.condition.notify_all()
+
+    def get(self, timeout=None):
+        """Return the next event, or None on timeout or when the subscription
+        was closed and every event was consumed"""
+        with self.condition:
+            self.condition.wait_for(lambda: self.queue or self.closed, timeout)
+            if not self.queue:
+                return None
+
+            event = self.queue.popleft()
+            self.condition.notify_all()
+            return event
+
+    def __iter__(self):
+        while True:
+            event = self.get()
+            if event is None:
+                return
+            yield event
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+class EventBus():
+    def __init__(self):
+        self.subscriptions = []
+        self.lock = threading.Lock()
+
+    def subscribe(self, maxsize=1000, policy='drop-oldest', blockTimeout=0.1):
+        s = Subscription(maxsize, policy, blockTimeout)
+        with self.lock:
+            self.subscriptions.append(s)
+
+        return s
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            if subscription in self.subscriptions:
+                self.subscriptions.remove(subscription)
+        subscription.close()
+
+    def publish(self, event):
+        with self.lock:
+            subscriptions = list(self.subscriptions)
+
+        for s in subscriptions:
+            s.put(event)
+
+    def close(self):
+        """Close every subscription, consumers finish the queued events"""
+        with self.lock:
+            subscriptions = self.subscriptions
+            self.subscriptions = []
+
+        for s in subscriptions:
+            s.close()
@@ -0,0 +1,143 @@
+"""Fit scan data of all counters at once
+
+Each counter is fitted in a process pool with the peak (gaussian), edge
+(error function step) and centroid models. Results are dictionaries with the
+position (peak center, edge position or centroid), FWHM (of the peak, or of
+the edge derivative) and amplitude, or None when the fit failed. Points
+that aren't finite (failed points are NaN) are left out of the fits, their
+number is in dropped.
+
+The pool uses spawn, like the scan engine: forking a process that runs
+Channel Access threads can deadlock the children on inherited locks."""
+import multiprocessing
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+from numbers import Number
+
+import numpy
+from scipy.optimize import curve_fit
+from scipy.special import erf
+
+MODELS = ('peak', 'edge', 'centroid')
+
+# FWHM of a gaussian with unit standard deviation
+SIGMA_TO_FWHM = 2*numpy.sqrt(2*numpy.log(2))
+
+def gaussian(x, amplitude, center, sigma, offset):
+    return amplitude*numpy.exp(-(x - center)**2/(2*sigma**2)) + offset
+
+def step(x, amplitude, center, sigma, offset):
+    return amplitude/2*(1 + erf((x - center)/(numpy.sqrt(2)*sigma))) + offset
+
+def centroid(x, y):
+    w = y - y.min()
+    total = w.sum()
+    if total == 0:
+        return None
+
+    return {'position': float((x*w).sum()/total), 'fwhm': None,
+            'amplitude': float(y.max() - y.min())}
+
+def fitPeak(x, y):
+    i = int(numpy.argmax(y))
+    offset = float(y.min())
+    amplitude = float(y[i]) - offset
+    # Initial width from the points above half maximum
+    above = x[y - offset >= amplitude/2]
+    sigma = max(float(above.max() - above.min()), abs(float(x[1] - x[0])))/SIGMA_TO_FWHM
+
+    p, _ = curve_fit(gaussian, x, y, p0=(amplitude, float(x[i]), sigma, offset))
+    return {'position': float(p[1]), 'fwhm': float(abs(p[2])*SIGMA_TO_FWHM),
+            'amplitude': float(p[0])}
+
+def fitEdge(x, y):
+    # Edge position guess is the largest derivative
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        d = numpy.diff(y)/numpy.diff(x)
+    i = int(numpy.nanargmax(numpy.abs(d)))
+    amplitude = float(y[-1] - y[0])
+    sigma = abs(float(x[-1] - x[0]))/10
+
+    p, _ = curve_fit(step, x, y, p0=(amplitude, float(x[i] + x[i + 1])/2,
+                                     sigma, float(y[0])))
+    return {'position': float(p[1]), 'fwhm': float(abs(p[2])*SIGMA_TO_FWHM),
+            'amplitude': float(p[0])}
+
+FIT_FN = {
+    'peak': fitPeak,
+    'edge': fitEdge,
+    'centroid': centroid,
+}
+
+def fitCounter(name, x, y, models=MODELS):
+    """Fit one counter with every model. Returns (name, results)"""
+    x = numpy.asarray(x, dtype=float)
+    y = numpy.asarray(y, dtype=float)
+
+    finite = numpy.isfinite(x) & numpy.isfinite(y)
+    dropped = int(len(y) - finite.sum())
+    x = x[finite]
+    y = y[finite]
+
+    # Sort by position, fits don't depend on scan direction
+    order = numpy.argsort(x)
+    x = x[order]
+    y = y[order]
+
+    results = {'dropped': dropped}
+    for model in models:
+        if len(y) < 4:
+            results[model] = None
+            continue
+        try:
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore')
+                results[model] = FIT_FN[model](x, y)
+        except (RuntimeError, ValueError, TypeError, FloatingPointError):
+            results[model] = None
+
+    return name, results
+
+def numericCounters(data, counters):
+    """Return the counters of data that have only numeric values"""
+    numeric = []
+
+    for name in counters:
+        values = data.get(name)
+        if not values or len(values) < 4:
+            continue
+        if all(isinstance(v, Number) and not isinstance(v, bool) for v in values):
+            numeric.append(name)
+
+    return numeric
+
+def fitAll(x, data, counters, models=MODELS, executor=None):
+    """Fit all numeric counters of data (as returned by getScanData) against
+    the positions x. Returns {counter: {model: result}}"""
+    names = numericCounters(data, counters)
+    if executor is None or len(names) < 2:
+        return dict(fitCounter(n, x, data[n], models) for n in names)
+
+    futures = [executor.submit(fitCounter, n, x, data[n], models) for n in names]
+    return dict(f.result() for f in futures)
+
+def createFitExecutor():
+    return ProcessPoolExecutor(mp_context=multiprocessing.get_context('spawn'))
+
+def formatFits(fits, models=MODELS):
+    lines = []
+    for name in sorted(fits):
+        fields = []
+        for model in models:
+            r = fits[name].get(model)
+            if r is None:
+                fields.append('%s: -' % model)
+            elif r['fwhm'] is None:
+                fields.append('%s: %g' % (model, r['position']))
+            else:
+                fields.append('%s: %g (FWHM %g)' % (model, r['position'], r['fwhm']))
+        if fits[name].get('dropped'):
+            fields.append('%d points dropped' % fits[name]['dropped'])
+        lines.append('%s: %s' % (name, ', '.join(fields)))
+
+    return '\n'.join(lines)
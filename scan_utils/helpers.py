@@ -7,6 +7,7 @@ import re
 import time
 import atexit
 import signal
+import threading
 import collections
 from datetime import datetime
 from glob import iglob
@@ -17,7 +18,7 @@ from docopt import docopt, DocoptExit
 from xdg.BaseDirectory import load_config_paths as loadConfigPaths
 from xdg.BaseDirectory import xdg_config_dirs as xdgConfigDirs
 
-from epics import PV
+from epics import PV, caget_many
 from py4syn import mtrDB
 from py4syn.epics.Keithley6514Class import Keithley6514
 from py4syn.epics.LinkamCI94Class import LinkamCI94
@@ -40,6 +41,9 @@ from py4syn.epics.DxpFakeClass import DxpFake
 from py4syn.epics.OceanClass import OceanOpticsSpectrometer
 
 from .CountablePV import CountablePV
+from .control import ScanControl
+from .retry import PointFailed
+from .readout import Readout, waitCounters
 from .NullMotor import NullMotor
 
 import importlib
@@ -214,8 +218,17 @@ def findActiveCounterFromSAXS2ScanFile(scanFilePattern):
 
 MAX_NUM_CHANNELS = 20
 
+class GroupedScaler(Scaler):
+    '''Scaler that reads several channels with a single Channel Access request'''
+    def __init__(self, pvName, numChannels, mnemonic):
+        super().__init__(pvName, numChannels, mnemonic)
+        self.channelPVs = ['%s.S%d' % (pvName, i) for i in range(1, numChannels + 1)]
+
+    def getValues(self, channels):
+        return caget_many([self.channelPVs[c - 1] for c in channels])
+
 def scalerBuilder(info, mnemonic):
-    return Scaler(info['pv'], MAX_NUM_CHANNELS, mnemonic)
+    return GroupedScaler(info['pv'], MAX_NUM_CHANNELS, mnemonic)
 
 def keithleyDestructor(keithley, integration, average, averageType, averageCount,
                        continuous):
@@ -279,15 +292,19 @@ def pilatusBuilder(info, mnemonic):
 DXP_MAX_NUM_CHANNELS = 4
 DXP_MAX_NUM_ROIS_PER_CHANNEL = 32
 
+# Hardware channels and ROIs may be changed with the "channels" and
+# "hardware-rois" counter options. Software ROIs (see roi.py) have no limit.
 def dxpBuilder(info, mnemonic, out='out'):
-    d = Dxp(mnemonic,DXP_MAX_NUM_CHANNELS,DXP_MAX_NUM_ROIS_PER_CHANNEL,info['pv'],output=out)
+    d = Dxp(mnemonic,info.get('channels', DXP_MAX_NUM_CHANNELS),
+            info.get('hardware-rois', DXP_MAX_NUM_ROIS_PER_CHANNEL),info['pv'],output=out)
     atexit.register(d.close)
     #installSignalHandlers()
 
     return d
 
 def dxpFakeBuilder(info, mnemonic, out='out'):
-    d = DxpFake(mnemonic,DXP_MAX_NUM_CHANNELS,DXP_MAX_NUM_ROIS_PER_CHANNEL,info['pv'],output=out)
+    d = DxpFake(mnemonic,info.get('channels', DXP_MAX_NUM_CHANNELS),
+                info.get('hardware-rois', DXP_MAX_NUM_ROIS_PER_CHANNEL),info['pv'],output=out)
     atexit.register(d.close)
     #installSignalHandlers()
 
@@ -306,7 +323,8 @@ def isCamera(type):
 counterBuilder = {
     'scaler': scalerBuilder,
     'keithley': keithleyBuilder,
-    'pv': lambda info, name: CountablePV(info['pv'], name),
+    'pv': lambda info, name: CountablePV(info['pv'], name,
+                                         info.get('integrate', 'mean')),
     'virtual': lambda info, name: SimCountable(info['pv'], name),
     'date': userDefinedBuilder,
     'time': userDefinedBuilder,
@@ -318,8 +336,17 @@ counterBuilder = {
     'qe65000' :qe65000Builder
 }
 
-# Create counters using counterMap for configuration
-def createCounters(counters, configuration, output=None):
+# Key identifying the device used by a counter. Counters with the same key
+# share the device
+def counterKey(info):
+    return (info['type'], info.get('pv', None), info.get('ip', None),
+            info.get('address', None), info.get('formula', None),
+            info.get('spectra', False))
+
+# Create counters using counterMap for configuration. If a cache dictionary is
+# given, devices already created in a previous call are reused instead of
+# being connected again (used by the scan daemon to keep devices warm)
+def createCounters(counters, configuration, output=None, cache=None):
     counterMap = configuration['counters']
     devices = {}
 
@@ -352,19 +379,37 @@ def createCounters(counters, configuration, output=None):
         except KeyError:
             raise ValueError('Counter %s doesn\'t have a type field' % name) from None
 
-        if (type, pv, ip, address, formula, spectra) in devices:
-            device = devices[type, pv, ip, address, formula, spectra]
+        isSpectra = type == 'dxp' or type == 'dxpfake' or type == "qe65000"
+        # With ROIs configured, the RoiStore writes the ROIs and the selected
+        # spectra, so the device is built without its own output
+        hasRois = isSpectra and 'rois' in info
+        hasOutput = (output is not None) and isSpectra and not hasRois
+        # Devices writing their own output files can only be reused for the
+        # same output
+        key = counterKey(info)
+        cacheKey = key + (output if hasOutput else None, hasRois)
+
+        if key in devices:
+            device = devices[key]
+        elif cache is not None and cacheKey in cache:
+            device = cache[cacheKey]
+            devices[key] = device
         else:
             try:
-                if (output is not None) and (type == 'dxp' or type == 'dxpfake'
-                        or type == "qe65000"):
+                if hasOutput:
                     device = counterBuilder[type](info, name, output)
+                elif hasRois:
+                    device = counterBuilder[type](info, name, None)
                 else:
                     device = counterBuilder[type](info, name)
-                devices[type, pv, ip, address, formula, spectra] = device
+                devices[key] = device
             except KeyError:
                 raise ValueError('Unable to build device with type %s' % type) from None
 
+            # User defined fields (date, time) must be recreated on every scan
+            if cache is not None and device is not None:
+                cache[cacheKey] = device
+
         # The created counter may not be an ICountable (ex: date, time, etc.)
         if(isinstance(device, ICountable)):
             counter.createCounter(name, device, channel, monitor, factor)
@@ -396,14 +441,72 @@ def createCameraShutters(counters, configuration):
 
     return tuple(shutters.values())
 
+# Interval to double check motion with a regular poll, in case a done
+# moving monitor update is missed
+MOTION_POLL_FALLBACK = 1.0
+
 class MotorWithReadBack(Motor):
-    '''A motor class with separate read back value PV'''
+    '''A motor class with separate read back value PV
+
+    The readback and the done moving flag (DMOV) are monitored, so
+    getRealPosition returns the latest readback without a network round trip
+    and wait returns as soon as the motion done event arrives.'''
     def __init__(self, mnemonic, pvName, readBackName):
         super().__init__(pvName, mnemonic)
-        self.readBack = PV(readBackName)
+        self.readBackValue = None
+        self.done = threading.Event()
+        self.done.set()
+        # DMOV was seen at 0 since the last move started. Done events
+        # arriving before that are late updates of the previous move
+        self.started = True
+        self.moveLock = threading.Lock()
+        self.readBack = PV(readBackName, callback=self.onReadBack,
+                           auto_monitor=True)
+        self.doneMoving = PV(pvName + '.DMOV', callback=self.onDoneMoving,
+                             auto_monitor=True)
+
+    def onReadBack(self, value=None, **kwargs):
+        self.readBackValue = value
+
+    def onDoneMoving(self, value=None, **kwargs):
+        with self.moveLock:
+            if value != 1:
+                self.started = True
+                self.done.clear()
+            elif self.started:
+                self.done.set()
 
     def getRealPosition(self):
-        return self.readBack.get()
+        if self.readBackValue is None:
+            return self.readBack.get()
+
+        return self.readBackValue
+
+    # Every move clears the done event before starting, and it's only set
+    # again once the move was seen starting, so wait never sees a stale done
+    # flag from the previous move
+    def startMove(self):
+        with self.moveLock:
+            self.started = False
+            self.done.clear()
+
+    def setValue(self, v):
+        self.startMove()
+        super().setValue(v)
+
+    def setAbsolutePosition(self, pos, waitComplete=False):
+        self.startMove()
+        super().setAbsolutePosition(pos, waitComplete)
+
+    def setRelativePosition(self, pos, waitComplete=False):
+        self.startMove()
+        super().setRelativePosition(pos, waitComplete)
+
+    # Moves that don't start (already at the target) are caught by the poll
+    def wait(self):
+        while not self.done.wait(MOTION_POLL_FALLBACK):
+            if not self.isMoving():
+                self.done.set()
 
 def die(*v):
     print(*v, file=stderr)
@@ -497,19 +600,58 @@ class SubScan(Scan):
         super().__init__(ScanType.SCAN, *args, **kwargs)
         self.subScanCount = count
         self.subScanCallback = callback
+        self.readout = None
+        self.control = ScanControl()
+        self.control.scan = self
+        # PointRetry, to retry failed steps and skip points that keep failing
+        # instead of aborting the scan
+        self.retry = None
+
+    # Abort the point being counted instead of waiting for it to finish
+    def interrupt(self):
+        super().interrupt()
+        self.control.interrupt()
+
+    def pause(self):
+        self.control.pause()
+
+    def resume(self):
+        self.control.resume()
+
+    # Read all counters, each device once, independent devices concurrently
+    def readCounters(self):
+        if self.readout is None:
+            self.readout = Readout()
+
+        return self.readout.read()
 
     def waitComplete(self, idxs):
-        t = self.getCountTime()
+        waitCounters(self.getCountTime(), idxs)
 
-        if isinstance(t, collections.Iterable):
-            t = t[int(idxs[-1])]
+    def runStep(self, step, function, *args):
+        if self.retry is None:
+            return function(*args)
 
-        if(t < 0):
-            counter.waitAll(monitor=True)
-        else:
-            counter.waitAll(monitor=False)
+        return self.retry.run(step, function, *args)
+
+    def moveTo(self, pointIdx):
+        """Move to the point and return the position of each device"""
+        for param in self.getScanParams():
+            param.getDevice().setValue(param.getPoints()[pointIdx])
+
+        self._Scan__waitDevices()
+
+        # Read the position only once per point
+        return [param.getDevice().getValue() for param in self.getScanParams()]
 
-        counter.stopAll()
+    def countPoint(self, mark, positions, indexes):
+        """Run the sub scan steps, discarding data of a failed attempt"""
+        self.control.discard(mark)
+
+        for i in range(self.subScanCount):
+            self.subScanCallback(scan=self, pos=positions, idx=indexes, sub=i)
+            if self.control.aborted:
+                break
 
     def doScan(self):
         # Arrays to store positions and indexes to be used as callback arguments
@@ -531,24 +673,53 @@ class SubScan(Scan):
             self._Scan__waitDelay(scan=self, pos=positions, idx=indexes)
 
             for deviceIdx in range(0, self.getNumberOfParams()):
-                param = self.getScanParams()[deviceIdx]
-                param.getDevice().setValue(param.getPoints()[pointIdx])
                 indexes.append(pointIdx)
 
-            self._Scan__waitDevices()
+            error = None
+            try:
+                values = self.runStep('Moving', self.moveTo, pointIdx)
+            except PointFailed as e:
+                error = e
+                values = [float('nan')]*self.getNumberOfParams()
 
-            for deviceIdx in range(0, self.getNumberOfParams()):
-                param = self.getScanParams()[deviceIdx]
-                positions.append(param.getDevice().getValue())
+            for param, position in zip(self.getScanParams(), values):
+                positions.append(position)
                 # Saves device position at SCAN_DATA
-                scanModule.SCAN_DATA[param.getDevice().getMnemonic()].append(param.getDevice().getValue())
+                scanModule.SCAN_DATA[param.getDevice().getMnemonic()].append(position)
 
             # Pre Operation Callback
             if(self._Scan__preOperationCallback):
                 self._Scan__preOperationCallback(scan=self, pos=positions, idx=indexes)
 
-            for i in range(self.subScanCount):
-                self.subScanCallback(scan=self, pos=positions, idx=indexes, sub=i)
+            # Paused points are counted again from the first sub scan,
+            # interrupted points end the scan and failed points are skipped
+            mark = self.control.mark()
+            while error is None:
+                if self.control.aborted and not self.control.waitResume(pointIdx):
+                    break
+
+                mark = self.control.mark()
+                try:
+                    self.runStep('Counting', self.countPoint, mark, positions,
+                                 indexes)
+                except PointFailed as e:
+                    error = e
+                    break
+
+                if not self.control.aborted or self.control.interrupted:
+                    break
+                self.control.discard(mark)
+
+            if self.retry is not None:
+                if error is None:
+                    self.retry.counted(mark)
+                else:
+                    self.retry.markFailed(pointIdx, error, mark)
+                self.retry.record(error is not None)
+
+            if self.control.interrupted:
+                self.control.markIncomplete(pointIdx)
+                break
 
             # Post Operation Callback
             if(self._Scan__postOperationCallback):
@@ -563,6 +734,10 @@ class SubScan(Scan):
             if(self._Scan__postPointCallback):
                 self._Scan__postPointCallback(scan=self, pos=positions, idx=indexes)
 
+        if self.readout is not None:
+            self.readout.close()
+            self.readout = None
+
         # Post Scan Callback
         if(self._Scan__postScanCallback):
             self._Scan__postScanCallback(scan=self)
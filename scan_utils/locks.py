@@ -0,0 +1,127 @@
+"""Device locks for scans running at the same time
+
+Scans running in different processes (see ScanExecutor in scanEngine.py, or
+simply several scan commands) lock every motor and counter device they use,
+so independent experiments run concurrently and only scans sharing a device
+wait for each other. Devices are identified by their PV (or address), so
+counters reading channels of the same device share a lock, and pseudo motors
+also lock the motors they move. Counters without hardware (date, time, math,
+virtual) and read only PV monitors (pv type, like the ring current) are not
+locked, any number of scans may read them.
+
+Locks are files held with flock, so they're released when the scan ends or
+its process dies. The directory and the maximum time to wait for busy
+devices (forever by default) are configured in the misc section:
+
+    misc:
+      lock-directory: /tmp/scan-utils-locks
+      lock-timeout: 600
+"""
+import fcntl
+import os
+import re
+import tempfile
+import time
+
+LOCK_DIRECTORY = os.path.join(tempfile.gettempdir(), 'scan-utils-locks')
+
+# Counter types that don't need a lock
+UNLOCKED_COUNTERS = ('date', 'time', 'math', 'virtual', 'pv')
+
+class DeviceBusy(RuntimeError):
+    pass
+
+def deviceName(info, name):
+    for key in ('pv', 'ip', 'address'):
+        if info.get(key):
+            return str(info[key])
+
+    return name
+
+def motorDevices(name, configuration):
+    """Devices moved by a motor"""
+    info = configuration['motors'][name]
+
+    if info['type'] == 'null':
+        return []
+    if info['type'] == 'pseudo':
+        devices = [name]
+        for motor in info.get('targets', {}):
+            devices.extend(motorDevices(motor, configuration))
+        return devices
+
+    return [deviceName(info, name)]
+
+def counterDevices(counters, configuration):
+    """Devices read by the counters that must be locked"""
+    return [deviceName(configuration['counters'][n], n) for n in counters
+            if configuration['counters'][n].get('type') not in UNLOCKED_COUNTERS]
+
+class DeviceLocks():
+    '''Exclusive locks on a set of devices, all of them or none'''
+    def __init__(self, directory=LOCK_DIRECTORY):
+        self.directory = directory
+        self.files = {}
+
+    def path(self, device):
+        return os.path.join(self.directory,
+                            re.sub(r'[^\w.-]', '_', device) + '.lock')
+
+    def holder(self, device):
+        try:
+            with open(self.path(device)) as f:
+                return f.read().strip() or 'unknown'
+        except OSError:
+            return 'unknown'
+
+    def tryAcquire(self, devices, owner):
+        """Lock every device or none of them. Returns the busy devices"""
+        busy = []
+
+        for device in devices:
+            fd = os.open(self.path(device), os.O_RDWR | os.O_CREAT, 0o666)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                os.close(fd)
+                busy.append(device)
+            else:
+                self.files[device] = fd
+
+        if busy:
+            self.release()
+            return busy
+
+        for fd in self.files.values():
+            os.ftruncate(fd, 0)
+            os.pwrite(fd, owner.encode(), 0)
+
+        return []
+
+    def acquire(self, devices, owner='', timeout=None, poll=0.5):
+        """Wait until every device is free and lock them. Raises DeviceBusy
+        after timeout seconds"""
+        os.makedirs(self.directory, exist_ok=True)
+        devices = sorted(set(devices))
+        start = time.time()
+        reported = None
+
+        while True:
+            busy = self.tryAcquire(devices, owner)
+            if not busy:
+                return
+
+            held = ', '.join('%s (%s)' % (d, self.holder(d)) for d in busy)
+            if timeout is not None and time.time() - start >= timeout:
+                raise DeviceBusy('Devices in use: %s' % held)
+            if busy != reported:
+                print('Waiting for devices in use: %s' % held)
+                reported = busy
+
+            time.sleep(poll)
+
+    def release(self):
+        # Closing the file releases the lock
+        for fd in self.files.values():
+            os.close(fd)
+        self.files = {}
@@ -0,0 +1,72 @@
+"""Masked 2d scans
+
+Only the grid points inside a mask are visited, in snake order. A mask is
+either a YAML file with a list of polygons, each one a list of vertices
+given as [motor 0 position, motor 1 position], for example:
+
+    - [[0, 0], [1, 0], [1, 2], [0, 2]]
+    - [[2, 2], [3, 2], [2.5, 3]]
+
+or an image mask: a NumPy (.npy) or text file with a boolean or 0/1 array,
+with one line per position of motor 1 and one column per position of motor
+0. Points are selected in the same coordinates as the scan limits (before
+adding the current position in relative scans)."""
+import numpy
+import yaml
+
+from .path_optimizer import snakeIndex
+
+def pointsInPolygon(x, y, polygon):
+    """Even-odd rule test of each point (x, y) against the polygon"""
+    polygon = numpy.asarray(polygon, dtype=float)
+    inside = numpy.zeros(numpy.shape(x), dtype=bool)
+    xs = polygon[:, 0]
+    ys = polygon[:, 1]
+    xp = numpy.roll(xs, 1)
+    yp = numpy.roll(ys, 1)
+
+    for x0, y0, x1, y1 in zip(xs, ys, xp, yp):
+        if y0 == y1:
+            continue
+        crosses = (y0 > y) != (y1 > y)
+        xCross = x0 + (y - y0)*(x1 - x0)/(y1 - y0)
+        inside ^= crosses & (x < xCross)
+
+    return inside
+
+def loadMask(fileName, axes):
+    """Return a boolean array with one line per position of axes[1] and one
+    column per position of axes[0], True for points to visit"""
+    shape = (len(axes[1]), len(axes[0]))
+
+    if fileName.endswith(('.yml', '.yaml')):
+        with open(fileName) as f:
+            polygons = yaml.load(f)
+
+        x, y = numpy.meshgrid(numpy.asarray(axes[0], dtype=float),
+                              numpy.asarray(axes[1], dtype=float))
+        mask = numpy.zeros(shape, dtype=bool)
+        for polygon in polygons:
+            mask |= pointsInPolygon(x, y, polygon)
+
+        return mask
+
+    if fileName.endswith('.npy'):
+        mask = numpy.load(fileName)
+    else:
+        mask = numpy.loadtxt(fileName, ndmin=2)
+
+    mask = numpy.asarray(mask).astype(bool)
+    if mask.shape != shape:
+        raise ValueError('Mask shape %s does not match the scan grid %s' %
+                         (mask.shape, shape))
+
+    return mask
+
+def maskedSnake(mask):
+    """Snake order indexes of the points inside the mask (as returned by
+    loadMask), sorted so they keep the snake path"""
+    lines, pointsPerLine = mask.shape
+    logical = numpy.flatnonzero(mask.ravel())
+
+    return numpy.sort(snakeIndex(logical, pointsPerLine))
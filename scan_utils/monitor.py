@@ -0,0 +1,159 @@
+"""High rate monitoring of counters (time scans without a motor)
+
+Counters are sampled at a fixed rate into a ring buffer, and a writer
+thread drains the buffer in batches, so file access never delays
+sampling. Counters are read without starting a count, so this is meant for
+continuously updated values (pv counters, temperatures, scalers in auto count
+mode).
+
+With a deadband, a sample is only stored when some counter changed more than
+its deadband since the last stored sample. Deadbands are given per counter in
+the configuration ("deadband" key) or for all counters on the command line."""
+import threading
+from numbers import Number
+from time import time, sleep
+
+import numpy
+
+class SampleRing():
+    '''Ring buffer of samples, each one a time followed by one value per
+    counter. If the reader falls behind, the oldest samples are overwritten'''
+    def __init__(self, width, capacity=100000):
+        self.data = numpy.empty((capacity, width + 1))
+        self.capacity = capacity
+        self.written = 0
+        self.read = 0
+        self.overruns = 0
+        self.lock = threading.Lock()
+
+    def append(self, t, values):
+        with self.lock:
+            row = self.data[self.written % self.capacity]
+            row[0] = t
+            row[1:] = values
+            self.written += 1
+
+    def drain(self):
+        """Return the samples appended since the last drain"""
+        with self.lock:
+            if self.written - self.read > self.capacity:
+                self.overruns += self.written - self.read - self.capacity
+                self.read = self.written - self.capacity
+
+            indexes = numpy.arange(self.read, self.written) % self.capacity
+            rows = self.data[indexes]
+            self.read = self.written
+
+        return rows
+
+class Deadband():
+    '''Keep only samples where some value changed more than its deadband'''
+    def __init__(self, deadbands):
+        self.deadbands = numpy.asarray(deadbands, dtype=float)
+        self.last = None
+
+    def filter(self, rows):
+        if len(rows) == 0:
+            return rows
+
+        keep = numpy.zeros(len(rows), dtype=bool)
+        last = self.last
+
+        for i, values in enumerate(rows[:, 1:]):
+            if last is None:
+                keep[i] = True
+            else:
+                with numpy.errstate(invalid='ignore'):
+                    changed = numpy.abs(values - last) > self.deadbands
+                # A value becoming or stopping being NaN is also a change
+                changed |= numpy.isnan(values) != numpy.isnan(last)
+                keep[i] = changed.any()
+            if keep[i]:
+                last = values
+
+        self.last = last
+        return rows[keep]
+
+def sampleValues(data, names):
+    """Convert a readout to an array, non numeric values become NaN"""
+    values = numpy.full(len(names), numpy.nan)
+
+    for i, name in enumerate(names):
+        v = data.get(name)
+        if isinstance(v, Number) and not isinstance(v, bool):
+            values[i] = v
+
+    return values
+
+class Monitor():
+    '''Sample counters at a fixed rate and write them in batches'''
+    def __init__(self, readout, names, rate, f, deadband=None, batch=1.0,
+                 capacity=100000):
+        self.readout = readout
+        self.names = list(names)
+        self.period = 1/rate
+        self.f = f
+        self.deadband = Deadband(deadband) if deadband is not None else None
+        self.batch = batch
+        self.ring = SampleRing(len(self.names), capacity)
+        self.stopped = threading.Event()
+        self.samples = 0
+        self.stored = 0
+        self.late = 0
+
+    def sample(self, limit=None, duration=None):
+        start = time()
+        next = start
+
+        while not self.stopped.is_set():
+            if limit is not None and self.samples >= limit:
+                break
+            if duration is not None and time() - start >= duration:
+                break
+
+            t = time()
+            self.ring.append(t, sampleValues(self.readout.read(), self.names))
+            self.samples += 1
+
+            # Fixed rate, not fixed sleep: late samples don't shift the
+            # following ones
+            next += self.period
+            wait = next - time()
+            if wait > 0:
+                sleep(wait)
+            else:
+                self.late += 1
+                if -wait > self.period:
+                    next = time()
+
+    def flush(self):
+        rows = self.ring.drain()
+        if self.deadband is not None:
+            rows = self.deadband.filter(rows)
+
+        if len(rows):
+            numpy.savetxt(self.f, rows, delimiter='\t',
+                          fmt=['%.6f'] + ['%.9g']*len(self.names))
+            self.f.flush()
+            self.stored += len(rows)
+
+    def write(self):
+        while not self.stopped.wait(self.batch):
+            self.flush()
+
+    def run(self, limit=None, duration=None):
+        """Sample until limit samples were taken, duration seconds passed or
+        stop is called"""
+        self.f.write('# time\t%s\n' % '\t'.join(self.names))
+        writer = threading.Thread(target=self.write)
+        writer.start()
+
+        try:
+            self.sample(limit, duration)
+        finally:
+            self.stopped.set()
+            writer.join()
+            self.flush()
+
+    def stop(self):
+        self.stopped.set()
@@ -0,0 +1,250 @@
+"""Choose the order in which scan points are visited to minimize total motion
+time. Grids (2d maps) are tried with both fast axis assignments and with
+snake, unidirectional (raster) and spiral patterns. Arbitrary point lists are
+ordered with nearest neighbour followed by 2-opt improvement.
+
+Move times follow a trapezoidal velocity profile: acceleration is the time
+the motor takes to reach full velocity, like the ACCL field of the EPICS motor
+record. Motors move together, so each move takes the time of the slowest one.
+
+All optimizers return the logical index of each visited point, which is used
+by restoreLogicalOrder to write the data back in logical order."""
+import numpy
+
+PATTERNS = ('snake', 'raster', 'spiral')
+
+def moveTime(distance, velocity, acceleration=None):
+    """Time to move the given (array of) distances"""
+    d = numpy.abs(numpy.asarray(distance, dtype=float))
+
+    if velocity is None:
+        return numpy.zeros(d.shape)
+
+    if not acceleration:
+        return d/velocity
+
+    # Full speed is reached only if the distance covers acceleration and
+    # deceleration ramps
+    ramp = velocity*acceleration
+    return numpy.where(d >= ramp, d/velocity + acceleration,
+                       2*numpy.sqrt(d*acceleration/velocity))
+
+def pathTime(positions, velocities, accelerations, start=None):
+    """Total motion time to visit positions ((N, motors) array) in order"""
+    positions = numpy.asarray(positions, dtype=float)
+
+    if start is not None:
+        positions = numpy.vstack((start, positions))
+
+    if len(positions) < 2:
+        return 0.0
+
+    delta = numpy.diff(positions, axis=0)
+    times = numpy.zeros(len(delta))
+    for axis, (v, a) in enumerate(zip(velocities, accelerations)):
+        times = numpy.maximum(times, moveTime(delta[:, axis], v, a))
+
+    return float(times.sum())
+
+def gridOrder(shape, fastAxis, pattern):
+    """Visiting order of a grid as an (N, 2) array with the index on each
+    axis. shape has the number of positions of axis 0 and axis 1"""
+    slowAxis = 1 - fastAxis
+    nFast = shape[fastAxis]
+    nSlow = shape[slowAxis]
+    order = []
+
+    if pattern == 'spiral':
+        # Walk the border of the remaining rectangle, moving inwards
+        lo = [0, 0]
+        hi = [shape[0] - 1, shape[1] - 1]
+        f, s = fastAxis, slowAxis
+        while lo[0] <= hi[0] and lo[1] <= hi[1]:
+            ring = []
+            for k in range(lo[f], hi[f] + 1):
+                ring.append({f: k, s: lo[s]})
+            for k in range(lo[s] + 1, hi[s] + 1):
+                ring.append({f: hi[f], s: k})
+            if lo[s] < hi[s]:
+                for k in range(hi[f] - 1, lo[f] - 1, -1):
+                    ring.append({f: k, s: hi[s]})
+            if lo[f] < hi[f]:
+                for k in range(hi[s] - 1, lo[s], -1):
+                    ring.append({f: lo[f], s: k})
+            order.extend((p[0], p[1]) for p in ring)
+            lo = [lo[0] + 1, lo[1] + 1]
+            hi = [hi[0] - 1, hi[1] - 1]
+    else:
+        fast = list(range(nFast))
+        for k in range(nSlow):
+            for j in fast:
+                if fastAxis == 0:
+                    order.append((j, k))
+                else:
+                    order.append((k, j))
+            if pattern == 'snake':
+                fast.reverse()
+
+    return numpy.array(order, dtype=int).reshape(-1, 2)
+
+def optimizeGrid(axes, velocities, accelerations=(None, None), start=None,
+                 patterns=PATTERNS):
+    """Find the fastest way to visit the grid formed by axes (positions of
+    motor 0 and motor 1). Returns (points, logical, fastAxis, pattern, time),
+    where points has one list of positions per motor in visiting order and
+    logical is the index of each visited point when the grid is read with
+    motor 1 as the outer loop and motor 0 as the inner loop."""
+    axes = [numpy.asarray(a, dtype=float) for a in axes]
+    shape = (len(axes[0]), len(axes[1]))
+    best = None
+
+    for fastAxis in (0, 1):
+        for pattern in patterns:
+            order = gridOrder(shape, fastAxis, pattern)
+            positions = numpy.column_stack((axes[0][order[:, 0]],
+                                            axes[1][order[:, 1]]))
+            t = pathTime(positions, velocities, accelerations, start)
+
+            if best is None or t < best[0]:
+                best = (t, fastAxis, pattern, order, positions)
+
+    t, fastAxis, pattern, order, positions = best
+    logical = order[:, 1]*shape[0] + order[:, 0]
+
+    return ([positions[:, 0].tolist(), positions[:, 1].tolist()], logical,
+            fastAxis, pattern, t)
+
+def _costFrom(positions, i, targets, velocities, accelerations):
+    delta = positions[targets] - positions[i]
+    times = numpy.zeros(len(targets))
+    for axis, (v, a) in enumerate(zip(velocities, accelerations)):
+        times = numpy.maximum(times, moveTime(delta[:, axis], v, a))
+
+    return times
+
+def nearestNeighbour(positions, velocities, accelerations, start=None):
+    positions = numpy.asarray(positions, dtype=float)
+    n = len(positions)
+
+    if start is not None:
+        positions = numpy.vstack((start, positions))
+        current = 0
+        remaining = numpy.arange(1, n + 1)
+    else:
+        current = 0
+        remaining = numpy.arange(1, n)
+
+    order = [] if start is not None else [0]
+    while len(remaining):
+        cost = _costFrom(positions, current, remaining, velocities,
+                         accelerations)
+        k = int(numpy.argmin(cost))
+        current = remaining[k]
+        order.append(current)
+        remaining = numpy.delete(remaining, k)
+
+    order = numpy.array(order, dtype=int)
+    return order - 1 if start is not None else order
+
+def twoOpt(positions, order, velocities, accelerations, start=None,
+           maxPasses=10):
+    """Improve an open path by reversing segments while it gets faster"""
+    positions = numpy.asarray(positions, dtype=float)
+    offset = 0
+
+    # A fixed start point is handled as node 0, which never moves
+    if start is not None:
+        positions = numpy.vstack((start, positions))
+        order = numpy.concatenate(([0], numpy.asarray(order) + 1))
+        offset = 1
+    else:
+        order = numpy.array(order, dtype=int)
+
+    n = len(order)
+    for _ in range(maxPasses):
+        improved = False
+        for i in range(max(1, offset), n - 1):
+            a = order[i - 1]
+            b = order[i]
+            js = numpy.arange(i + 1, n)
+            c = order[js]
+            before = _costFrom(positions, a, [b], velocities, accelerations)[0]
+            before = before + _pairCost(positions, c, order, js, velocities,
+                                        accelerations)
+            after = _costFrom(positions, a, c, velocities, accelerations)
+            after = after + _pairCost(positions, numpy.full(len(js), b),
+                                      order, js, velocities, accelerations)
+            gain = before - after
+            k = int(numpy.argmax(gain))
+            if gain[k] > 1e-12:
+                j = js[k]
+                order[i:j + 1] = order[i:j + 1][::-1].copy()
+                improved = True
+        if not improved:
+            break
+
+    return order[offset:] - offset
+
+# Cost of moving from nodes to the successor of each position js in order (zero
+# at the end of the path)
+def _pairCost(positions, nodes, order, js, velocities, accelerations):
+    cost = numpy.zeros(len(js))
+    hasNext = js + 1 < len(order)
+    if not hasNext.any():
+        return cost
+
+    delta = positions[order[js[hasNext] + 1]] - positions[nodes[hasNext]]
+    times = numpy.zeros(int(hasNext.sum()))
+    for axis, (v, a) in enumerate(zip(velocities, accelerations)):
+        times = numpy.maximum(times, moveTime(delta[:, axis], v, a))
+    cost[hasNext] = times
+
+    return cost
+
+# 2-opt is quadratic on the number of points, larger lists only use nearest
+# neighbour ordering
+MAX_TWO_OPT_POINTS = 2000
+
+def optimizePoints(points, velocities, accelerations=None, start=None):
+    """Order an arbitrary point list. points has one list of positions per
+    motor. Returns (points, logical, time): points in visiting order and the
+    index in the original list of each visited point"""
+    positions = numpy.column_stack([numpy.asarray(p, dtype=float)
+                                    for p in points])
+    if accelerations is None:
+        accelerations = [None]*len(points)
+
+    order = nearestNeighbour(positions, velocities, accelerations, start)
+    if len(order) <= MAX_TWO_OPT_POINTS:
+        order = twoOpt(positions, order, velocities, accelerations, start)
+
+    # Never return a path slower than the original one
+    original = numpy.arange(len(positions))
+    if pathTime(positions[original], velocities, accelerations, start) <= \
+       pathTime(positions[order], velocities, accelerations, start):
+        order = original
+
+    t = pathTime(positions[order], velocities, accelerations, start)
+    return [positions[order, k].tolist() for k in range(len(points))], order, t
+
+def snakeIndex(logical, pointsPerLine):
+    """Convert logical grid indexes (as returned by optimizeGrid) to indexes
+    in the snake order created by generatePointsSnake"""
+    logical = numpy.asarray(logical)
+    line = logical//pointsPerLine
+    point = logical % pointsPerLine
+    point = numpy.where(line % 2 == 1, pointsPerLine - 1 - point, point)
+
+    return line*pointsPerLine + point
+
+def restoreLogicalOrder(data, logical, skip=('points',)):
+    """Reorder, in place, every per point list in data (as returned by
+    getScanData) from visiting order to logical order"""
+    logical = numpy.asarray(logical)
+    inverse = numpy.argsort(logical)
+    n = len(logical)
+
+    for key, value in data.items():
+        if key in skip or not isinstance(value, list) or len(value) != n:
+            continue
+        value[:] = [value[i] for i in inverse]
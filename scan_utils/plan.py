@@ -0,0 +1,99 @@
+"""Helpers to check a list of scans before moving anything: all trajectories
+are validated against motor soft limits at once and the total time is
+estimated from motor velocities and acquisition times"""
+import numpy
+
+def motorLimits(device):
+    """Return (low, high) soft limits of a device, infinite when unknown"""
+    try:
+        low = device.getLowLimitValue()
+        high = device.getHighLimitValue()
+    except AttributeError:
+        return float('-inf'), float('inf')
+
+    if low is None:
+        low = float('-inf')
+    if high is None:
+        high = float('inf')
+
+    return float(low), float(high)
+
+def motorVelocity(device):
+    """Return the device velocity, or None when not available"""
+    try:
+        v = device.getVelocity()
+    except AttributeError:
+        return None
+
+    if not v:
+        return None
+
+    return abs(float(v))
+
+def motorAcceleration(device):
+    """Return the time the device takes to reach full velocity, or None when
+    not available"""
+    try:
+        a = device.getAcceleration()
+    except AttributeError:
+        return None
+
+    if not a:
+        return None
+
+    return abs(float(a))
+
+def validateLimits(trajectories, limits):
+    """Check all points of all trajectories in a single vectorized pass.
+    trajectories is a list of (tag, motor, positions) and limits maps each
+    motor to (low, high). Returns a list of (tag, motor, position, low, high)
+    with every point outside the limits"""
+    if len(trajectories) == 0:
+        return []
+
+    motors = sorted(limits)
+    motorIndex = dict((m, i) for i, m in enumerate(motors))
+    low = numpy.array([limits[m][0] for m in motors], dtype=float)
+    high = numpy.array([limits[m][1] for m in motors], dtype=float)
+
+    lengths = [len(t[2]) for t in trajectories]
+    positions = numpy.concatenate([numpy.asarray(t[2], dtype=float)
+                                   for t in trajectories])
+    owner = numpy.repeat(numpy.arange(len(trajectories)), lengths)
+    which = numpy.repeat([motorIndex[t[1]] for t in trajectories], lengths)
+
+    bad = (positions < low[which]) | (positions > high[which]) | \
+          numpy.isnan(positions)
+
+    violations = []
+    for i in numpy.flatnonzero(bad):
+        tag, motor, _ = trajectories[owner[i]]
+        violations.append((tag, motor, float(positions[i]),
+                           float(low[which[i]]), float(high[which[i]])))
+
+    return violations
+
+def estimateTime(positions, times, velocities, sleep=0, start=None):
+    """Estimate scan duration in seconds. positions has one array per motor
+    (all with the same length), times is the acquisition time of each point
+    and velocities the velocity of each motor (None when unknown). Motors move
+    together, so each move takes the time of the slowest motor. If start
+    positions are given, the move to the first point is included"""
+    times = numpy.abs(numpy.asarray(times, dtype=float))
+    total = times.sum() + sleep*len(times)
+
+    moves = numpy.zeros(len(times))
+    for i, (p, v) in enumerate(zip(positions, velocities)):
+        if v is None:
+            continue
+
+        p = numpy.asarray(p, dtype=float)
+        if start is not None:
+            p = numpy.concatenate(([start[i]], p))
+        else:
+            p = numpy.concatenate((p[:1], p))
+
+        delta = numpy.abs(numpy.diff(p))
+        moves = numpy.maximum(moves, delta/v)
+
+    return float(total + moves.sum())
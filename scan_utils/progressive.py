@@ -0,0 +1,97 @@
+"""Progressive (coarse to fine) 2d maps
+
+Instead of filling the map line by line, points are visited in levels: the
+first level takes every 2**(levels-1)th position of both motors and each
+following level halves the spacing, visiting only points not taken yet. Each
+level is visited in snake order.
+
+After each level a preview of the whole map is written, where points not
+measured yet take the value of the measured point of the coarser grid that
+covers them, so a complete (lower resolution) map is available from the end
+of the first level on. The scan may be stopped at the end of the current
+level and refinement can be restricted to regions of interest with a mask
+(the first level always covers the whole map)."""
+import os
+from numbers import Number
+
+import numpy
+
+from .path_optimizer import snakeIndex
+
+def levelStrides(levels):
+    """Spacing between points of each level, coarse to fine"""
+    return [2**l for l in range(levels - 1, -1, -1)]
+
+def progressiveOrder(lines, pointsPerLine, levels, refine=None):
+    """Return the snake order indexes (as created by generatePointsSnake) of
+    the points in visiting order and the number of points of each level.
+    refine is an optional boolean (lines, pointsPerLine) array with the points
+    that may be visited after the first level"""
+    line, point = numpy.indices((lines, pointsPerLine))
+    taken = numpy.zeros((lines, pointsPerLine), dtype=bool)
+    order = []
+    sizes = []
+
+    for level, stride in enumerate(levelStrides(levels)):
+        visit = (line % stride == 0) & (point % stride == 0) & ~taken
+        if level > 0 and refine is not None:
+            visit &= refine
+        taken |= visit
+
+        n = 0
+        for i, l in enumerate(numpy.flatnonzero(visit.any(axis=1))):
+            points = numpy.flatnonzero(visit[l])
+            if i % 2 == 1:
+                points = points[::-1]
+            order.extend(l*pointsPerLine + points)
+            n += len(points)
+        if n:
+            sizes.append(n)
+
+    return snakeIndex(numpy.array(order, dtype=int), pointsPerLine), sizes
+
+class ProgressiveMap():
+    '''Counter values of a progressive map on the full grid, written to a
+    .npz file with one (lines, pointsPerLine) array per counter'''
+    def __init__(self, fileName, lines, pointsPerLine, levels):
+        self.fileName = fileName
+        self.lines = lines
+        self.pointsPerLine = pointsPerLine
+        self.levels = levels
+        self.values = {}
+
+    def add(self, name, index, value):
+        """Store the value of the point with the given snake order index"""
+        if not isinstance(value, Number) or isinstance(value, bool):
+            return
+
+        if name not in self.values:
+            self.values[name] = numpy.full((self.lines, self.pointsPerLine),
+                                           numpy.nan)
+
+        line, point = divmod(index, self.pointsPerLine)
+        if line % 2 == 1:
+            point = self.pointsPerLine - 1 - point
+        self.values[name][line, point] = value
+
+    def filled(self, name):
+        """Map where points not measured take the value of the measured
+        point of the coarsest level covering them"""
+        values = self.values[name]
+        result = numpy.full_like(values, numpy.nan)
+
+        for stride in levelStrides(self.levels):
+            anchors = values[::stride, ::stride]
+            expanded = anchors.repeat(stride, axis=0).repeat(stride, axis=1)
+            expanded = expanded[:self.lines, :self.pointsPerLine]
+            result = numpy.where(numpy.isnan(expanded), result, expanded)
+
+        return result
+
+    def save(self):
+        # Replace the file at once, so readers never see a partial map
+        temporary = self.fileName + '.tmp'
+        with open(temporary, 'wb') as f:
+            numpy.savez(f, **dict((name, self.filled(name))
+                                  for name in self.values))
+        os.replace(temporary, self.fileName)
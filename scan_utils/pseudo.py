@@ -0,0 +1,94 @@
+"""Precompute real motor trajectories of pseudo motor scans
+
+Pseudo motor target expressions are compiled once and evaluated over the
+whole trajectory with NumPy, giving one array of targets per real motor.
+Targets are given to the expressions as T (and by the pseudo motor name) and
+other dependencies by their current position. Pseudo motors targeting other
+pseudo motors are expanded recursively.
+
+A trajectory is only used if the pseudo motor position expression, evaluated
+over the real motor arrays, gives back the requested points. Otherwise (for
+example, expressions that need py4syn objects) the scan falls back to moving
+the pseudo motor point by point."""
+from collections import OrderedDict
+
+import numpy
+
+# Functions available to expressions, vectorized
+MATH = dict((f, getattr(numpy, f)) for f in (
+    'sin', 'cos', 'tan', 'arcsin', 'arccos', 'arctan', 'arctan2', 'sqrt',
+    'exp', 'log', 'log10', 'abs', 'radians', 'degrees', 'pi'))
+MATH.update({'asin': numpy.arcsin, 'acos': numpy.arccos, 'atan': numpy.arctan,
+             'atan2': numpy.arctan2, 'fabs': numpy.abs})
+
+# Maximum difference between requested points and the position computed back
+# from the real motor trajectories
+ROUND_TRIP_TOLERANCE = 1e-6
+
+class TrajectoryError(ValueError):
+    pass
+
+def isPseudo(name, configuration):
+    return configuration['motors'][name]['type'] == 'pseudo'
+
+def evaluate(expression, namespace, length, label):
+    try:
+        code = compile(str(expression), label, 'eval')
+        value = eval(code, {'__builtins__': {}}, namespace)
+        return numpy.asarray(value, dtype=float) + numpy.zeros(length)
+    except Exception as e:
+        raise TrajectoryError('Unable to evaluate %s: %s' % (label, e)) from None
+
+def expandTrajectory(name, points, configuration, devices):
+    """Return an ordered mapping from each real motor to its target array
+    for the given pseudo motor points"""
+    info = configuration['motors'][name]
+    targets = numpy.asarray(points, dtype=float)
+
+    namespace = dict(MATH)
+    for dependency in info.get('dependencies', []):
+        namespace[dependency] = devices[dependency].getRealPosition()
+    namespace['T'] = targets
+    namespace[name] = targets
+
+    real = OrderedDict()
+    for motor in sorted(info['targets']):
+        value = evaluate(info['targets'][motor], namespace, len(targets),
+                         '%s target for %s' % (name, motor))
+
+        if isPseudo(motor, configuration):
+            real.update(expandTrajectory(motor, value, configuration, devices))
+        else:
+            real[motor] = value
+
+    return real
+
+def pseudoPosition(name, real, configuration, devices, length):
+    """Evaluate the pseudo motor position expression over real trajectories"""
+    info = configuration['motors'][name]
+
+    namespace = dict(MATH)
+    for dependency in info.get('dependencies', []):
+        if dependency in real:
+            namespace[dependency] = real[dependency]
+        elif isPseudo(dependency, configuration):
+            namespace[dependency] = pseudoPosition(dependency, real,
+                                                   configuration, devices, length)
+        else:
+            namespace[dependency] = devices[dependency].getRealPosition()
+
+    return evaluate(info['position'], namespace, length, '%s position' % name)
+
+def realTrajectory(name, points, configuration, devices):
+    """Compute and check the real motor trajectories of a pseudo motor scan.
+    Raises TrajectoryError if they can't be computed or don't map back to the
+    requested points"""
+    real = expandTrajectory(name, points, configuration, devices)
+    back = pseudoPosition(name, real, configuration, devices, len(points))
+    error = numpy.max(numpy.abs(back - numpy.asarray(points, dtype=float)))
+
+    if not error <= ROUND_TRIP_TOLERANCE*max(1, numpy.max(numpy.abs(points))):
+        raise TrajectoryError('Real motor trajectories of %s do not map back '
+                              'to the requested points (error %g)' % (name, error))
+
+    return real
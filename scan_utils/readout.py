@@ -0,0 +1,161 @@
+"""Per point counter readout
+
+Counters are grouped by physical device, so each device is read only once per
+point (devices with a getValues method read all their channels with a single
+request), and independent devices are read concurrently. Pseudo counters
+depend on the other values, so they are read last.
+
+Plain py4syn scans use ScanReadout, which replaces the sequential
+getCountersData of the scan and reads the position of the scanned devices only
+once per point."""
+import collections.abc
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from epics import ca
+from py4syn import counterDB
+from py4syn.epics.PseudoCounterClass import PseudoCounter
+from py4syn.utils import counter
+import py4syn.utils.scan as scanModule
+
+def groupCounters(counters):
+    """Group enabled counters by device. Returns an ordered mapping from
+    device to a list of (name, channel, factor)"""
+    groups = OrderedDict()
+
+    for name, info in counters.items():
+        if not info.get('enable', True):
+            continue
+
+        groups.setdefault(info['device'], []).append(
+            (name, info.get('channel'), info.get('factor', 1)))
+
+    return groups
+
+def readDevice(device, entries):
+    """Read all channels used from device. Returns a dictionary with the value
+    of each counter"""
+    # Worker threads must share the CA context created by the main thread
+    ca.use_initial_context()
+
+    if len(entries) > 1 and hasattr(device, 'getValues'):
+        values = device.getValues([channel for _, channel, _ in entries])
+    else:
+        values = [device.getValue(channel=channel) for _, channel, _ in entries]
+
+    data = {}
+    for (name, channel, factor), v in zip(entries, values):
+        # Fall back to a single read when the grouped read failed
+        if v is None:
+            v = device.getValue(channel=channel)
+        if factor != 1 and v is not None:
+            v = v*factor
+        data[name] = v
+
+    return data
+
+class Readout():
+    '''Read all counters of counterDB, replacing getCountersData'''
+    def __init__(self, counters=None, maxWorkers=8):
+        groups = groupCounters(counterDB if counters is None else counters)
+
+        self.pseudo = [(d, e) for d, e in groups.items()
+                       if isinstance(d, PseudoCounter)]
+        self.devices = [(d, e) for d, e in groups.items()
+                        if not isinstance(d, PseudoCounter)]
+
+        if len(self.devices) > 1:
+            self.executor = ThreadPoolExecutor(min(len(self.devices), maxWorkers))
+        else:
+            self.executor = None
+
+    def read(self):
+        data = {}
+
+        if self.executor is None:
+            for device, entries in self.devices:
+                data.update(readDevice(device, entries))
+        else:
+            futures = [self.executor.submit(readDevice, device, entries)
+                       for device, entries in self.devices]
+            for f in futures:
+                data.update(f.result())
+
+        for device, entries in self.pseudo:
+            data.update(readDevice(device, entries))
+
+        return data
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+def waitCounters(countTime, idxs):
+    """Wait for the counters to finish the point and stop them, like py4syn
+    does before reading them"""
+    if isinstance(countTime, collections.abc.Iterable):
+        countTime = countTime[int(idxs[-1])]
+
+    counter.waitAll(monitor=countTime < 0)
+    counter.stopAll()
+
+class ScanReadout():
+    '''Readout of a plain py4syn scan. py4syn reads the counters one by one
+    and the position of each scanned device twice after every move (for the
+    callback positions and for the scan data)'''
+    def __init__(self):
+        self.readout = None
+        self.devices = []
+
+    def attach(self, scan):
+        """Hook into a py4syn scan object, replacing its counter save step and
+        caching positions. Must be attached before the other hooks (dwell,
+        control, retry), which wrap the save step"""
+        self.close()
+        self.readout = Readout()
+
+        def saveCounterData(*args, **kwargs):
+            waitCounters(scan.getCountTime(), kwargs['idx'])
+            for k, v in self.readout.read().items():
+                scanModule.SCAN_DATA[k].append(v)
+
+        scan._Scan__saveCounterData = saveCounterData
+
+        # Positions are read once the devices stop, and kept until they move
+        # again
+        self.devices = [param.getDevice() for param in scan.getScanParams()]
+        positions = {}
+        wait = scan._Scan__waitDevices
+
+        def waitDevices(*args, **kwargs):
+            wait(*args, **kwargs)
+            positions.clear()
+            for device in self.devices:
+                positions[id(device)] = type(device).getValue(device)
+
+        for device in self.devices:
+            def getValue(*args, device=device, **kwargs):
+                if args or kwargs or id(device) not in positions:
+                    return type(device).getValue(device, *args, **kwargs)
+                return positions[id(device)]
+
+            def setValue(*args, device=device, **kwargs):
+                positions.pop(id(device), None)
+                return type(device).setValue(device, *args, **kwargs)
+
+            device.getValue = getValue
+            device.setValue = setValue
+
+        scan._Scan__waitDevices = waitDevices
+
+    def close(self):
+        """Restore the devices and stop the readout threads"""
+        for device in self.devices:
+            device.__dict__.pop('getValue', None)
+            device.__dict__.pop('setValue', None)
+        self.devices = []
+
+        if self.readout is not None:
+            self.readout.close()
+            self.readout = None
@@ -0,0 +1,87 @@
+"""Streaming statistics of repeated scans (--count)
+
+Every counter value is accumulated as soon as it is acquired, using Welford's
+algorithm, so the mean and variance of each point are always available and
+repetitions can stop once the relative error of the mean is small enough."""
+from numbers import Number
+
+import numpy
+
+class RepetitionStats():
+    '''Running mean and variance of every numeric counter at every point'''
+    def __init__(self, points):
+        self.points = points
+        self.count = {}
+        self.mean = {}
+        self.m2 = {}
+
+    def add(self, name, index, value):
+        # NaN values come from failed points
+        if not isinstance(value, Number) or isinstance(value, bool) or \
+           value != value:
+            return
+
+        if name not in self.mean:
+            self.count[name] = numpy.zeros(self.points, dtype=int)
+            self.mean[name] = numpy.zeros(self.points)
+            self.m2[name] = numpy.zeros(self.points)
+
+        n = self.count[name][index] + 1
+        delta = value - self.mean[name][index]
+        self.count[name][index] = n
+        self.mean[name][index] += delta/n
+        self.m2[name][index] += delta*(value - self.mean[name][index])
+
+    def variance(self, name):
+        n = self.count[name]
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            return numpy.where(n > 1, self.m2[name]/(n - 1), numpy.nan)
+
+    def standardError(self, name):
+        with numpy.errstate(invalid='ignore'):
+            return numpy.sqrt(self.variance(name)/self.count[name])
+
+    def relativeError(self, name):
+        """Relative standard error of the mean of each point. Points with
+        zero mean are ignored (nan)"""
+        mean = numpy.abs(self.mean[name])
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            return numpy.where(mean > 0, self.standardError(name)/mean, numpy.nan)
+
+    def maxRelativeError(self, names=None):
+        """Worst relative error over all points of the given counters, or
+        infinity while there are not enough repetitions"""
+        worst = 0.0
+
+        for name in (names if names is not None else self.mean):
+            if name not in self.mean:
+                continue
+            # Points never visited (outside a mask) don't count
+            n = self.count[name]
+            if (n[n > 0] < 2).any():
+                return float('inf')
+            e = self.relativeError(name)
+            if not numpy.isnan(e).all():
+                worst = max(worst, float(numpy.nanmax(e)))
+
+        return worst
+
+    def save(self, fileName, positions, motors):
+        """Write positions of each motor, mean and standard error of every
+        counter. Only visited points are written, positions must be given for
+        those, in logical order"""
+        names = sorted(self.mean)
+        columns = [numpy.asarray(p, dtype=float) for p in positions]
+        header = list(motors)
+
+        visited = numpy.zeros(self.points, dtype=bool)
+        for name in names:
+            visited |= self.count[name] > 0
+
+        for name in names:
+            columns.append(self.mean[name][visited])
+            columns.append(self.standardError(name)[visited])
+            header.extend([name, name + '-err'])
+
+        numpy.savetxt(fileName, numpy.column_stack(columns),
+                      header='\t'.join(header), delimiter='\t')
@@ -0,0 +1,214 @@
+"""Record and replay scans
+
+A scan started with --record writes every event published on its event bus
+(points with positions, counter values, spectra and timing, and the scan
+start and end) to a file. The recording can be replayed through the same
+consumers (engine forwarder, GUI, writers) without beam, at the original
+speed, faster or as fast as possible, to measure consumer throughput and
+reproduce performance problems of real runs offline.
+
+ReplayWriters writes the ROI stores, spilled spectra images and XRF maps of
+a replay with the writers used by the scan. Replays don't run the scan
+callbacks again (normalization, progressive maps, repetition statistics,
+fits, catalog), events carry the values as the scan published them. The
+py4syn data file isn't written again, it needs the py4syn scan loop; the
+point values are sent as output lines instead.
+
+A recording is a pickle stream: a header dictionary with the scan arguments,
+motors, counters, configuration and map geometry, followed by the events.
+Event times are kept as recorded. The recorder never slows down the scan,
+events are dropped (and counted) if the disk can't keep up."""
+import pickle
+import threading
+from time import time
+
+from .events import PointEvent, ScanEvent
+from .roi import createRoiStores
+from .spill import createSpectraImages
+from .xrf import createXrfMappers, createXrfExecutor, xrfCounters
+
+# Delay (seconds) after which a replayed event counts as late
+LATE_TOLERANCE = 0.01
+
+class EventRecorder():
+    '''Write every event published on a bus to a file, from its own thread.
+    The queue is large, new events are dropped only if the disk can't keep up
+    for long, never waited for'''
+    def __init__(self, fileName, bus, header, maxsize=100000):
+        self.f = open(fileName, 'wb')
+        pickle.dump(header, self.f, pickle.HIGHEST_PROTOCOL)
+        self.bus = bus
+        self.subscription = bus.subscribe(maxsize, 'drop-newest')
+        self.thread = threading.Thread(target=self.write, daemon=True)
+        self.thread.start()
+
+    def write(self):
+        for event in self.subscription:
+            pickle.dump(event, self.f, pickle.HIGHEST_PROTOCOL)
+
+    def close(self):
+        """Write the queued events and close the file"""
+        self.bus.unsubscribe(self.subscription)
+        self.thread.join()
+        self.f.close()
+
+        if self.subscription.dropped:
+            print('Recording lost %d events' % self.subscription.dropped)
+
+def readRecording(fileName):
+    """Return the header and a generator of the events of a recording"""
+    f = open(fileName, 'rb')
+    try:
+        header = pickle.load(f)
+    except Exception:
+        f.close()
+        raise
+
+    def events():
+        with f:
+            while True:
+                try:
+                    yield pickle.load(f)
+                except EOFError:
+                    return
+
+    return header, events()
+
+def eventTime(event):
+    return event.end if isinstance(event, PointEvent) else event.time
+
+class Replay():
+    '''Publish recorded events on a bus, with the recorded timing divided by
+    speed, or as fast as possible if speed is 0. Has the interrupt, pause and
+    resume commands of a scan'''
+    def __init__(self, events, bus, speed=1.0):
+        self.events = events
+        self.bus = bus
+        self.speed = speed
+        self.running = threading.Event()
+        self.running.set()
+        self.stopped = threading.Event()
+        self.published = 0
+        self.points = 0
+        # Events published after their time, the consumers were too slow
+        self.late = 0
+        self.elapsed = 0
+
+    def run(self):
+        start = time()
+        origin = None
+
+        for event in self.events:
+            if not self.running.is_set():
+                paused = time()
+                self.running.wait()
+                # Time paused doesn't count as delay
+                if origin is not None:
+                    origin = (origin[0] + time() - paused, origin[1])
+            if self.stopped.is_set():
+                break
+
+            if self.speed:
+                if origin is None:
+                    origin = (time(), eventTime(event))
+                wait = origin[0] + (eventTime(event) - origin[1])/self.speed - time()
+                if wait > 0:
+                    self.stopped.wait(wait)
+                elif wait < -LATE_TOLERANCE:
+                    self.late += 1
+
+            self.bus.publish(event)
+            self.published += 1
+            if isinstance(event, PointEvent):
+                self.points += 1
+
+        self.elapsed = time() - start
+
+    def interrupt(self):
+        self.stopped.set()
+        self.running.set()
+
+    def pause(self):
+        self.running.clear()
+
+    def resume(self):
+        self.running.set()
+
+    def summary(self):
+        rate = self.points/self.elapsed if self.elapsed > 0 else float('inf')
+        return ('Replayed %d events (%d points) in %.3fs, %.1f points/s, '
+                '%d late' % (self.published, self.points, self.elapsed, rate,
+                             self.late))
+
+class ReplayWriters():
+    '''Write the outputs of a recorded scan again from its replayed events,
+    with the scan writers (ROI stores, spilled spectra images and XRF maps),
+    to files named after prefix like the scan outputs'''
+    def __init__(self, header, prefix):
+        if 'configuration' not in header:
+            raise ValueError('The recording has no configuration, outputs '
+                             'can\'t be written')
+
+        self.header = header
+        self.prefix = prefix
+        self.executor = None
+        self.roiStores = {}
+        self.spectraImages = {}
+        self.xrfMappers = {}
+
+    def open(self, repetition):
+        header = self.header
+        configuration = header['configuration']
+        counters = header['counters']
+        prefix = self.prefix
+        if header['args'].get('count', 1) > 1:
+            prefix += '_%d' % (repetition + 1)
+
+        self.roiStores = createRoiStores(counters, configuration, prefix)
+        self.spectraImages = createSpectraImages(counters, configuration,
+                                                 prefix, header['lines'],
+                                                 header['pointsPerLine'],
+                                                 header['image'])
+        if xrfCounters(counters, configuration):
+            if self.executor is None:
+                self.executor = createXrfExecutor(
+                    configuration['misc'].get('xrf-workers'))
+            self.xrfMappers = createXrfMappers(counters, configuration, prefix,
+                                               self.executor, header['lines'],
+                                               header['pointsPerLine'],
+                                               header['image'])
+
+    def add(self, event):
+        for name, value in event.arrays.items():
+            if name in self.roiStores:
+                self.roiStores[name].add(event.natural, value)
+            if name in self.spectraImages:
+                self.spectraImages[name].addSpectrum(event.natural, value)
+            if name in self.xrfMappers:
+                self.xrfMappers[name].add(event.natural, value, event.countTime)
+
+    def closeAll(self):
+        for writer in (list(self.roiStores.values()) +
+                       list(self.spectraImages.values()) +
+                       list(self.xrfMappers.values())):
+            writer.close()
+
+        self.roiStores = {}
+        self.spectraImages = {}
+        self.xrfMappers = {}
+
+    def write(self, subscription):
+        """Write the events of subscription until it is closed"""
+        try:
+            for event in subscription:
+                if isinstance(event, PointEvent):
+                    self.add(event)
+                elif isinstance(event, ScanEvent) and event.kind == 'start':
+                    self.closeAll()
+                    self.open(event.repetition)
+                elif isinstance(event, ScanEvent) and event.kind == 'end':
+                    self.closeAll()
+        finally:
+            self.closeAll()
+            if self.executor is not None:
+                self.executor.shutdown()
@@ -0,0 +1,157 @@
+"""Point level retry and fault isolation
+
+A step of a point that fails (moving the motors, counting, reading the
+counters) is tried again with exponential backoff. If every attempt fails the
+point is marked failed instead of aborting the scan: its counter values are
+NaN, the failed column is 1 and the scan goes on with the next point.
+
+Delays are configured in the misc section:
+
+    misc:
+      retry-delay: 0.5       # seconds before the first retry, doubled after
+      retry-max-delay: 10    # each one up to this value
+"""
+from time import sleep
+
+from py4syn import counterDB
+from py4syn.utils.scan import createUserDefinedDataField
+import py4syn.utils.scan as scanModule
+
+FAILED = 'failed'
+
+class PointFailed(Exception):
+    pass
+
+class PointRetry():
+    '''Retry failed point steps and isolate points that keep failing'''
+    def __init__(self, retries=3, delay=0.5, maxDelay=10):
+        self.retries = retries
+        self.delay = delay
+        self.maxDelay = maxDelay
+        # Visited index and error of each failed point
+        self.failed = []
+        # Data lists filled by counting a point
+        self.countedLists = set()
+        createUserDefinedDataField(FAILED)
+
+    def retry(self, step, error, function, *args, **kwargs):
+        """Call function again after it failed with error, up to the number of
+        retries. Raises PointFailed if every attempt fails"""
+        delay = self.delay
+
+        for attempt in range(self.retries):
+            print('%s failed (%s), retrying in %gs' % (step, error, delay))
+            sleep(delay)
+            delay = min(2*delay, self.maxDelay)
+
+            try:
+                return function(*args, **kwargs)
+            except Exception as e:
+                error = e
+
+        raise PointFailed('%s failed: %s' % (step, error))
+
+    def run(self, step, function, *args, **kwargs):
+        try:
+            return function(*args, **kwargs)
+        except Exception as e:
+            return self.retry(step, e, function, *args, **kwargs)
+
+    def mark(self):
+        """Lengths of the data lists before a point is counted"""
+        return dict((k, len(v)) for k, v in scanModule.SCAN_DATA.items()
+                    if isinstance(v, list) and k not in ('points', FAILED))
+
+    def counted(self, mark):
+        """Remember which lists were filled by counting, after a point was
+        counted successfully"""
+        self.countedLists = set(k for k, n in mark.items()
+                                if len(scanModule.SCAN_DATA[k]) > n)
+
+    def markFailed(self, pointIdx, error, mark):
+        """Replace partial data of the point by NaN"""
+        print('Point %d failed: %s' % (pointIdx, error))
+        self.failed.append((pointIdx, str(error)))
+
+        data = scanModule.SCAN_DATA
+        for k, n in mark.items():
+            del data[k][n:]
+
+        for k in (self.countedLists or set(mark) & set(counterDB)):
+            if len(data[k]) < len(data['points']):
+                data[k].append(float('nan'))
+
+    def record(self, failed):
+        scanModule.SCAN_DATA[FAILED].append(int(failed))
+
+    def attach(self, scan):
+        """Hook into a py4syn scan object, like ScanControl.attach. Must be
+        attached after the control, so paused points are not counted as
+        failures. Moves are retried when waiting for the motors fails"""
+        self.failed = []
+
+        waitDevices = scan._Scan__waitDevices
+        launch = scan._Scan__launchCounters
+        save = scan._Scan__saveCounterData
+        state = {'point': None}
+
+        def startPoint():
+            pointIdx = len(scanModule.SCAN_DATA['points']) - 1
+            if state['point'] != pointIdx:
+                state.update(point=pointIdx, error=None)
+
+            return pointIdx
+
+        def moveDevices(pointIdx, *args, **kwargs):
+            for param in scan.getScanParams():
+                param.getDevice().setValue(param.getPoints()[pointIdx])
+            waitDevices(*args, **kwargs)
+
+        def waitDevicesRetry(*args, **kwargs):
+            pointIdx = startPoint()
+            try:
+                waitDevices(*args, **kwargs)
+            except Exception as e:
+                try:
+                    self.retry('Moving', e, moveDevices, pointIdx, *args,
+                               **kwargs)
+                except PointFailed as failure:
+                    state['error'] = failure
+
+        def launchCounters(*args, **kwargs):
+            startPoint()
+            state['mark'] = self.mark()
+            state['launch'] = (args, kwargs)
+            if state['error'] is None:
+                try:
+                    self.run('Starting count', launch, *args, **kwargs)
+                except PointFailed as e:
+                    state['error'] = e
+
+        def count(*args, **kwargs):
+            for k, n in state['mark'].items():
+                del scanModule.SCAN_DATA[k][n:]
+            launchArgs, launchKwargs = state['launch']
+            launch(*launchArgs, **launchKwargs)
+            save(*args, **kwargs)
+
+        def saveCounterData(*args, **kwargs):
+            pointIdx = startPoint()
+            if state['error'] is None:
+                try:
+                    save(*args, **kwargs)
+                except Exception as e:
+                    try:
+                        self.retry('Counting', e, count, *args, **kwargs)
+                    except PointFailed as failure:
+                        state['error'] = failure
+
+            if state['error'] is None:
+                self.counted(state['mark'])
+            else:
+                self.markFailed(pointIdx, state['error'], state['mark'])
+            self.record(state['error'] is not None)
+
+        scan._Scan__waitDevices = waitDevicesRetry
+        scan._Scan__launchCounters = launchCounters
+        scan._Scan__saveCounterData = saveCounterData
@@ -0,0 +1,176 @@
+"""Region of interest (ROI) engine for spectra counters (dxp, qe65000)
+
+ROIs are computed from the spectra, not by the hardware, so any number of them
+can be defined and they can be redefined after the scan. A RoiStore keeps the
+ROI values of every point but full spectra only every Nth point or when a
+trigger expression fires, which reduces the output volume by orders of
+magnitude.
+
+ROIs are defined in the counter configuration:
+
+    mca1:
+      type: dxp
+      spectra: true
+      rois:
+        Fe: [630, 660]          # bins 630 to 660 (inclusive) of channel 0
+        Cu: [1, 800, 830]       # bins 800 to 830 of channel 1
+      spectra-every: 100        # keep the full spectrum every 100 points
+      spectra-trigger: roi['Fe'] > 1000
+
+Devices of counters with ROIs are built without their own output, so the
+RoiStore files are the only spectra written.
+"""
+import json
+
+import numpy
+
+# Number of points processed at once by roiSums, bounds temporary memory
+CHUNK_POINTS = 4096
+
+def parseRois(definition):
+    """Convert a ROI definition mapping to a list of names and an (R, 3)
+    array of (channel, low, high) bins"""
+    names = sorted(definition)
+    rois = []
+
+    for name in names:
+        r = [int(x) for x in definition[name]]
+        if len(r) == 2:
+            r = [0] + r
+        if len(r) != 3 or r[1] > r[2]:
+            raise ValueError('Invalid ROI %s: %s' % (name, definition[name]))
+        rois.append(r)
+
+    return names, numpy.array(rois, dtype=int).reshape(-1, 3)
+
+def roiSums(spectra, rois):
+    """Sum each ROI of spectra. The last axis of spectra is the bin and the
+    one before it the channel; any leading axes (points, map rows and
+    columns) are kept, so a whole map is processed at once. A single 1d
+    spectrum is handled as one channel. Returns an array with the leading
+    axes and one value per ROI"""
+    spectra = numpy.asarray(spectra)
+    if spectra.ndim == 1:
+        spectra = spectra[numpy.newaxis]
+
+    channels = rois[:, 0]
+    low = numpy.clip(rois[:, 1], 0, spectra.shape[-1])
+    high = numpy.clip(rois[:, 2] + 1, 0, spectra.shape[-1])
+
+    lead = spectra.shape[:-2]
+    flat = spectra.reshape((-1,) + spectra.shape[-2:])
+    result = numpy.empty((len(flat), len(rois)))
+
+    # Prefix sums turn every ROI into a difference of two elements
+    for start in range(0, len(flat), CHUNK_POINTS):
+        chunk = flat[start:start + CHUNK_POINTS]
+        cs = numpy.zeros(chunk.shape[:-1] + (chunk.shape[-1] + 1,))
+        numpy.cumsum(chunk, axis=-1, out=cs[..., 1:])
+        result[start:start + CHUNK_POINTS] = cs[:, channels, high] - \
+                                             cs[:, channels, low]
+
+    return result.reshape(lead + (len(rois),))
+
+class RoiStore():
+    '''Store ROI values of every point and decimated full spectra
+
+    Files created for a prefix:
+        <prefix>_rois.npz      ROI names, definitions, values and point indexes
+        <prefix>_spectra.dat   raw kept spectra, one after another
+        <prefix>_spectra.json  shape, dtype and point index of kept spectra'''
+
+    def __init__(self, prefix, definition, every=0, trigger=None):
+        self.prefix = prefix
+        self.names, self.rois = parseRois(definition)
+        self.every = every
+        self.trigger = trigger
+        self.points = []
+        self.values = []
+        self.kept = []
+        self.shape = None
+        self.dtype = None
+        self.spectraFile = None
+
+    def keep(self, index, values, spectrum):
+        if self.every and index % self.every == 0:
+            return True
+
+        if self.trigger:
+            roi = dict(zip(self.names, values))
+            total = float(spectrum.sum())
+            return bool(eval(self.trigger, {}, {'roi': roi, 'total': total}))
+
+        return False
+
+    def add(self, index, spectrum):
+        spectrum = numpy.asarray(spectrum)
+        if spectrum.ndim == 0:
+            return
+
+        values = roiSums(spectrum, self.rois)
+        self.points.append(index)
+        self.values.append(values)
+
+        if self.keep(index, values, spectrum):
+            if self.spectraFile is None:
+                self.shape = spectrum.shape
+                self.dtype = spectrum.dtype
+                self.spectraFile = open(self.prefix + '_spectra.dat', 'wb')
+            self.spectraFile.write(numpy.ascontiguousarray(spectrum,
+                                   dtype=self.dtype).tobytes())
+            self.kept.append(index)
+
+    def close(self):
+        values = numpy.array(self.values).reshape(-1, len(self.names))
+        numpy.savez(self.prefix + '_rois.npz', names=self.names,
+                    rois=self.rois, values=values,
+                    points=numpy.array(self.points, dtype=int))
+
+        if self.spectraFile is not None:
+            self.spectraFile.close()
+            self.spectraFile = None
+            with open(self.prefix + '_spectra.json', 'w') as f:
+                json.dump({'shape': list(self.shape), 'dtype': self.dtype.str,
+                           'points': self.kept}, f)
+
+def loadRois(prefix):
+    """Return names, point indexes and ROI values stored for prefix"""
+    data = numpy.load(prefix + '_rois.npz')
+    return list(data['names']), data['points'], data['values']
+
+def loadSpectra(prefix):
+    """Return point indexes and a memory mapped array with kept spectra"""
+    with open(prefix + '_spectra.json') as f:
+        info = json.load(f)
+
+    points = numpy.array(info['points'], dtype=int)
+    spectra = numpy.memmap(prefix + '_spectra.dat', dtype=info['dtype'],
+                           mode='r', shape=(len(points),) + tuple(info['shape']))
+
+    return points, spectra
+
+def recomputeRois(prefix, definition):
+    """Compute new ROIs from the spectra kept for prefix. Returns names, point
+    indexes and values"""
+    names, rois = parseRois(definition)
+    points, spectra = loadSpectra(prefix)
+    # Single channel spectra, roiSums takes (points, channels, bins)
+    if spectra.ndim == 2:
+        spectra = spectra[:, numpy.newaxis]
+
+    return names, points, roiSums(spectra, rois)
+
+def createRoiStores(counters, configuration, prefix):
+    """Create a RoiStore for each counter with ROIs in its configuration"""
+    stores = {}
+
+    for name in counters:
+        info = configuration['counters'][name]
+        if 'rois' not in info:
+            continue
+
+        stores[name] = RoiStore('%s_%s' % (prefix, name), info['rois'],
+                                info.get('spectra-every', 0),
+                                info.get('spectra-trigger'))
+
+    return stores
@@ -0,0 +1,111 @@
+"""Run table data
+
+Runs are kept in a NumPy record array, one record per run, with the
+initial, final and step of motor 1 and motor 2 and the counting time in
+milliseconds. Empty values are NaN (motor 2 columns are empty for 1d
+scans). Runs are saved as rows of strings (see qtArgs) and can be imported
+from CSV files with the same columns, with an optional header line."""
+import csv
+
+import numpy
+
+FIELDS = ('initial1', 'final1', 'step1', 'initial2', 'final2', 'step2', 'time')
+HEADERS = ('Initial 1 (mm)', 'Final 1 (mm)', 'Step 1 (mm)', 'Initial 2 (mm)',
+           'Final 2 (mm)', 'Step 2 (mm)', 'Counting Time (ms)')
+RUN_DTYPE = numpy.dtype([(f, float) for f in FIELDS])
+
+def emptyRuns(n):
+    runs = numpy.empty(n, dtype=RUN_DTYPE)
+    for f in FIELDS:
+        runs[f] = numpy.nan
+
+    return runs
+
+def parseValue(text):
+    """Convert a cell text to a value, empty cells are NaN. Raises
+    ValueError for invalid numbers"""
+    text = str(text).strip()
+    if text == '':
+        return numpy.nan
+
+    return float(text)
+
+def formatValue(value):
+    if numpy.isnan(value):
+        return ''
+
+    return '%g' % value
+
+def validateValue(field, value):
+    """Return an error message if value is not acceptable for the field"""
+    if numpy.isnan(value):
+        return None
+    if not numpy.isfinite(value):
+        return 'Value must be finite'
+    if field.startswith('step') and value == 0:
+        return 'Step must not be zero'
+    if field == 'time' and value <= 0:
+        return 'Counting time must be positive'
+
+    return None
+
+def runsFromRows(rows):
+    """Convert rows of strings to runs. Raises ValueError with the row and
+    column of the first invalid value"""
+    runs = emptyRuns(len(rows))
+
+    for i, row in enumerate(rows):
+        for j, field in enumerate(FIELDS):
+            text = row[j] if j < len(row) else ''
+            try:
+                value = parseValue(text)
+            except ValueError:
+                raise ValueError('Row %d, column %d: invalid number "%s"' %
+                                 (i + 1, j + 1, text)) from None
+            error = validateValue(field, value)
+            if error is not None:
+                raise ValueError('Row %d, column %d: %s' % (i + 1, j + 1, error))
+            runs[field][i] = value
+
+    return runs
+
+def runsToRows(runs):
+    return [[formatValue(r[f]) for f in FIELDS] for r in runs]
+
+def loadRunsCsv(fileName):
+    with open(fileName, newline='') as f:
+        rows = [r for r in csv.reader(f) if any(c.strip() for c in r)]
+
+    # Skip header line
+    if rows:
+        try:
+            [parseValue(c) for c in rows[0]]
+        except ValueError:
+            rows = rows[1:]
+
+    return runsFromRows(rows)
+
+def isComplete(runs, twoMotors):
+    """True for runs with every needed value filled"""
+    fields = FIELDS if twoMotors else ('initial1', 'final1', 'step1', 'time')
+    complete = numpy.ones(len(runs), dtype=bool)
+    for f in fields:
+        complete &= ~numpy.isnan(runs[f])
+
+    return complete
+
+def runTimes(runs, twoMotors, extraTime=0):
+    """Expected duration of each run in seconds (NaN for incomplete runs).
+    extraTime (ms) is added to the counting time of each point"""
+    with numpy.errstate(invalid='ignore'):
+        points = numpy.round(numpy.abs((runs['final1'] - runs['initial1']) /
+                                       runs['step1'])) + 1
+        if twoMotors:
+            lines = numpy.round(numpy.abs((runs['final2'] - runs['initial2']) /
+                                          runs['step2'])) + 1
+        else:
+            lines = 1
+
+        times = (runs['time'] + extraTime)/1000*points*lines
+
+    return numpy.where(isComplete(runs, twoMotors), times, numpy.nan)
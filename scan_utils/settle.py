@@ -0,0 +1,119 @@
+"""Wait for motors to settle before each acquisition
+
+Instead of sleeping a fixed time, the motor readback is polled until it stays
+within a tolerance for a time window. Configured per motor:
+
+    sh2y:
+      type: real
+      pv: XRF:DMC2:m1
+      settle:
+        tolerance: 0.0005       # motor units
+        window: 0.1             # seconds
+        timeout: 2              # seconds, fixed sleep is used after timeout
+        poll: 0.01              # seconds between reads
+
+The motors of a point are polled together, windows and timeouts all start
+when the move is done, so the wait is the longest one, not their sum.
+"""
+from collections import deque
+from time import sleep, time
+
+class ReadbackSettle():
+    '''Waits until a readback is stable within tolerance for window seconds'''
+    def __init__(self, name, read, tolerance, window=0.1, timeout=2.0, poll=0.01):
+        self.name = name
+        self.read = read
+        self.tolerance = tolerance
+        self.window = window
+        self.timeout = timeout
+        self.poll = poll
+
+        self.start = None
+        self.samples = deque()
+
+    def begin(self, start=None):
+        self.start = time() if start is None else start
+        self.samples = deque()
+
+    def check(self, now=None):
+        """Read once. Returns True if the readback settled, False on timeout
+        and None if still waiting"""
+        now = time() if now is None else now
+        value = self.read()
+        if value is not None:
+            self.samples.append((now, value))
+
+        # Keep only the samples inside the window (and the last one before
+        # it, which marks that the window is fully covered)
+        samples = self.samples
+        while len(samples) > 1 and samples[1][0] <= now - self.window:
+            samples.popleft()
+
+        if len(samples) > 1 and samples[0][0] <= now - self.window:
+            values = [v for _, v in samples]
+            if max(values) - min(values) <= self.tolerance:
+                return True
+
+        if now - self.start >= self.timeout:
+            return False
+
+        return None
+
+    def wait(self):
+        """Returns True if the readback settled, False on timeout"""
+        self.begin()
+        while True:
+            result = self.check()
+            if result is not None:
+                return result
+            sleep(self.poll)
+
+def createSettlers(motors, configuration, devices):
+    """Create a ReadbackSettle for each motor with settle configuration.
+    devices maps motor names to devices (mtrDB). Returns the settlers and the
+    motors without settle configuration"""
+    settlers = []
+    unconfigured = []
+
+    for name in motors:
+        info = configuration['motors'].get(name, {}).get('settle')
+        if info is None:
+            unconfigured.append(name)
+            continue
+
+        settlers.append(ReadbackSettle(name, devices[name].getRealPosition,
+                                       float(info['tolerance']),
+                                       float(info.get('window', 0.1)),
+                                       float(info.get('timeout', 2.0)),
+                                       float(info.get('poll', 0.01))))
+
+    return settlers, unconfigured
+
+def settle(settlers, fallback, needsFallback=False):
+    """Wait for all settlers at the same time. If some motor isn't
+    configured or didn't settle in time, sleep until the fallback time since
+    the start of the wait has passed"""
+    start = time()
+    for s in settlers:
+        s.begin(start)
+
+    waiting = list(settlers)
+    while waiting:
+        now = time()
+        for s in list(waiting):
+            result = s.check(now)
+            if result is None:
+                continue
+
+            waiting.remove(s)
+            if not result:
+                print('Warning: motor %s did not settle, waiting the rest '
+                      'of the %gs sleep' % (s.name, fallback))
+                needsFallback = True
+
+        if waiting:
+            sleep(min(s.poll for s in waiting))
+
+    # Time spent waiting for the readbacks counts as sleep
+    if needsFallback:
+        sleep(max(0, fallback - (time() - start)))
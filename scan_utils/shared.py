@@ -0,0 +1,67 @@
+"""Pass large arrays (spectra) between processes through shared memory
+
+Arrays are copied into one of a fixed number of slots of a multiprocessing
+RawArray and only the slot number is sent over the pipe. The receiver copies
+the array out and gives the slot back. When every slot is in use the writer
+drops the array instead of blocking the acquisition. Arrays longer than a
+slot are sent through the pipe by the scan engine instead."""
+import multiprocessing
+import queue
+
+import numpy
+
+SLOTS = 16
+# Longest array that fits a slot, in elements
+MAX_LENGTH = 8192
+# Time to wait for a free slot, seconds. Released slots reach the queue
+# through a feeder thread, so they aren't available immediately
+SLOT_WAIT = 0.05
+
+class SharedSlots():
+    '''Fixed number of float64 buffers shared with a child process. Must be
+    created before the child and passed to it as a Process argument'''
+    def __init__(self, slots=SLOTS, length=MAX_LENGTH, context=multiprocessing):
+        self.slots = slots
+        self.length = length
+        self.buffer = context.RawArray('d', slots*length)
+        self.free = context.Queue()
+        for slot in range(slots):
+            self.free.put(slot)
+        self.dropped = 0
+        self._view = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_view'] = None
+        return state
+
+    @property
+    def view(self):
+        # Created on first use in each process
+        if self._view is None:
+            self._view = numpy.frombuffer(self.buffer, dtype=float).reshape(
+                self.slots, self.length)
+        return self._view
+
+    def write(self, values):
+        """Copy values into a free slot. Returns (slot, length), or None if
+        the array was dropped (no free slot or too long)"""
+        values = numpy.asarray(values, dtype=float).ravel()
+        if len(values) > self.length:
+            self.dropped += 1
+            return None
+
+        try:
+            slot = self.free.get(timeout=SLOT_WAIT)
+        except queue.Empty:
+            self.dropped += 1
+            return None
+
+        self.view[slot, :len(values)] = values
+        return slot, len(values)
+
+    def read(self, slot, length):
+        """Copy an array out of its slot and release the slot"""
+        values = self.view[slot, :length].copy()
+        self.free.put(slot)
+        return values
@@ -0,0 +1,157 @@
+"""On-disk storage for spectra collected during a map
+
+Spectra are written directly to a preallocated .npy file, so the scan process
+never holds the whole map in memory (resident memory stays bounded by one
+spectrum plus what the operating system caches). The collected image is read
+back with getImage as a memory mapped array, or later with
+numpy.load(fileName, mmap_mode='r').
+
+The scan wraps spilled devices in SpilledDevice, so startCollectImage,
+stopCollectImage and image keep working for code using the device, with the
+image being the memory mapped file. Each spectrum in the scan data is
+replaced by its (read only) view of the file once written.
+
+Enabled for spectra counters with the "spill" option:
+
+    mca1:
+      type: dxp
+      spectra: true
+      spill: true
+"""
+import numpy
+import numpy.lib.format
+
+class SpectraImage():
+    '''Collects one spectrum per point of a map with the given number of lines
+    (positions of the slow motor) and points per line (positions of the fast
+    motor). For snake scans, points of odd lines are stored reversed, so the
+    image is in logical order. The file is created when the first spectrum
+    arrives, because only then its shape and type are known.'''
+    def __init__(self, fileName, lines, pointsPerLine, snake=False):
+        self.fileName = fileName
+        self.lines = lines
+        self.pointsPerLine = pointsPerLine
+        self.snake = snake
+        self.f = None
+        self.offset = 0
+        self.itemSize = 0
+        self.shape = None
+        self.dtype = None
+        self.view = None
+
+    def create(self, spectrum):
+        self.shape = spectrum.shape
+        self.dtype = spectrum.dtype
+        self.itemSize = spectrum.nbytes
+        shape = (self.lines, self.pointsPerLine) + self.shape
+
+        self.f = open(self.fileName, 'w+b')
+        numpy.lib.format.write_array_header_1_0(self.f, {
+            'descr': numpy.lib.format.dtype_to_descr(self.dtype),
+            'fortran_order': False,
+            'shape': shape,
+        })
+        self.offset = self.f.tell()
+        # Preallocate (sparse) space for the whole map
+        self.f.truncate(self.offset +
+                        self.itemSize*self.lines*self.pointsPerLine)
+        self.f.flush()
+        # Single read only mapping of the file, spectra already written are
+        # handed out as views of it
+        self.view = numpy.memmap(self.fileName, self.dtype, 'r', self.offset,
+                                 shape)
+
+    def addSpectrum(self, index, spectrum):
+        """Write the spectrum of a point and return it as a read only view of
+        the file (None for failed points)"""
+        spectrum = numpy.asarray(spectrum)
+        # Failed points have no spectrum
+        if spectrum.ndim == 0:
+            return
+
+        if self.f is None:
+            self.create(spectrum)
+
+        if index >= self.lines*self.pointsPerLine:
+            raise IndexError('Point %d outside %dx%d image' %
+                             (index, self.lines, self.pointsPerLine))
+
+        line, point = divmod(index, self.pointsPerLine)
+        if self.snake and line % 2 == 1:
+            point = self.pointsPerLine - 1 - point
+
+        position = line*self.pointsPerLine + point
+        self.f.seek(self.offset + position*self.itemSize)
+        self.f.write(numpy.ascontiguousarray(spectrum, dtype=self.dtype).tobytes())
+        self.f.flush()
+
+        return self.view[line, point]
+
+    def spill(self, index, values):
+        """Write the last spectrum of values (the scan data list of the
+        counter) and replace it with its view of the file, so the scan data
+        doesn't keep every spectrum in memory"""
+        slot = self.addSpectrum(index, values[-1])
+        if slot is not None:
+            values[-1] = slot
+
+    def getImage(self):
+        """Return a read only memory mapped (lines, points, ...) array"""
+        if self.f is None:
+            return None
+
+        if not self.f.closed:
+            self.f.flush()
+        return numpy.load(self.fileName, mmap_mode='r')
+
+    def close(self):
+        if self.f is not None:
+            self.f.close()
+
+class SpilledDevice():
+    '''Spectra device whose image is collected by a SpectraImage. Has the
+    collect image methods of the device and image is the memory mapped
+    array, everything else goes to the device'''
+    def __init__(self, device):
+        self.device = device
+        self.spectra = None
+        self.collectImage = False
+
+    def attach(self, spectra):
+        self.spectra = spectra
+
+    def startCollectImage(self, rows=0, cols=0):
+        # The file is created with the first spectrum
+        self.collectImage = True
+
+    def stopCollectImage(self):
+        self.collectImage = False
+        if self.spectra is not None:
+            self.spectra.close()
+
+    @property
+    def image(self):
+        return None if self.spectra is None else self.spectra.getImage()
+
+    def getImage(self):
+        return self.image
+
+    def __getattr__(self, name):
+        return getattr(self.device, name)
+
+def spilledCounters(counters, configuration):
+    """Return the spectra counters with spill enabled"""
+    return [name for name in counters
+            if configuration['counters'][name].get('spectra', False) and
+               configuration['counters'][name].get('spill', False)]
+
+def createSpectraImages(counters, configuration, prefix, lines, pointsPerLine,
+                        snake=False):
+    """Create a SpectraImage for each spectra counter with spill enabled"""
+    images = {}
+
+    for name in spilledCounters(counters, configuration):
+        images[name] = SpectraImage('%s_%s_spectra.npy' % (prefix, name),
+                                    lines, pointsPerLine, snake)
+
+    return images
@@ -0,0 +1,223 @@
+"""Online XRF fitting of spectra counters, producing elemental maps
+
+Spectra are fitted during the scan, in batches, on a pool of worker
+processes: each spectrum is decomposed by linear least squares into the sum
+of reference profiles (one per element, plus background profiles if wanted).
+The pseudo inverse of the reference matrix is computed once, so fitting a
+batch is a single matrix product. Amounts are corrected for dead time with the
+non-paralyzable model, using the total count rate of the spectrum:
+
+    corrected = amount/(1 - dead-time*counts/count-time)
+
+Points where the detector is saturated (no valid correction) are NaN.
+
+Fits are configured in the counter configuration:
+
+    mca1:
+      type: dxp
+      spectra: true
+      xrf:
+        references: /data/refs.npz  # one profile per element, over all bins
+        elements: [Fe, Cu, Zn]      # default: every profile in the file
+        channel: 0                  # detector channel, for 2d spectra
+        range: [100, 2000]          # bins used in the fit (inclusive)
+        dead-time: 1.0e-6           # seconds per count [default: 0]
+        batch: 32                   # spectra per worker task
+        save-interval: 5            # seconds between partial map writes
+
+Maps are written to <output>_<counter>_xrf.npz while the scan runs (at most
+every save-interval seconds, as fits finish) and when it ends, so aborted
+scans still have the maps of the points fitted. There's one (lines, points
+per line) array per element in logical order, NaN for points not fitted yet,
+and the residual sum of squares (chi2). Each fitted point is also published
+on the scan event bus as a FitEvent, for live views.
+
+The number of worker processes (one per CPU by default) is set in the misc
+section:
+
+    misc:
+      xrf-workers: 8
+
+Workers are spawned, like the scan engine: forking a process that runs
+Channel Access threads can deadlock the children on inherited locks.
+"""
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from time import time
+
+import numpy
+
+def loadReferences(fileName, elements=None):
+    """Return element names and an (elements, bins) array of profiles"""
+    with numpy.load(fileName) as f:
+        names = list(elements) if elements else sorted(f.files)
+        missing = [n for n in names if n not in f.files]
+        if missing:
+            raise ValueError('References not found in %s: %s' %
+                             (fileName, ', '.join(missing)))
+
+        return names, numpy.array([f[n] for n in names], dtype=float)
+
+def fitSpectra(projection, references, spectra, factors):
+    """Least squares amount of each reference in each spectrum (one per line),
+    multiplied by the dead-time correction factors. Returns the (spectra,
+    references) amounts and the residual sum of squares of each spectrum"""
+    amounts = spectra @ projection.T
+    residual = spectra - amounts @ references
+    chi2 = numpy.einsum('ij,ij->i', residual, residual)
+
+    return amounts*factors[:, numpy.newaxis], chi2
+
+def createXrfExecutor(workers=None):
+    return ProcessPoolExecutor(workers, multiprocessing.get_context('spawn'))
+
+class XrfMapper():
+    '''Fit the spectra of one counter on an executor, in batches, and collect
+    the elemental maps of a scan with the given number of lines and points
+    per line (snake order indexes, as for SpectraImage)'''
+    def __init__(self, fileName, names, references, executor, lines,
+                 pointsPerLine, snake=False, channel=0, bins=None,
+                 deadTime=0, batch=32, publish=None, saveInterval=5):
+        low, high = bins if bins is not None else (0, references.shape[1] - 1)
+
+        self.fileName = fileName
+        self.names = names
+        self.references = references[:, low:high + 1]
+        self.projection = numpy.linalg.pinv(self.references.T)
+        self.executor = executor
+        self.lines = lines
+        self.pointsPerLine = pointsPerLine
+        self.snake = snake
+        self.channel = channel
+        self.low = low
+        self.high = high
+        self.deadTime = deadTime
+        self.batch = batch
+        self.publish = publish
+        self.saveInterval = saveInterval
+        self.saved = time()
+        self.changed = False
+        # Bound the spectra waiting for workers, acquisition waits if the
+        # pool can't keep up
+        self.maxTasks = 2*(getattr(executor, '_max_workers', None) or 4)
+
+        points = lines*pointsPerLine
+        self.maps = numpy.full((len(names), points), numpy.nan)
+        self.chi2 = numpy.full(points, numpy.nan)
+        self.indexes = []
+        self.spectra = []
+        self.factors = []
+        self.tasks = []
+
+    def correction(self, spectrum, countTime):
+        """Dead-time correction factor, NaN if the detector is saturated"""
+        if self.deadTime <= 0 or countTime <= 0:
+            return 1.0
+
+        loss = 1 - self.deadTime*spectrum.sum()/countTime
+        return 1/loss if loss > 0 else numpy.nan
+
+    def add(self, index, spectrum, countTime):
+        spectrum = numpy.asarray(spectrum, dtype=float)
+        # Failed points have no spectrum
+        if spectrum.ndim == 0:
+            return
+        if spectrum.ndim > 1:
+            spectrum = spectrum[self.channel]
+
+        self.indexes.append(index)
+        self.spectra.append(spectrum[self.low:self.high + 1])
+        self.factors.append(self.correction(spectrum, countTime))
+
+        if len(self.indexes) >= self.batch:
+            self.submit()
+        self.collect()
+
+    def submit(self):
+        if not self.indexes:
+            return
+
+        future = self.executor.submit(fitSpectra, self.projection,
+                                      self.references, numpy.array(self.spectra),
+                                      numpy.array(self.factors))
+        self.tasks.append((future, self.indexes))
+        self.indexes = []
+        self.spectra = []
+        self.factors = []
+
+    def collect(self, wait=False):
+        """Store the results of finished tasks. Waits for every task if wait
+        is set, or for the oldest ones if there are too many"""
+        while self.tasks:
+            future, indexes = self.tasks[0]
+            if not (wait or future.done() or len(self.tasks) > self.maxTasks):
+                break
+
+            amounts, chi2 = future.result()
+            self.tasks.pop(0)
+            self.maps[:, indexes] = amounts.T
+            self.chi2[indexes] = chi2
+            self.changed = True
+
+            if self.publish is not None:
+                for index, values in zip(indexes, amounts):
+                    self.publish(index, dict(zip(self.names, values.tolist())))
+
+        if self.changed and time() - self.saved >= self.saveInterval:
+            self.save()
+
+    def image(self, values):
+        """Values of every point as a (lines, points per line) array"""
+        image = values.reshape(self.lines, self.pointsPerLine).copy()
+        if self.snake:
+            image[1::2] = image[1::2, ::-1]
+
+        return image
+
+    def save(self):
+        # Replace the file at once, so readers never see a partial file
+        maps = dict((name, self.image(m)) for name, m in zip(self.names, self.maps))
+        temporary = self.fileName + '.tmp'
+        with open(temporary, 'wb') as f:
+            numpy.savez(f, names=self.names, chi2=self.image(self.chi2), **maps)
+        os.replace(temporary, self.fileName)
+
+        self.saved = time()
+        self.changed = False
+
+    def close(self):
+        """Fit the remaining spectra and write the maps"""
+        self.submit()
+        self.collect(wait=True)
+        self.save()
+
+def xrfCounters(counters, configuration):
+    """Return the counters with XRF fitting configured"""
+    return [name for name in counters
+            if 'xrf' in configuration['counters'][name]]
+
+def createXrfMappers(counters, configuration, prefix, executor, lines,
+                     pointsPerLine, snake=False, publish=None):
+    """Create an XrfMapper for each counter with XRF fitting configured.
+    publish, if given, is called with the counter name, point index and
+    amounts by element"""
+    mappers = {}
+
+    for name in xrfCounters(counters, configuration):
+        info = configuration['counters'][name]['xrf']
+        names, references = loadReferences(info['references'],
+                                           info.get('elements'))
+        bins = info.get('range')
+
+        mappers[name] = XrfMapper('%s_%s_xrf.npz' % (prefix, name), names,
+                                  references, executor, lines, pointsPerLine,
+                                  snake, info.get('channel', 0),
+                                  tuple(bins) if bins else None,
+                                  float(info.get('dead-time', 0)),
+                                  int(info.get('batch', 32)),
+                                  publish and (lambda i, v, name=name:
+                                               publish(name, i, v)),
+                                  float(info.get('save-interval', 5)))
+
+    return mappers
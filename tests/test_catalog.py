@@ -0,0 +1,57 @@
+import os
+import time
+
+import pytest
+
+# Needs xdg and the device libraries imported by scan_utils.helpers
+catalog = pytest.importorskip('scan_utils.catalog')
+Catalog = catalog.Catalog
+catalogPath = catalog.catalogPath
+counterStats = catalog.counterStats
+outputFiles = catalog.outputFiles
+
+@pytest.fixture
+def database(tmp_path):
+    return Catalog(str(tmp_path / 'db' / 'catalog.sqlite'))
+
+def testCatalogPath():
+    assert catalogPath({'misc': {'catalog': False}}) is None
+    assert catalogPath({'misc': {'catalog': '/tmp/c.sqlite'}}) == '/tmp/c.sqlite'
+    assert catalogPath({'misc': {}}).endswith('catalog.sqlite')
+
+def testCounterStats():
+    assert counterStats([1, 3, float('nan'), 'x', 2], [0, 1, 2, 3, 4]) == \
+           (1.0, 3.0, 2.0, 6.0, 1)
+    assert counterStats(['x']) is None
+
+def testOutputFiles(tmp_path):
+    old = tmp_path / 'scan_0001'
+    old.write_text('')
+    start = time.time() + 1
+    new = tmp_path / 'scan_0002'
+    new.write_text('')
+    os.utime(str(new), (start, start))
+
+    assert outputFiles(str(tmp_path / 'scan'), start) == [str(new)]
+    assert outputFiles(None, 0) == []
+
+def testAddFindRemove(database):
+    first = database.add({'start': 100, 'status': 'ok', 'points': 10,
+                         'command': ['scan', 'x'], 'comment': 'alignment'},
+                        [('x', 0, 1)], [('c', 0, 5, 2, 20, 0.5)])
+    second = database.add({'start': 200, 'status': 'ok', 'points': 5},
+                         [('y', -1, 1)], [('d', 0, 1, 0.5, 2, None)])
+
+    assert [s['id'] for s in database.find()] == [second, first]
+    assert [s['id'] for s in database.find('x', 0.5)] == [first]
+    assert database.find('x', 2) == []
+    assert [s['id'] for s in database.find(counter='d')] == [second]
+    assert [s['id'] for s in database.find(since=150)] == [second]
+    assert [s['id'] for s in database.find(text='align')] == [first]
+
+    scan = database.get(first)
+    assert scan['command'] == ['scan', 'x']
+    assert scan['counters']['c']['peak'] == 0.5
+
+    database.remove(first)
+    assert database.get(first) is None
@@ -0,0 +1,82 @@
+import threading
+
+import pytest
+
+from scan_utils.events import EventBus, Subscription
+
+def testDropOldest():
+    s = Subscription(2, 'drop-oldest')
+    for i in range(4):
+        s.put(i)
+    s.close()
+
+    assert list(s) == [2, 3]
+    assert s.dropped == 2
+
+def testDropNewest():
+    s = Subscription(2, 'drop-newest')
+    for i in range(4):
+        s.put(i)
+    s.close()
+
+    assert list(s) == [0, 1]
+    assert s.dropped == 2
+
+def testBlockWaitsForConsumer():
+    s = Subscription(1, 'block', blockTimeout=5)
+    s.put(0)
+    consumed = []
+    consumer = threading.Thread(target=lambda: consumed.append(s.get()))
+    consumer.start()
+
+    s.put(1)
+    consumer.join()
+    s.close()
+
+    assert consumed == [0]
+    assert list(s) == [1]
+    assert s.dropped == 0
+
+def testBlockTimeout():
+    s = Subscription(1, 'block', blockTimeout=0.01)
+    s.put(0)
+    s.put(1)
+
+    assert s.dropped == 1
+
+def testInvalidPolicy():
+    with pytest.raises(ValueError):
+        Subscription(1, 'wait')
+
+def testBus():
+    bus = EventBus()
+    a = bus.subscribe()
+    b = bus.subscribe()
+    bus.publish(1)
+    bus.unsubscribe(b)
+    bus.publish(2)
+    bus.close()
+
+    assert list(a) == [1, 2]
+    assert list(b) == [1]
+
+def testOutputNeverBlocksScan():
+    scanEngine = pytest.importorskip('scanEngine')
+
+    # The parent stopped reading, sending blocks forever
+    blocked = threading.Event()
+    def send(*event):
+        blocked.wait()
+
+    outbox = Subscription(10)
+    sender = threading.Thread(target=scanEngine.sendQueued, args=(outbox, send))
+    sender.start()
+
+    writer = scanEngine.PipeWriter(lambda *event: outbox.put(event))
+    for i in range(100):
+        writer.write('line %d\n' % i)
+    assert outbox.dropped > 0
+
+    blocked.set()
+    outbox.close()
+    sender.join()
@@ -0,0 +1,46 @@
+import numpy
+
+from scan_utils.fitting import fitCounter, fitAll, formatFits, \
+                               createFitExecutor, numericCounters
+
+X = numpy.linspace(-5, 5, 41)
+
+def testPeak():
+    y = 10*numpy.exp(-(X - 1)**2/2) + 1
+
+    _, results = fitCounter('c', X, y)
+
+    assert numpy.isclose(results['peak']['position'], 1, atol=1e-3)
+    assert numpy.isclose(results['peak']['fwhm'], 2.3548, atol=1e-3)
+    assert results['dropped'] == 0
+
+def testEdge():
+    y = numpy.where(X > 0.5, 2.0, 0.0)
+    _, results = fitCounter('c', X, y)
+
+    assert abs(results['edge']['position'] - 0.5) < 0.2
+
+def testFailedPointsAreDropped():
+    y = list(10*numpy.exp(-X**2/2))
+    y[3] = float('nan')
+    y[20] = float('nan')
+
+    _, results = fitCounter('c', X, y)
+
+    assert results['dropped'] == 2
+    assert abs(results['peak']['position']) < 0.1
+    assert '2 points dropped' in formatFits({'c': results})
+
+def testNumericCounters():
+    data = {'a': [1, 2, 3, 4], 'b': [1, 2, 'x', 4], 'c': [1, 2], 'd': None}
+    assert numericCounters(data, ['a', 'b', 'c', 'd']) == ['a']
+
+def testParallel():
+    data = {'a': list(numpy.exp(-X**2)), 'b': list(numpy.exp(-(X - 2)**2))}
+    executor = createFitExecutor()
+    try:
+        fits = fitAll(list(X), data, ['a', 'b'], executor=executor)
+    finally:
+        executor.shutdown()
+
+    assert numpy.isclose(fits['b']['peak']['position'], 2, atol=1e-3)
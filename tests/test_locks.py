@@ -0,0 +1,74 @@
+import multiprocessing
+
+import pytest
+
+from scan_utils.locks import DeviceLocks, DeviceBusy, motorDevices, \
+                             counterDevices
+
+CONFIGURATION = {
+    'motors': {
+        'x': {'type': 'real', 'pv': 'BL:m1'},
+        'y': {'type': 'real', 'pv': 'BL:m2'},
+        'null': {'type': 'null'},
+        'diag': {'type': 'pseudo', 'targets': {'x': 'T', 'y': 'T'}},
+    },
+    'counters': {
+        'mca1': {'type': 'dxp', 'pv': 'BL:dxp'},
+        'mca2': {'type': 'dxp', 'pv': 'BL:dxp'},
+        'sim': {'type': 'simcountable'},
+        'date': {'type': 'date'},
+        'sum': {'type': 'math', 'formula': 'mca1 + mca2'},
+        'ringcurrent': {'type': 'pv', 'pv': 'LNLS:ANEL:corrente'},
+    },
+}
+
+def testMotorDevices():
+    assert motorDevices('x', CONFIGURATION) == ['BL:m1']
+    assert motorDevices('null', CONFIGURATION) == []
+    assert sorted(motorDevices('diag', CONFIGURATION)) == \
+           ['BL:m1', 'BL:m2', 'diag']
+
+def testCounterDevices():
+    # Channels of the same device share the lock
+    assert counterDevices(['mca1', 'mca2', 'sim'], CONFIGURATION) == \
+           ['BL:dxp', 'BL:dxp', 'sim']
+
+def testUnlockedCounters():
+    # No hardware, or read only monitors shared by every scan
+    assert counterDevices(['date', 'sum', 'ringcurrent'], CONFIGURATION) == []
+
+def holdLocks(directory, devices, locked, release):
+    locks = DeviceLocks(directory)
+    locks.acquire(devices, 'other scan')
+    locked.set()
+    release.wait(10)
+    locks.release()
+
+def testLocksAcrossProcesses(tmp_path):
+    directory = str(tmp_path)
+    context = multiprocessing.get_context('spawn')
+    locked = context.Event()
+    release = context.Event()
+    holder = context.Process(target=holdLocks,
+                             args=(directory, ['BL:m1'], locked, release))
+    holder.start()
+
+    try:
+        assert locked.wait(30)
+
+        locks = DeviceLocks(directory)
+        with pytest.raises(DeviceBusy, match='other scan'):
+            locks.acquire(['BL:m1', 'BL:m2'], 'this scan', timeout=0.2,
+                          poll=0.05)
+        # All or nothing: the free device isn't kept locked
+        assert locks.files == {}
+
+        # Independent devices don't wait
+        locks.acquire(['BL:m2'], 'this scan', timeout=0)
+        locks.release()
+    finally:
+        release.set()
+        holder.join()
+
+    locks.acquire(['BL:m1'], 'this scan', timeout=1, poll=0.05)
+    locks.release()
@@ -0,0 +1,41 @@
+import numpy
+import pytest
+
+from scan_utils.mask import pointsInPolygon, loadMask, maskedSnake
+
+def testPointsInPolygon():
+    square = [[0, 0], [2, 0], [2, 2], [0, 2]]
+    x = numpy.array([1, 3, 0.5, -1])
+    y = numpy.array([1, 1, 1.5, 1])
+
+    assert pointsInPolygon(x, y, square).tolist() == [True, False, True, False]
+
+def testPointsInConcavePolygon():
+    # U shape, the notch is outside
+    u = [[0, 0], [3, 0], [3, 3], [2, 3], [2, 1], [1, 1], [1, 3], [0, 3]]
+    x = numpy.array([0.5, 1.5, 2.5, 1.5])
+    y = numpy.array([2, 2, 2, 0.5])
+
+    assert pointsInPolygon(x, y, u).tolist() == [True, False, True, True]
+
+def testLoadImageMask(tmp_path):
+    fileName = str(tmp_path / 'mask.npy')
+    numpy.save(fileName, numpy.array([[1, 0, 1], [0, 1, 0]]))
+
+    mask = loadMask(fileName, [[0, 1, 2], [0, 1]])
+
+    assert mask.dtype == bool
+    assert mask.tolist() == [[True, False, True], [False, True, False]]
+
+def testLoadMaskShapeMismatch(tmp_path):
+    fileName = str(tmp_path / 'mask.txt')
+    numpy.savetxt(fileName, numpy.ones((3, 3)))
+
+    with pytest.raises(ValueError):
+        loadMask(fileName, [[0, 1, 2], [0, 1]])
+
+def testMaskedSnake():
+    mask = numpy.array([[True, False, True], [True, True, False]])
+
+    # Second line is visited backwards: logical 4, 3 are snake 4, 5
+    assert maskedSnake(mask).tolist() == [0, 2, 4, 5]
@@ -0,0 +1,51 @@
+import numpy
+
+from scan_utils.path_optimizer import gridOrder, optimizeGrid, optimizePoints,\
+                                      pathTime, snakeIndex, restoreLogicalOrder
+
+def testGridOrderVisitsEveryPointOnce():
+    for pattern in ('snake', 'raster', 'spiral'):
+        for fastAxis in (0, 1):
+            order = gridOrder((4, 3), fastAxis, pattern)
+            assert sorted(map(tuple, order)) == \
+                   [(i, j) for i in range(4) for j in range(3)]
+
+def testSnakeOrder():
+    order = gridOrder((3, 2), 0, 'snake')
+    assert order.tolist() == [[0, 0], [1, 0], [2, 0], [2, 1], [1, 1], [0, 1]]
+
+def testOptimizeGridPrefersFastMotor():
+    # Motor 1 is much faster, so it should be the fast axis
+    points, logical, fastAxis, pattern, t = optimizeGrid(
+        [numpy.arange(5), numpy.arange(5)], [1, 100])
+
+    assert fastAxis == 1
+    assert pattern == 'snake'
+    assert sorted(logical) == list(range(25))
+    assert t <= pathTime(numpy.column_stack(points), [1, 100], [None, None])
+
+def testOptimizePointsNeverSlower():
+    rng = numpy.random.default_rng(1)
+    points = [rng.uniform(0, 10, 50).tolist(), rng.uniform(0, 10, 50).tolist()]
+    original = pathTime(numpy.column_stack(points), [1, 1], [None, None])
+
+    ordered, order, t = optimizePoints(points, [1, 1])
+
+    assert sorted(order) == list(range(50))
+    assert t <= original
+    assert numpy.allclose(ordered[0], numpy.asarray(points[0])[order])
+
+def testSnakeIndex():
+    # 2 lines of 3 points, the second line is reversed
+    assert snakeIndex([0, 1, 2, 3, 4, 5], 3).tolist() == [0, 1, 2, 5, 4, 3]
+
+def testRestoreLogicalOrder():
+    data = {'points': [0, 1, 2], 'x': [20, 0, 10], 'y': [2, 0, 1],
+            'other': [1, 2]}
+
+    restoreLogicalOrder(data, [2, 0, 1])
+
+    assert data['x'] == [0, 10, 20]
+    assert data['y'] == [0, 1, 2]
+    assert data['points'] == [0, 1, 2]
+    assert data['other'] == [1, 2]
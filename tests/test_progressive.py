@@ -0,0 +1,40 @@
+import numpy
+
+from scan_utils.path_optimizer import snakeIndex
+from scan_utils.progressive import levelStrides, progressiveOrder, \
+                                   ProgressiveMap
+
+def testLevelStrides():
+    assert levelStrides(3) == [4, 2, 1]
+
+def testProgressiveOrderCoversGridOnce():
+    order, sizes = progressiveOrder(5, 6, 3)
+
+    assert sorted(order) == list(range(30))
+    assert sum(sizes) == 30
+    # First level: every 4th position of both motors
+    assert sizes[0] == 2*2
+
+def testRefineMask():
+    refine = numpy.zeros((4, 4), dtype=bool)
+    refine[:2, :2] = True
+
+    order, sizes = progressiveOrder(4, 4, 2, refine)
+
+    # Coarse level covers the whole map, then only the refined region
+    assert sizes == [4, 3]
+
+def testFilledMap(tmp_path):
+    fileName = str(tmp_path / 'map.npz')
+    m = ProgressiveMap(fileName, 4, 4, 2)
+    order, sizes = progressiveOrder(4, 4, 2)
+
+    # Only the first level is measured, values are the logical index
+    for index in order[:sizes[0]]:
+        logical = snakeIndex(index, 4)
+        m.add('c', int(index), float(logical))
+    m.save()
+
+    filled = numpy.load(fileName)['c']
+    assert filled.tolist() == [[0, 0, 2, 2], [0, 0, 2, 2],
+                               [8, 8, 10, 10], [8, 8, 10, 10]]
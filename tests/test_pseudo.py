@@ -0,0 +1,46 @@
+import numpy
+import pytest
+
+from scan_utils.pseudo import realTrajectory, TrajectoryError
+
+class Device():
+    def __init__(self, position):
+        self.position = position
+
+    def getRealPosition(self):
+        return self.position
+
+CONFIGURATION = {'motors': {
+    'x': {'type': 'real'},
+    'y': {'type': 'real'},
+    'offset': {'type': 'real'},
+    # Moves x and y together, keeping their difference
+    'diag': {'type': 'pseudo', 'dependencies': ['x', 'y', 'offset'],
+             'targets': {'x': 'T', 'y': 'T + offset'},
+             'position': '(x + y - offset)/2'},
+    'double': {'type': 'pseudo', 'dependencies': ['diag'],
+               'targets': {'diag': 'T/2'}, 'position': '2*diag'},
+    'wrong': {'type': 'pseudo', 'dependencies': ['x'],
+              'targets': {'x': 'T'}, 'position': 'x + 1'},
+}}
+
+DEVICES = {'x': Device(0), 'y': Device(1), 'offset': Device(1), 'diag': Device(0)}
+
+def testRoundTrip():
+    points = numpy.linspace(0, 1, 11)
+
+    real = realTrajectory('diag', points, CONFIGURATION, DEVICES)
+
+    assert list(real) == ['x', 'y']
+    assert numpy.allclose(real['x'], points)
+    assert numpy.allclose(real['y'], points + 1)
+
+def testNestedPseudoMotors():
+    real = realTrajectory('double', [0, 2, 4], CONFIGURATION, DEVICES)
+
+    assert numpy.allclose(real['x'], [0, 1, 2])
+    assert numpy.allclose(real['y'], [1, 2, 3])
+
+def testRoundTripMismatch():
+    with pytest.raises(TrajectoryError):
+        realTrajectory('wrong', [0, 1], CONFIGURATION, DEVICES)
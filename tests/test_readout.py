@@ -0,0 +1,78 @@
+import pytest
+
+readout = pytest.importorskip('scan_utils.readout')
+
+class Motor():
+    def __init__(self):
+        self.position = 0
+        self.reads = 0
+
+    def getValue(self):
+        self.reads += 1
+        return self.position
+
+    def setValue(self, v):
+        self.position = v
+
+class Param():
+    def __init__(self, device):
+        self.device = device
+
+    def getDevice(self):
+        return self.device
+
+class Scan():
+    def __init__(self, motor):
+        self.motor = motor
+
+    def getScanParams(self):
+        return [Param(self.motor)]
+
+    def getCountTime(self):
+        return 1
+
+    def _Scan__waitDevices(self):
+        pass
+
+    def _Scan__saveCounterData(self, **kwargs):
+        raise AssertionError('py4syn must not read the counters')
+
+class Readout():
+    def read(self):
+        return {'c': 42}
+
+    def close(self):
+        pass
+
+@pytest.fixture
+def scan(monkeypatch):
+    monkeypatch.setattr(readout, 'Readout', Readout)
+    monkeypatch.setattr(readout, 'waitCounters', lambda t, idxs: None)
+    monkeypatch.setattr(readout.scanModule, 'SCAN_DATA', {'c': []},
+                        raising=False)
+    return Scan(Motor())
+
+def testPositionReadOncePerPoint(scan):
+    r = readout.ScanReadout()
+    r.attach(scan)
+    motor = scan.motor
+
+    for point in (1, 2):
+        motor.setValue(point)
+        scan._Scan__waitDevices()
+        assert motor.getValue() == point
+        assert motor.getValue() == point
+    assert motor.reads == 2
+
+    r.close()
+    motor.getValue()
+    assert motor.reads == 3
+    assert 'getValue' not in vars(motor)
+
+def testCountersSaved(scan):
+    r = readout.ScanReadout()
+    r.attach(scan)
+
+    scan._Scan__saveCounterData(idx=[0])
+    assert readout.scanModule.SCAN_DATA['c'] == [42]
+    r.close()
@@ -0,0 +1,49 @@
+import numpy
+
+from scan_utils.repetitions import RepetitionStats
+
+def testWelfordMatchesNumpy():
+    rng = numpy.random.default_rng(0)
+    values = rng.normal(10, 2, (20, 4))
+    stats = RepetitionStats(4)
+
+    for repetition in values:
+        for index, value in enumerate(repetition):
+            stats.add('c', index, float(value))
+
+    assert numpy.allclose(stats.mean['c'], values.mean(axis=0))
+    assert numpy.allclose(stats.variance('c'), values.var(axis=0, ddof=1))
+    assert numpy.allclose(stats.standardError('c'),
+                          values.std(axis=0, ddof=1)/numpy.sqrt(20))
+
+def testIgnoresNanAndNonNumeric():
+    stats = RepetitionStats(2)
+
+    for value in (1.0, float('nan'), 'text', True, 3.0):
+        stats.add('c', 0, value)
+
+    assert stats.count['c'][0] == 2
+    assert stats.mean['c'][0] == 2.0
+
+def testMaxRelativeError():
+    stats = RepetitionStats(3)
+    stats.add('c', 0, 10.0)
+    # Not enough repetitions yet
+    assert stats.maxRelativeError() == float('inf')
+
+    stats.add('c', 0, 12.0)
+    # Points 1 and 2 were never visited (masked), they don't count
+    assert numpy.isclose(stats.maxRelativeError(), 1/11)
+
+def testSaveVisitedPoints(tmp_path):
+    stats = RepetitionStats(3)
+    for value in (1.0, 3.0):
+        stats.add('c', 0, value)
+        stats.add('c', 2, value*2)
+
+    fileName = str(tmp_path / 'mean.txt')
+    stats.save(fileName, [[0.0, 2.0]], ['m'])
+
+    saved = numpy.loadtxt(fileName)
+    assert saved[:, 0].tolist() == [0.0, 2.0]
+    assert saved[:, 1].tolist() == [2.0, 4.0]
@@ -0,0 +1,76 @@
+import threading
+import time
+
+import numpy
+
+from scan_utils.events import EventBus, PointEvent, ScanEvent
+from scan_utils.replay import EventRecorder, readRecording, Replay, \
+                              ReplayWriters
+
+def record(fileName, header, events):
+    bus = EventBus()
+    recorder = EventRecorder(fileName, bus, header)
+    for event in events:
+        bus.publish(event)
+    recorder.close()
+
+def pointEvents(n, interval=0.0):
+    start = 1000.0
+    events = [ScanEvent('start', start, 0)]
+    for i in range(n):
+        t = start + i*interval
+        events.append(PointEvent(i, i, {'x': float(i)}, {'c': i},
+                                 {'mca1': numpy.full(8, i + 1.0)}, t, t, 1.0, 0))
+    events.append(ScanEvent('end', start + n*interval, 0))
+
+    return events
+
+def testRecordAndRead(tmp_path):
+    fileName = str(tmp_path / 'scan.pkl')
+    events = pointEvents(5)
+
+    record(fileName, {'args': {}}, events)
+    header, recorded = readRecording(fileName)
+    recorded = list(recorded)
+
+    assert header == {'args': {}}
+    assert [type(e) for e in recorded] == [type(e) for e in events]
+    assert recorded[3].values == {'c': 2}
+
+def testReplaySpeed(tmp_path):
+    fileName = str(tmp_path / 'scan.pkl')
+    record(fileName, {}, pointEvents(5, interval=0.02))
+    bus = EventBus()
+    s = bus.subscribe()
+
+    replay = Replay(readRecording(fileName)[1], bus, speed=2)
+    start = time.time()
+    replay.run()
+    bus.close()
+
+    # 5 intervals of 20 ms at twice the speed
+    assert 0.04 <= time.time() - start < 0.5
+    assert replay.points == 5
+    assert len(list(s)) == 7
+
+def testReplayWriters(tmp_path):
+    fileName = str(tmp_path / 'scan.pkl')
+    configuration = {'misc': {}, 'counters': {'mca1': {
+        'spectra': True, 'spill': True, 'rois': {'all': [0, 7]}}}}
+    record(fileName, {'args': {'count': 1}, 'counters': ['mca1'],
+                      'image': True, 'configuration': configuration,
+                      'lines': 2, 'pointsPerLine': 2}, pointEvents(4))
+
+    bus = EventBus()
+    writers = ReplayWriters(readRecording(fileName)[0], str(tmp_path / 'out'))
+    thread = threading.Thread(target=writers.write,
+                              args=(bus.subscribe(100, 'block', 10),))
+    thread.start()
+    Replay(readRecording(fileName)[1], bus, speed=0).run()
+    bus.close()
+    thread.join()
+
+    spectra = numpy.load(str(tmp_path / 'out_mca1_spectra.npy'))
+    assert spectra[..., 0].tolist() == [[1, 2], [4, 3]]
+    rois = numpy.load(str(tmp_path / 'out_mca1_rois.npz'))
+    assert rois['values'][:, 0].tolist() == [8, 16, 24, 32]
@@ -0,0 +1,45 @@
+import pytest
+
+scanModule = pytest.importorskip('py4syn.utils.scan')
+
+from scan_utils.retry import PointRetry, PointFailed, FAILED
+
+@pytest.fixture
+def retry(monkeypatch):
+    monkeypatch.setattr(scanModule, 'SCAN_DATA',
+                        {'points': [], FAILED: [], 'c': []}, raising=False)
+    return PointRetry(retries=2, delay=0, maxDelay=0)
+
+def testRetrySucceeds(retry):
+    calls = []
+
+    def flaky():
+        calls.append(1)
+        if len(calls) < 2:
+            raise IOError('timeout')
+        return 'ok'
+
+    assert retry.run('Counting', flaky) == 'ok'
+    assert len(calls) == 2
+
+def testRetryGivesUp(retry):
+    def broken():
+        raise IOError('timeout')
+
+    with pytest.raises(PointFailed, match='Counting failed'):
+        retry.run('Counting', broken)
+
+def testMarkFailed(retry):
+    data = scanModule.SCAN_DATA
+    data['points'].append(0)
+    mark = retry.mark()
+    data['c'].append(1.0)
+    retry.counted(mark)
+
+    data['points'].append(1)
+    mark = retry.mark()
+    retry.markFailed(1, 'timeout', mark)
+
+    assert data['c'][0] == 1.0
+    assert data['c'][1] != data['c'][1]
+    assert retry.failed == [(1, 'timeout')]
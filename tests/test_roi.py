@@ -0,0 +1,61 @@
+import numpy
+import pytest
+
+from scan_utils.roi import parseRois, roiSums, RoiStore, loadRois, \
+                           loadSpectra, recomputeRois
+
+def testParseRois():
+    names, rois = parseRois({'Fe': [10, 20], 'Cu': [1, 5, 8]})
+
+    assert names == ['Cu', 'Fe']
+    assert rois.tolist() == [[1, 5, 8], [0, 10, 20]]
+
+def testParseRoisInvalid():
+    with pytest.raises(ValueError):
+        parseRois({'Fe': [20, 10]})
+
+def testRoiSums():
+    spectra = numpy.arange(2*3*16).reshape(2, 3, 16)
+    _, rois = parseRois({'a': [0, 2, 5], 'b': [2, 0, 15]})
+
+    sums = roiSums(spectra, rois)
+
+    assert sums.shape == (2, 2)
+    assert sums[:, 0].tolist() == spectra[:, 0, 2:6].sum(axis=1).tolist()
+    assert sums[:, 1].tolist() == spectra[:, 2].sum(axis=1).tolist()
+
+def testRoiSumsSingleSpectrum():
+    _, rois = parseRois({'a': [1, 2]})
+    assert roiSums(numpy.arange(4), rois).tolist() == [3]
+
+def testRoiStore(tmp_path):
+    prefix = str(tmp_path / 'scan_mca1')
+    store = RoiStore(prefix, {'a': [0, 3]}, every=2)
+
+    for i in range(5):
+        store.add(i, numpy.full(8, i))
+    # Failed points have no spectrum
+    store.add(5, numpy.float64('nan'))
+    store.close()
+
+    names, points, values = loadRois(prefix)
+    assert names == ['a']
+    assert points.tolist() == [0, 1, 2, 3, 4]
+    assert values[:, 0].tolist() == [0, 4, 8, 12, 16]
+
+    kept, spectra = loadSpectra(prefix)
+    assert kept.tolist() == [0, 2, 4]
+    assert spectra[:, 0].tolist() == [0, 2, 4]
+
+    _, _, values = recomputeRois(prefix, {'b': [0, 7]})
+    assert values[:, 0].tolist() == [0, 16, 32]
+
+def testRoiStoreTrigger(tmp_path):
+    prefix = str(tmp_path / 'scan_mca1')
+    store = RoiStore(prefix, {'a': [0, 3]}, trigger="roi['a'] > 10")
+
+    for i in range(5):
+        store.add(i, numpy.full(8, i))
+    store.close()
+
+    assert loadSpectra(prefix)[0].tolist() == [3, 4]
@@ -0,0 +1,39 @@
+from time import time
+
+from scan_utils.settle import ReadbackSettle, settle
+
+def testSettlesAfterWindow():
+    s = ReadbackSettle('m', lambda: 1.0, 0.01, window=0.05, poll=0.005)
+    start = time()
+
+    assert s.wait()
+    assert time() - start >= 0.05
+
+def testTimeout():
+    # Readback keeps moving
+    s = ReadbackSettle('m', time, 1e-6, window=0.05, timeout=0.1, poll=0.005)
+
+    assert not s.wait()
+
+def testSettlersAreWaitedTogether(capsys):
+    settlers = [ReadbackSettle('a', lambda: 1.0, 0.01, 0.1, poll=0.005),
+                ReadbackSettle('b', lambda: 2.0, 0.01, 0.1, poll=0.005),
+                ReadbackSettle('c', lambda: 3.0, 0.01, 0.1, poll=0.005)]
+    start = time()
+
+    settle(settlers, 1.0)
+
+    # The longest window, not their sum
+    assert time() - start < 0.2
+    assert capsys.readouterr().out == ''
+
+def testFallbackIncludesSettleTime(capsys):
+    # Readback keeps moving, times out after 0.2s
+    settlers = [ReadbackSettle('m', time, 1e-6, 0.05, timeout=0.2, poll=0.005)]
+    start = time()
+
+    settle(settlers, 0.3)
+
+    elapsed = time() - start
+    assert 0.3 <= elapsed < 0.45
+    assert 'did not settle' in capsys.readouterr().out
@@ -0,0 +1,37 @@
+import numpy
+import pytest
+
+from scan_utils.events import PointEvent
+from scan_utils.shared import SharedSlots
+
+def testSlots():
+    arrays = SharedSlots(2, 4)
+
+    first = arrays.write([1, 2, 3])
+    second = arrays.write([4])
+    # Every slot in use
+    assert arrays.write([5]) is None
+    assert arrays.dropped == 1
+
+    assert arrays.read(*first).tolist() == [1, 2, 3]
+    assert arrays.read(*second).tolist() == [4]
+    assert arrays.write([6]) is not None
+
+def testLongArraysSentThroughPipe():
+    scanEngine = pytest.importorskip('scanEngine')
+    arrays = SharedSlots(2, 4)
+    sent = []
+
+    class Events():
+        def __iter__(self):
+            yield PointEvent(0, 0, {}, {}, {'short': numpy.ones(4),
+                                            'long': numpy.arange(10)},
+                             0, 0, 1, 0)
+
+    scanEngine.forward(Events(), lambda *e: sent.append(e), arrays)
+
+    kinds = dict((e[2], e) for e in sent if e[0] != 'point')
+    assert kinds['short'][0] == 'array'
+    assert kinds['long'][0] == 'array-data'
+    assert kinds['long'][3].tolist() == list(range(10))
+    assert arrays.dropped == 0
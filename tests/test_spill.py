@@ -0,0 +1,54 @@
+import tracemalloc
+
+import numpy
+
+from scan_utils.spill import SpectraImage, SpilledDevice
+
+class Device():
+    name = 'mca1'
+
+    def startCollectImage(self, rows=0, cols=0):
+        raise AssertionError('the device must not collect the image')
+
+def testSnakeImageInLogicalOrder(tmp_path):
+    image = SpectraImage(str(tmp_path / 'spectra.npy'), 2, 3, snake=True)
+
+    for i in range(6):
+        image.addSpectrum(i, numpy.full(4, i, dtype=numpy.int32))
+    image.close()
+
+    saved = numpy.load(str(tmp_path / 'spectra.npy'))
+    assert saved.shape == (2, 3, 4)
+    assert saved[..., 0].tolist() == [[0, 1, 2], [5, 4, 3]]
+
+def testSpilledDeviceImage(tmp_path):
+    device = SpilledDevice(Device())
+    image = SpectraImage(str(tmp_path / 'spectra.npy'), 1, 2)
+    device.attach(image)
+
+    device.startCollectImage(1, 2)
+    image.addSpectrum(0, numpy.ones(3))
+    image.addSpectrum(1, numpy.zeros(3))
+    device.stopCollectImage()
+
+    assert device.name == 'mca1'
+    assert device.image[0, :, 0].tolist() == [1, 0]
+
+def testScanDataKeepsOnlyViews(tmp_path):
+    image = SpectraImage(str(tmp_path / 'spectra.npy'), 20, 100)
+    values = []
+
+    tracemalloc.start()
+    for i in range(2000):
+        values.append(numpy.full(4096, i, dtype=numpy.float64))
+        image.spill(i, values)
+    used = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    image.close()
+
+    # 2000 spectra of 32 kB would be 64 MB
+    assert used < 4*1024*1024
+    assert len(values) == 2000
+    assert not any(v.flags.owndata for v in values)
+    assert values[1234][0] == 1234
+    assert numpy.load(str(tmp_path / 'spectra.npy'))[12, 34, 0] == 1234
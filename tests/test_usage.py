@@ -0,0 +1,62 @@
+"""Usage text of the command line scripts. The scripts import py4syn and
+other device libraries, so their docstrings are read without importing
+them"""
+import ast
+import os
+import re
+
+import pytest
+from docopt import docopt, parse_defaults
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SCRIPTS = ('scan', 'scanDaemon', 'scanCatalog', 'scanReplay', 'scanMonitor',
+           'scanPlan')
+
+def usage(script):
+    with open(os.path.join(ROOT, script + '.py')) as f:
+        return ast.get_docstring(ast.parse(f.read()), clean=False)
+
+def documentedDefaults(doc):
+    """Long name of each option whose description has a default value"""
+    options = doc[doc.index('Options:'):]
+    blocks = re.split(r'\n(?=[ \t]*-)', options)
+    names = []
+
+    for block in blocks:
+        if '[default:' in block:
+            name = re.search(r'--[\w-]+', block) or re.search(r'-\w', block)
+            names.append(name.group(0))
+
+    return names
+
+@pytest.mark.parametrize('script', SCRIPTS)
+def testDefaultsAreParsed(script):
+    doc = usage(script)
+    parsed = dict((o.long or o.short, o.value) for o in parse_defaults(doc))
+
+    for name in documentedDefaults(doc):
+        assert parsed.get(name) is not None, name
+
+@pytest.mark.parametrize('script, argv', [
+    ('scan', '-a sh2x 0 1 0.1 1'),
+    ('scan', '-x -a --time 0.5 sh2x 0 1 0.1 sh2y 0 1 0.1'),
+    ('scan', '-x --mask m.yml --levels 3 --retries 2 sh2x 0 1 5 sh2y 0 1 5'),
+    ('scan', '--count 3 --target-error 0.01 --record r.pkl sh2x 0 1 0.1 1'),
+    ('scanDaemon', ''),
+    ('scanCatalog', '-m sh2x -x 0.5 -n 10'),
+    ('scanCatalog', 'show 3'),
+    ('scanReplay', '-f -o out rec.pkl'),
+    ('scanMonitor', '-r 100 -t 10'),
+    ('scanPlan', '-p plan.yml'),
+])
+def testParse(script, argv):
+    docopt(usage(script), argv.split())
+
+def testScanDefaults():
+    p = docopt(usage('scan'), '-x -a --time 0.5 sh2x 0 1 0.1 sh2y 0 1 0.1'.split())
+
+    assert p['--count'] == '1'
+    assert p['--sleep'] == '0'
+    assert p['--levels'] == '1'
+    assert p['--time'] == '0.5'
@@ -0,0 +1,82 @@
+import numpy
+import pytest
+
+from scan_utils.xrf import fitSpectra, loadReferences, XrfMapper, \
+                           createXrfMappers
+
+BINS = 64
+
+def profile(center):
+    x = numpy.arange(BINS)
+    return numpy.exp(-(x - center)**2/8)
+
+@pytest.fixture
+def references(tmp_path):
+    fileName = str(tmp_path / 'refs.npz')
+    numpy.savez(fileName, Fe=profile(20), Cu=profile(40))
+    return fileName
+
+def testFitSpectra():
+    refs = numpy.array([profile(20), profile(40)])
+    amounts = numpy.array([[1.0, 2.0], [3.0, 0.5]])
+    projection = numpy.linalg.pinv(refs.T)
+
+    fitted, chi2 = fitSpectra(projection, refs, amounts @ refs,
+                              numpy.array([1.0, 2.0]))
+
+    assert numpy.allclose(fitted, [[1, 2], [6, 1]])
+    assert numpy.allclose(chi2, 0)
+
+def testLoadReferences(references):
+    names, refs = loadReferences(references)
+    assert names == ['Cu', 'Fe']
+    assert refs.shape == (2, BINS)
+
+    with pytest.raises(ValueError):
+        loadReferences(references, ['Zn'])
+
+class Executor():
+    '''Runs tasks right away'''
+    _max_workers = 1
+
+    def submit(self, function, *args):
+        from concurrent.futures import Future
+        future = Future()
+        future.set_result(function(*args))
+        return future
+
+def testMapper(references, tmp_path):
+    names, refs = loadReferences(references, ['Fe', 'Cu'])
+    published = []
+    mapper = XrfMapper(str(tmp_path / 'xrf.npz'), names, refs, Executor(),
+                       2, 2, snake=True, deadTime=0.01, batch=3,
+                       publish=lambda i, v: published.append(i))
+
+    for i in range(4):
+        mapper.add(i, (i + 1)*profile(20), 1.0)
+    # Failed point
+    mapper.add(3, numpy.float64('nan'), 1.0)
+    # Saturated detector, no valid dead-time correction
+    mapper.add(2, 1000*profile(20), 1.0)
+    mapper.close()
+
+    maps = numpy.load(str(tmp_path / 'xrf.npz'))
+    counts = profile(20).sum()
+    fe = maps['Fe']
+    assert numpy.isclose(fe[0, 0], 1/(1 - 0.01*counts))
+    # Snake: visited index 2 and 3 are the second line backwards
+    assert numpy.isnan(fe[1, 1])
+    assert numpy.isclose(fe[1, 0], 4/(1 - 0.01*4*counts))
+    assert numpy.allclose(maps['Cu'][~numpy.isnan(fe)], 0)
+    assert sorted(published) == [0, 1, 2, 2, 3]
+
+def testCreateMappers(references, tmp_path):
+    configuration = {'counters': {
+        'mca1': {'xrf': {'references': references, 'range': [10, 50]}},
+        'det': {}}}
+
+    mappers = createXrfMappers(['mca1', 'det'], configuration,
+                               str(tmp_path / 'scan'), Executor(), 1, 4)
+
+    assert list(mappers) == ['mca1']
+    assert mappers['mca1'].references.shape == (2, 41)